@@ -1,38 +1,119 @@
+"""
+This module calls the API endpoints of the running app and stores their
+responses in apireturns.txt, along with the latency of each call.
+
+The calls are independent, so they are made concurrently over a pooled
+session, and the run takes as long as the slowest endpoint rather than the
+sum of all of them. Each call has its own timeout, and failed connections
+and server errors are retried with exponential backoff.
+"""
+
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import config
+
+# Default timeouts in seconds of the endpoint calls, overridden by
+# 'api_timeouts' in config.json
+DEFAULT_TIMEOUTS = {
+    'predictions': 30,
+    'scoring': 30,
+    'summary_stats': 10,
+    'diagnostics': 60,
+    'evaluation': 30
+}
+
+
+def api_session(pool_size):
+    """
+    Create a session with a connection pool and retries with backoff, set
+    by 'api_retries' and 'api_backoff_seconds' in config.json.
+
+    Args:
+    - pool_size: The number of pooled connections.
+
+    Returns:
+    - The requests.Session.
+    """
+    retry = Retry(
+        total=config.get('api_retries', 3),
+        backoff_factor=config.get('api_backoff_seconds', 0.5),
+        status_forcelist=(500, 502, 503, 504),
+        # The prediction call only reads a dataset, so it is safe to retry
+        allowed_methods=frozenset({'GET', 'POST'}),
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def timed_call(session, method, url, timeout, **kwargs):
+    """
+    Make a request and measure its latency.
+
+    Args:
+    - session: The requests.Session.
+    - method: 'GET' or 'POST'.
+    - url: The endpoint URL.
+    - timeout: The timeout in seconds.
+    - kwargs: Optional; Arguments passed on to the request.
+
+    Returns:
+    - A tuple of the decoded JSON response and a dictionary with the status
+    code, the number of retries and the latency in seconds.
+    """
+    start = time.perf_counter()
+    response = session.request(method, url, timeout=timeout, **kwargs)
+    seconds = time.perf_counter() - start
+    response.raise_for_status()
+    retries = response.raw.retries
+    return response.json(), {
+        'status': response.status_code,
+        'retries': len(retries.history) if retries is not None else 0,
+        'seconds': seconds
+    }
 
 
 def run_apicalls():
     """
     This function makes various API calls and stores the responses.
     """
-    # Load the configuration to get various paths
-    with open('config.json', 'r', encoding='utf-8') as f:
-        config = json.load(f)
-
-    output_file_path = os.path.join(
-        config['output_model_path'], 'apireturns.txt')
-    test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
+    output_file_path = config.path('output_model_path', 'apireturns.txt')
+    test_data_path = config.path('test_data_path', 'testdata.csv')
 
     # Specify a URL that resolves to your workspace
-    URL = "http://127.0.0.1:8000"
+    URL = config.get('api_url', "http://127.0.0.1:8000")
+    timeouts = {**DEFAULT_TIMEOUTS, **config.get('api_timeouts', {})}
 
     # API endpoints calls
-    response1 = requests.post(
-        f"{URL}/prediction", json={"dataset_path": test_data_path})
-    # print(response1.status_code, response1.text)
-    response2 = requests.get(f"{URL}/scoring")
-    response3 = requests.get(f"{URL}/summarystats")
-    response4 = requests.get(f"{URL}/diagnostics")
+    calls = {
+        'predictions': ('POST', f"{URL}/prediction",
+                        {'json': {"dataset_path": test_data_path}}),
+        'scoring': ('GET', f"{URL}/scoring", {}),
+        'summary_stats': ('GET', f"{URL}/summarystats", {}),
+        'diagnostics': ('GET', f"{URL}/diagnostics", {}),
+        'evaluation': ('GET', f"{URL}/evaluation", {})
+    }
+    start = time.perf_counter()
+    with api_session(len(calls)) as session, \
+            ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {name: executor.submit(timed_call, session, method, url,
+                                         timeouts[name], **kwargs)
+                   for name, (method, url, kwargs) in calls.items()}
+        results = {name: future.result() for name, future in futures.items()}
 
     # Combine all API responses
-    responses = {
-        "predictions": response1.json(),
-        "scoring": response2.json(),
-        "summary_stats": response3.json(),
-        "diagnostics": response4.json()
-    }
+    responses = {name: response for name, (response, _) in results.items()}
+    responses['latency'] = {name: latency
+                            for name, (_, latency) in results.items()}
+    responses['latency']['total_seconds'] = time.perf_counter() - start
 
     # Ensure the output directory exists
     os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
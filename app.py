@@ -2,31 +2,51 @@
 Flask application for scoring monitoring.
 """
 
-import pickle
-import json
-import os
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 import diagnostics
-from scoring import score_model
+import batch_prediction
+import model_registry
+from datastore import dataset_exists
+from evaluation import evaluation_summary, get_evaluation
+from scoring import read_score_history, score_model
+from config import config
 
 # Set up variables for use in our script
 app = Flask(__name__)
 app.secret_key = '1652d576-484a-49fd-913a-6879acfa6ba4'
 
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
 
-dataset_csv_path = os.path.join(config['output_folder_path'])
-prediction_model_path = os.path.join(
-    config['prod_deployment_path'], 'trainedmodel.pkl')
+def preload():
+    """
+    Load the config, the deployed model and the dataset profile into
+    memory, so that requests only pay for serving them. Called by serve.py
+    before forking the workers, which then share these copy-on-write.
+    """
+    # Warm the model cache so the first request only pays for inference
+    try:
+        model_registry.get_inference_model()
+    except FileNotFoundError:
+        print("Model file not found. Ensure the model file path is correct \
+            in config.json.")
+    # Nothing to profile until the first ingestion
+    if not dataset_exists(config.path('output_folder_path',
+                                      'finaldata.csv')):
+        return
+    try:
+        diagnostics.dataframe_summary()
+    except (OSError, ValueError) as e:
+        print(f"Error preloading the dataset profile: {e}")
+
+
+def init_app():
+    """
+    Warm the model cache and start the background diagnostics job. Called
+    by the serving entry points rather than at import time.
+    """
+    preload()
 
-PREDICTION_MODEL = None
-try:
-    with open(prediction_model_path, 'rb') as model_file:
-        PREDICTION_MODEL = pickle.load(model_file)
-except FileNotFoundError:
-    print("Model file not found. Ensure the model file path is correct \
-        in config.json.")
+    # Keep the diagnostics snapshot fresh in the background
+    diagnostics.start_background_refresh()
 
 # Prediction Endpoint
 
@@ -42,6 +62,33 @@ def prediction():
         predictions = diagnostics.model_predictions(dataset_path)
         return jsonify(predictions), 200
 
+# Inline Batch Prediction Endpoint
+
+
+@app.route("/prediction/batch", methods=['POST', 'OPTIONS'])
+def batch_prediction_endpoint():
+    """
+    Endpoint for scoring records posted in the request body, either as
+    JSON ({'columns': ...} or {'records': ...}), which is loaded whole, or
+    as NDJSON, which is streamed in batches. Invalid NDJSON lines are
+    answered with an error line in the stream.
+    """
+    if request.method == 'POST':
+        if request.mimetype == 'application/x-ndjson':
+            return Response(
+                stream_with_context(
+                    batch_prediction.predict_ndjson(request.stream)),
+                mimetype='application/x-ndjson')
+        try:
+            features = batch_prediction.payload_to_array(request.get_json())
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        predictions, probabilities = batch_prediction.predict_array(
+            features)
+        return jsonify({'predictions': predictions,
+                        'probabilities': probabilities}), 200
+    return '', 200
+
 # Scoring Endpoint
 
 
@@ -53,6 +100,37 @@ def scoring():
     f1_score = score_model()
     return jsonify({'F1 score': f1_score}), 200
 
+# Evaluation Endpoint
+
+
+@app.route("/evaluation", methods=['GET', 'OPTIONS'])
+def evaluation_endpoint():
+    """
+    Endpoint for the metrics of the deployed model on the test dataset.
+    """
+    return jsonify(evaluation_summary(get_evaluation())), 200
+
+# Score History Endpoint
+
+
+@app.route("/scoring/history", methods=['GET', 'OPTIONS'])
+def scoring_history():
+    """
+    Endpoint for the history of champion and challenger scores.
+    """
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(read_score_history(limit)), 200
+
+# Model Cache Endpoint
+
+
+@app.route("/modelcache", methods=['GET', 'OPTIONS'])
+def modelcache():
+    """
+    Endpoint for the model cache hit and reload counters.
+    """
+    return jsonify(model_registry.stats()), 200
+
 # Summary Statistics Endpoint
 
 
@@ -70,18 +148,23 @@ def summarystats():
 @app.route("/diagnostics", methods=['GET', 'OPTIONS'])
 def diagnostics_endpoint():
     """
-    Endpoint for diagnostics information.
+    Endpoint for diagnostics information, served from the snapshot kept
+    up to date by the background diagnostics job.
+    """
+    return jsonify(diagnostics.diagnostics_snapshot()), 200
+
+# Stage Metrics History Endpoint
+
+
+@app.route("/diagnostics/history", methods=['GET', 'OPTIONS'])
+def diagnostics_history():
+    """
+    Endpoint for the history of instrumented pipeline stage runs.
     """
-    execution_times = diagnostics.execution_time()
-    missing_data = diagnostics.missing_data_check()
-    outdated_packages = diagnostics.outdated_packages_list()
-    diagnostics_info = {
-        'execution_time': execution_times,
-        'missing_data': missing_data,
-        'outdated_packages': outdated_packages
-    }
-    return jsonify(diagnostics_info), 200
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify(diagnostics.stage_metrics_history(limit)), 200
 
 
 if __name__ == "__main__":
+    init_app()
     app.run(host='0.0.0.0', port=8000, debug=True, threaded=True)
@@ -0,0 +1,203 @@
+"""
+This module contains functions for scoring records posted as JSON or NDJSON
+directly with the deployed model, without building a DataFrame.
+
+A JSON payload is parsed whole, so its memory grows with the request body.
+NDJSON is read and scored batch by batch, so only NDJSON requests are
+bounded in memory.
+"""
+
+import json
+import numpy as np
+from datastore import FEATURE_COLUMNS
+import model_registry
+from config import config
+
+read_chunk_size = 1 << 16
+
+
+def batch_size():
+    """
+    Get the maximum number of rows scored at once.
+
+    Returns:
+    - The 'prediction_batch_size' setting in config.json.
+    """
+    return config.get('prediction_batch_size', 10000)
+
+
+def columns_to_array(columns):
+    """
+    Convert a columnar payload to a feature array.
+
+    Args:
+    - columns: A dictionary mapping each feature name to a list of values.
+
+    Returns:
+    - A float32 array of shape (rows, features).
+    """
+    return np.column_stack([np.asarray(columns[column], dtype=np.float32)
+                            for column in FEATURE_COLUMNS])
+
+
+def records_to_array(records):
+    """
+    Convert a row-oriented payload to a feature array.
+
+    Args:
+    - records: A list of records, each either a dictionary keyed by feature
+    name or a list of feature values in FEATURE_COLUMNS order.
+
+    Returns:
+    - A float32 array of shape (rows, features).
+    """
+    array = np.empty((len(records), len(FEATURE_COLUMNS)), dtype=np.float32)
+    for i, record in enumerate(records):
+        if isinstance(record, dict):
+            record = [record[column] for column in FEATURE_COLUMNS]
+        array[i] = record
+    return array
+
+
+def payload_to_array(payload):
+    """
+    Convert a JSON payload to a feature array. The payload is already
+    loaded whole, so use NDJSON to bound the memory of large requests.
+
+    Args:
+    - payload: Either {'columns': {feature: [values]}} or
+    {'records': [record, ...]}.
+
+    Returns:
+    - A float32 array of shape (rows, features).
+    """
+    if 'columns' in payload:
+        return columns_to_array(payload['columns'])
+    if 'records' in payload:
+        return records_to_array(payload['records'])
+    raise KeyError("Payload must contain 'columns' or 'records'")
+
+
+def predict_array(features, model=None):
+    """
+    Score a feature array in batches of at most batch_size() rows.
+
+    Args:
+    - features: A float32 array of shape (rows, features).
+    - model: Optional; The model to use. Defaults to the deployed model.
+
+    Returns:
+    - A tuple of (predictions, probabilities) lists, where probabilities
+    are the predicted probabilities of the positive class.
+    """
+    model = model or model_registry.get_inference_model()
+    rows = batch_size()
+    predictions = []
+    probabilities = []
+    for start in range(0, len(features), rows):
+        batch = features[start:start + rows]
+        predictions.extend(model.predict(batch).tolist())
+        probabilities.extend(model.predict_proba(batch)[:, 1].tolist())
+    return predictions, probabilities
+
+
+def iter_lines(stream):
+    """
+    Split a binary stream into lines, reading it in fixed-size chunks.
+
+    Args:
+    - stream: A file-like object opened in binary mode.
+
+    Yields:
+    - The lines of the stream, without line endings.
+    """
+    remainder = b''
+    while True:
+        chunk = stream.read(read_chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def _reject_constant(name):
+    raise ValueError(f"Invalid number {name}")
+
+
+# Decoder of NDJSON records, rejecting NaN and Infinity, which would make
+# the predictions invalid JSON
+_decoder = json.JSONDecoder(parse_constant=_reject_constant)
+
+
+def iter_ndjson_batches(stream):
+    """
+    Read NDJSON records into feature arrays of at most batch_size() rows.
+    Each line is validated on its own, so a malformed line or a record
+    missing a feature is reported without ending the stream.
+
+    Args:
+    - stream: A binary stream of NDJSON lines, each holding one record.
+
+    Yields:
+    - Float32 arrays of shape (rows, features), or an {'error': ...,
+    'line': n} dictionary for each invalid line, numbered from 1. The
+    rows before an invalid line are yielded first, to keep the input order.
+    """
+    rows = batch_size()
+    batch = np.empty((rows, len(FEATURE_COLUMNS)), dtype=np.float32)
+    count = 0
+    for number, line in enumerate(iter_lines(stream), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = _decoder.decode(line.decode('utf-8'))
+            if isinstance(record, dict):
+                record = [record[column] for column in FEATURE_COLUMNS]
+            if not isinstance(record, list):
+                raise TypeError("Record must be an object or a list")
+            if None in record:
+                raise ValueError("Record has a missing feature value")
+            batch[count] = record
+        except KeyError as e:
+            error = f"Missing feature {e}"
+        except (TypeError, ValueError) as e:
+            error = str(e)
+        else:
+            count += 1
+            if count == rows:
+                yield batch
+                batch = np.empty_like(batch)
+                count = 0
+            continue
+        if count:
+            yield batch[:count]
+            batch = np.empty_like(batch)
+            count = 0
+        yield {'error': error, 'line': number}
+    if count:
+        yield batch[:count]
+
+
+def predict_ndjson(stream):
+    """
+    Score NDJSON records batch by batch, so memory stays bounded by the
+    batch size.
+
+    Args:
+    - stream: A binary stream of NDJSON lines, each holding one record.
+
+    Yields:
+    - One NDJSON line per batch with its predictions and probabilities, and
+    one {'error': ..., 'line': n} line per invalid input line.
+    """
+    model = model_registry.get_inference_model()
+    for features in iter_ndjson_batches(stream):
+        if isinstance(features, dict):
+            yield json.dumps(features) + '\n'
+            continue
+        predictions, probabilities = predict_array(features, model)
+        yield json.dumps({'predictions': predictions,
+                          'probabilities': probabilities}) + '\n'
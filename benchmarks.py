@@ -0,0 +1,1255 @@
+"""
+This module contains benchmarks for the scoring monitoring system.
+
+Run a benchmark with:
+    python benchmarks.py <benchmark name> [<JSON argument> ...]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from config import PROJECT_DIR, config
+from datagen import generate_frame, write_files
+
+# Script run in a fresh interpreter so that the peak RSS of each load
+# is measured on its own
+LOAD_SCRIPT = """
+import json, resource, sys, time
+from datastore import FEATURE_COLUMNS, load_dataset
+start = time.perf_counter()
+data = load_dataset(sys.argv[1], columns=FEATURE_COLUMNS,
+                    file_format=sys.argv[2])
+seconds = time.perf_counter() - start
+peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb,
+                  'rows': len(data)}))
+"""
+
+# Script running ingestion in a fresh interpreter against a temporary
+# config, so that its peak RSS is measured on its own
+INGEST_SCRIPT = """
+import json, resource, sys, time
+from config import config
+config.config_path = sys.argv[1]
+config.reload()
+import ingestion
+start = time.perf_counter()
+ingestion.merge_multiple_dataframe(incremental=False)
+seconds = time.perf_counter() - start
+peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb}))
+"""
+
+# Script running pipeline stage functions in a fresh interpreter against a
+# temporary config, so that the time and peak RSS of each stage are measured
+# on their own. The stage is a JSON list of ['module:function', args] calls.
+# The peak RSS is read from VmHWM, because ru_maxrss is inherited from the
+# parent process across the fork
+STAGE_SCRIPT = """
+import importlib, json, sys, time
+from config import config
+config.config_path = sys.argv[1]
+config.reload()
+calls = []
+for target, args in json.loads(sys.argv[2]):
+    module_name, function_name = target.split(':')
+    module = importlib.import_module(module_name)
+    calls.append((getattr(module, function_name), args))
+start = time.perf_counter()
+for function, args in calls:
+    function(*args)
+seconds = time.perf_counter() - start
+with open('/proc/self/status', 'r', encoding='utf-8') as status_file:
+    peak_rss_mb = next(int(line.split()[1]) / 1024 for line in status_file
+                       if line.startswith('VmHWM:'))
+print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb}))
+"""
+
+# Script loading a dataset and splitting it into training and test sets in
+# a fresh interpreter, the way named by argv[3], to measure its peak RSS
+SPLIT_SCRIPT = """
+import json, sys, time
+from config import config
+config.config_path = sys.argv[1]
+config.reload()
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from datastore import (FEATURE_COLUMNS, LABEL_COLUMN, load_compact_dataset,
+                       load_dataset)
+start = time.perf_counter()
+if sys.argv[3] == 'object dataframe':
+    # The original loader and split, with object strings and int64 columns
+    data = pd.read_csv(sys.argv[2])
+    data = data.iloc[:, 1:]
+    x = data.drop(LABEL_COLUMN, axis=1)
+    y = data[LABEL_COLUMN]
+    x_train, x_test, y_train, y_test = train_test_split(
+        x, y, test_size=0.2, random_state=0)
+elif sys.argv[3] == 'compact dataframe':
+    data = load_dataset(sys.argv[2], columns=FEATURE_COLUMNS + [LABEL_COLUMN])
+    x_train, x_test, y_train, y_test = train_test_split(
+        data[FEATURE_COLUMNS], data[LABEL_COLUMN], test_size=0.2,
+        random_state=0)
+else:
+    train, test = load_compact_dataset(
+        sys.argv[2], corporation=sys.argv[3].endswith('corporation')).split(
+            test_size=0.2, random_state=0)
+seconds = time.perf_counter() - start
+with open('/proc/self/status', 'r', encoding='utf-8') as status_file:
+    peak_rss_mb = next(int(line.split()[1]) / 1024 for line in status_file
+                       if line.startswith('VmHWM:'))
+print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb}))
+"""
+
+# Script serving the Flask app against a temporary config
+SERVE_SCRIPT = """
+import sys
+from config import config
+config.config_path = sys.argv[1]
+config.reload()
+from app import app, init_app
+init_app()
+app.run(host='127.0.0.1', port=int(sys.argv[2]), threaded=True)
+"""
+
+# Script serving the app with pre-forked workers against a temporary config
+PREFORK_SCRIPT = """
+import sys
+from config import config
+config.config_path = sys.argv[1]
+config.reload()
+import serve
+serve.serve(host='127.0.0.1', port=int(sys.argv[2]))
+"""
+
+
+def temporary_config(tmp_dir, **settings):
+    """
+    Write a config.json whose folders all live in a temporary directory.
+
+    Args:
+    - tmp_dir: The temporary directory.
+    - settings: Optional; Settings overriding the project config.
+
+    Returns:
+    - The path of the temporary config.json.
+    """
+    folders = {key: os.path.join(tmp_dir, key) for key in (
+        'input_folder_path', 'output_folder_path', 'test_data_path',
+        'output_model_path', 'prod_deployment_path')}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    with open(config.config_path, 'r', encoding='utf-8') as config_file:
+        tmp_config = json.load(config_file)
+    tmp_config.update(folders, **settings)
+    config_path = os.path.join(tmp_dir, 'config.json')
+    with open(config_path, 'w', encoding='utf-8') as config_file:
+        json.dump(tmp_config, config_file, indent=4)
+    return config_path
+
+
+def bench_storage(row_counts=(1_000_000, 10_000_000)):
+    """
+    Compare load time and peak RSS of the csv and parquet storage formats
+    when loading the model features.
+
+    Args:
+    - row_counts: Optional; The dataset sizes to benchmark.
+
+    Returns:
+    - A list of dictionaries with the results for each size and format.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        from datastore import write_dataset
+        for rows in row_counts:
+            csv_path = os.path.join(tmp_dir, f'data{rows}.csv')
+            data = generate_frame(rows)
+            for file_format in ('csv', 'parquet'):
+                write_dataset(data.copy(), csv_path, file_format)
+            del data
+            for file_format in ('csv', 'parquet'):
+                output = subprocess.run(
+                    [sys.executable, '-c', LOAD_SCRIPT, csv_path,
+                     file_format],
+                    capture_output=True, text=True, check=True,
+                    cwd=PROJECT_DIR).stdout
+                result = {'rows': rows, 'format': file_format,
+                          **json.loads(output)}
+                results.append(result)
+                print(result)
+    return results
+
+
+def latency_percentiles(latencies):
+    """
+    Summarize request latencies.
+
+    Args:
+    - latencies: A list of latencies in seconds.
+
+    Returns:
+    - A dictionary with the p50 and p99 latencies in milliseconds.
+    """
+    latencies_ms = np.asarray(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p99_ms': float(np.percentile(latencies_ms, 99))}
+
+
+def bench_batch_prediction(batch_sizes=(1, 1000, 100_000), iterations=50):
+    """
+    Load test the /prediction/batch endpoint with columnar JSON and NDJSON
+    payloads of increasing size.
+
+    Args:
+    - batch_sizes: Optional; The number of records per request.
+    - iterations: Optional; The number of requests for batches of up to
+    1000 rows, scaled down for larger batches.
+
+    Returns:
+    - A list of dictionaries with the latency percentiles for each batch
+    size and payload type.
+    """
+    from app import app
+    client = app.test_client()
+    results = []
+    for rows in batch_sizes:
+        data = generate_frame(rows)
+        columns = {column: data[column].tolist() for column in data.columns}
+        ndjson = '\n'.join(json.dumps(record) for record in
+                           data.to_dict(orient='records'))
+        payloads = {
+            'json': {'json': {'columns': columns}},
+            'ndjson': {'data': ndjson,
+                       'content_type': 'application/x-ndjson'}
+        }
+        for payload_type, kwargs in payloads.items():
+            latencies = []
+            for _ in range(max(5, iterations * 1000 // max(rows, 1000))):
+                start = time.perf_counter()
+                response = client.post('/prediction/batch', **kwargs)
+                response.get_data()
+                latencies.append(time.perf_counter() - start)
+            result = {'rows': rows, 'payload': payload_type,
+                      'requests': len(latencies),
+                      **latency_percentiles(latencies)}
+            results.append(result)
+            print(result)
+    return results
+
+
+def bench_inference(row_counts=(1, 1000, 1_000_000), min_seconds=1.0):
+    """
+    Compare the per-row cost of the original pickled-model prediction path
+    with the compact vectorized scorer, both producing a list of ints.
+
+    Args:
+    - row_counts: Optional; The number of rows to predict per call.
+    - min_seconds: Optional; The minimum time to spend timing each path.
+
+    Returns:
+    - A list of dictionaries with the microseconds per row of each path.
+    """
+    import pickle
+    from compact_model import (compact_model_path, feature_array,
+                               loads_compact_model)
+    from datastore import FEATURE_COLUMNS
+    model_path = config.path('prod_deployment_path', 'trainedmodel.pkl')
+    with open(model_path, 'rb') as model_file:
+        model = pickle.load(model_file)
+    with open(compact_model_path(model_path), 'rb') as model_file:
+        compact = loads_compact_model(model_file.read())
+
+    def sklearn_path(data):
+        predictions = model.predict(data[FEATURE_COLUMNS])
+        return [int(prediction) if isinstance(prediction, np.integer)
+                else prediction for prediction in predictions]
+
+    def compact_path(data):
+        return compact.predict(feature_array(data)).tolist()
+
+    results = []
+    for rows in row_counts:
+        data = generate_frame(rows)
+        for name, path in (('sklearn', sklearn_path),
+                           ('compact', compact_path)):
+            calls = 0
+            start = time.perf_counter()
+            while calls == 0 or time.perf_counter() - start < min_seconds:
+                path(data)
+                calls += 1
+            seconds = time.perf_counter() - start
+            result = {'rows': rows, 'path': name, 'calls': calls,
+                      'us_per_row': seconds / calls / rows * 1e6}
+            results.append(result)
+            print(result)
+    return results
+
+
+def bench_startup(budget_seconds=1.0):
+    """
+    Check that a fullprocess run finding no new data stays fast, and report
+    the import time of fullprocess measured with 'python -X importtime'.
+    The run uses a temporary config on a copy of the source data, ingested
+    beforehand, so the project data and models are left untouched.
+    Exits with a non-zero status from the command line if over budget.
+
+    Args:
+    - budget_seconds: Optional; The maximum wall time of the run.
+
+    Returns:
+    - A list with one dictionary holding the measurements and whether the
+    run passed.
+    """
+    import shutil
+    importtime = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import fullprocess'],
+        capture_output=True, text=True, check=True, cwd=PROJECT_DIR).stderr
+    import_us = {}
+    for line in importtime.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                import_us[name.strip()] = int(cumulative)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(tmp_dir, trace_memory=False)
+        source_path = os.path.join(PROJECT_DIR, 'sourcedata')
+        for name in os.listdir(source_path):
+            shutil.copy(os.path.join(source_path, name),
+                        os.path.join(tmp_dir, 'input_folder_path'))
+        # Ingest the copied data first, so the timed run finds nothing new
+        subprocess.run(
+            [sys.executable, '-c', STAGE_SCRIPT, config_path, json.dumps(
+                [['ingestion:merge_multiple_dataframe', [False]]])],
+            capture_output=True, text=True, check=True, cwd=PROJECT_DIR)
+
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', STAGE_SCRIPT, config_path,
+             json.dumps([['fullprocess:main', []]])],
+            capture_output=True, text=True, check=True, cwd=PROJECT_DIR)
+        run_seconds = time.perf_counter() - start
+
+    result = {'fullprocess_import_ms': import_us['fullprocess'] / 1000,
+              'heavy_modules_imported': sorted(
+                  {'pandas', 'sklearn', 'matplotlib', 'requests'}
+                  & set(import_us)),
+              'no_new_data_run_seconds': run_seconds,
+              'budget_seconds': budget_seconds,
+              'passed': run_seconds < budget_seconds}
+    print(result)
+    return [result]
+
+
+def bench_manifest(file_count=20000):
+    """
+    Time new-data detection over a folder with many source files: a first
+    scan hashing every file, a scan with nothing changed, and a scan after
+    one file was appended to in place.
+
+    Args:
+    - file_count: Optional; The number of source files in the folder.
+
+    Returns:
+    - A list of dictionaries with the duration of each scan.
+    """
+    from manifest import scan_folder
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rows = generate_frame(10).to_csv(index=False)
+        for i in range(file_count):
+            with open(os.path.join(tmp_dir, f'drop{i}.csv'), 'w',
+                      encoding='utf-8') as drop_file:
+                drop_file.write(rows)
+
+        manifest = {}
+        for scan_name in ('initial', 'unchanged', 'one_changed'):
+            if scan_name == 'one_changed':
+                with open(os.path.join(tmp_dir, 'drop0.csv'), 'a',
+                          encoding='utf-8') as drop_file:
+                    drop_file.write(rows.splitlines()[1] + '\n')
+            start = time.perf_counter()
+            scan = scan_folder(tmp_dir, manifest)
+            result = {'files': file_count, 'scan': scan_name,
+                      'seconds': time.perf_counter() - start,
+                      'new': len(scan.new), 'changed': len(scan.changed)}
+            manifest = scan.manifest
+            results.append(result)
+            print(result)
+    return results
+
+
+def bench_streaming_ingestion(size_gb=2.0, chunksize=100000,
+                              max_rss_mb=1024):
+    """
+    Check that streaming ingestion of a multi-GB input keeps peak RSS
+    bounded. The input repeats a pool of one million unique rows, so the
+    dedup stage has real work to do. Exits with a non-zero status from the
+    command line if the peak RSS exceeds max_rss_mb.
+
+    Args:
+    - size_gb: Optional; The total size of the source csv files in GB.
+    - chunksize: Optional; The number of rows read at a time.
+    - max_rss_mb: Optional; The peak RSS allowed for the ingestion process.
+
+    Returns:
+    - A list with one dictionary holding the measurements and whether the
+    run passed.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(
+            tmp_dir, ingestion_chunksize=chunksize, storage_format='csv',
+            trace_memory=False)
+        pool = generate_frame(1_000_000).to_csv(index=False)
+        header, rows = pool.split('\n', 1)
+        input_bytes = 0
+        file_index = 0
+        while input_bytes < size_gb * 1024 ** 3:
+            file_path = os.path.join(tmp_dir, 'input_folder_path',
+                                     f'drop{file_index}.csv')
+            with open(file_path, 'w', encoding='utf-8') as drop_file:
+                drop_file.write(header + '\n')
+                for _ in range(10):
+                    drop_file.write(rows)
+            input_bytes += os.path.getsize(file_path)
+            file_index += 1
+        del pool, rows
+
+        output = subprocess.run(
+            [sys.executable, '-c', INGEST_SCRIPT, config_path],
+            capture_output=True, text=True, check=True,
+            cwd=PROJECT_DIR).stdout
+        measurements = json.loads(output.strip().splitlines()[-1])
+        output_bytes = os.path.getsize(
+            os.path.join(tmp_dir, 'output_folder_path', 'finaldata.csv'))
+    result = {'input_gb': input_bytes / 1024 ** 3, 'files': file_index,
+              'output_mb': output_bytes / 1024 ** 2,
+              'chunksize': chunksize, **measurements,
+              'max_rss_mb': max_rss_mb,
+              'passed': measurements['peak_rss_mb'] < max_rss_mb}
+    print(result)
+    return [result]
+
+
+def bench_parallel_ingestion(worker_counts=(1, 2, 4, 8), file_count=64,
+                             rows_per_file=100000):
+    """
+    Time full ingestion of many source files at increasing worker counts,
+    checking that finaldata.csv and ingestedfiles.txt come out byte-identical
+    to the serial run.
+
+    Args:
+    - worker_counts: Optional; The 'ingestion_workers' values to time.
+    - file_count: Optional; The number of source files.
+    - rows_per_file: Optional; The number of rows per source file.
+
+    Returns:
+    - A list of dictionaries with the duration and speedup for each worker
+    count, and whether its output matched the serial run.
+    """
+    from manifest import file_hash
+    results = []
+    serial_hashes = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, 'source')
+        os.makedirs(source_dir)
+        for i in range(file_count):
+            generate_frame(rows_per_file, seed=i).to_csv(
+                os.path.join(source_dir, f'drop{i:04d}.csv'), index=False)
+
+        for workers in worker_counts:
+            run_dir = os.path.join(tmp_dir, f'workers{workers}')
+            config_path = temporary_config(
+                run_dir, input_folder_path=source_dir, storage_format='csv',
+                ingestion_workers=workers, ingestion_parallel_min_bytes=0,
+                trace_memory=False)
+            output = subprocess.run(
+                [sys.executable, '-c', INGEST_SCRIPT, config_path],
+                capture_output=True, text=True, check=True,
+                cwd=PROJECT_DIR).stdout
+            measurements = json.loads(output.strip().splitlines()[-1])
+            output_hashes = [file_hash(os.path.join(
+                run_dir, 'output_folder_path', name))
+                for name in ('finaldata.csv', 'ingestedfiles.txt')]
+            serial_hashes = serial_hashes or output_hashes
+            result = {'workers': workers, 'files': file_count,
+                      'rows': file_count * rows_per_file, **measurements,
+                      'speedup': (results[0]['seconds'] / measurements[
+                          'seconds'] if results else 1.0),
+                      'passed': output_hashes == serial_hashes}
+            results.append(result)
+            print(result)
+    return results
+
+
+def bench_training(history_sizes=(10_000, 100_000, 1_000_000),
+                   new_rows=10_000, max_f1_loss=0.01):
+    """
+    Compare retraining time and F1 score of the incremental update of a
+    model with a full refit, at increasing history sizes.
+
+    Args:
+    - history_sizes: Optional; The numbers of rows the model was trained on.
+    - new_rows: Optional; The number of newly ingested rows.
+    - max_f1_loss: Optional; The largest F1 drop allowed for the
+    incremental update.
+
+    Returns:
+    - A list of dictionaries with the duration and F1 score of both modes
+    for each history size, and whether the incremental F1 is within
+    max_f1_loss of the full refit.
+    """
+    from sklearn.metrics import f1_score
+    import training
+    from datastore import FEATURE_COLUMNS, LABEL_COLUMN
+    holdout = generate_frame(100_000, seed=1)
+    results = []
+    for history_size in history_sizes:
+        history = generate_frame(history_size, seed=2)
+        new_data = generate_frame(new_rows, seed=3)
+        model = training.new_model().fit(history[FEATURE_COLUMNS],
+                                         history[LABEL_COLUMN])
+        weights = np.append(model.coef_.ravel(), model.intercept_)
+        state = training.training_state(
+            weights, np.eye(len(weights)) + training.loss_hessian(
+                weights, training.augmented_features(
+                    history[FEATURE_COLUMNS])),
+            model.classes_, {}, history_size, 0)
+
+        start = time.perf_counter()
+        full_model = training.new_model().fit(
+            pd.concat([history, new_data])[FEATURE_COLUMNS],
+            pd.concat([history, new_data])[LABEL_COLUMN])
+        full_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        weights, _, _ = training.incremental_update(
+            state, new_data[FEATURE_COLUMNS], new_data[LABEL_COLUMN])
+        incremental_model = training.model_from_weights(
+            weights, state['classes'], 0)
+        incremental_seconds = time.perf_counter() - start
+
+        full_f1, incremental_f1 = [
+            f1_score(holdout[LABEL_COLUMN],
+                     fitted.predict(holdout[FEATURE_COLUMNS]))
+            for fitted in (full_model, incremental_model)]
+        result = {'history_rows': history_size, 'new_rows': new_rows,
+                  'full_seconds': full_seconds,
+                  'incremental_seconds': incremental_seconds,
+                  'full_f1': full_f1, 'incremental_f1': incremental_f1,
+                  'passed': incremental_f1 >= full_f1 - max_f1_loss}
+        results.append(result)
+        print(result)
+    return results
+
+
+def free_port():
+    """
+    Get a free TCP port on the loopback interface.
+    """
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_deployment(deployments=20, clients=4, rollback_every=5):
+    """
+    Hammer the /prediction endpoint from several clients while models are
+    repeatedly deployed and rolled back, checking that no request fails.
+
+    Args:
+    - deployments: Optional; The number of deployments.
+    - clients: Optional; The number of concurrent clients.
+    - rollback_every: Optional; Roll back after this many deployments.
+
+    Returns:
+    - A list with one dictionary holding the request and failure counts and
+    whether no request failed.
+    """
+    import shutil
+    import threading
+    import requests
+    import deployment
+    model_dirs = [os.path.join(PROJECT_DIR, name)
+                  for name in ('models', 'practicemodels')]
+    test_data_path = config.path('test_data_path', 'testdata.csv')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(tmp_dir, trace_memory=False)
+        project_config_path = config.config_path
+        config.config_path = config_path
+        config.reload()
+        try:
+            model_path = config.path('output_model_path')
+            for name in ('trainedmodel.pkl', 'trainedmodel.json',
+                         'latestscore.txt'):
+                shutil.copy(os.path.join(model_dirs[0], name), model_path)
+            shutil.copy(os.path.join(PROJECT_DIR, 'ingesteddata',
+                                     'ingestedfiles.txt'),
+                        config.path('output_folder_path'))
+            deployment.store_model_into_pickle()
+
+            port = free_port()
+            url = f'http://127.0.0.1:{port}/prediction'
+            server = subprocess.Popen(
+                [sys.executable, '-c', SERVE_SCRIPT, config_path, str(port)],
+                cwd=PROJECT_DIR, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            for _ in range(100):
+                try:
+                    requests.post(url, json={'dataset_path': test_data_path},
+                                  timeout=1)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+
+            counts = {'requests': 0, 'failures': 0}
+            counts_lock = threading.Lock()
+            stop = threading.Event()
+
+            def client():
+                with requests.Session() as session:
+                    while not stop.is_set():
+                        try:
+                            response = session.post(
+                                url, json={'dataset_path': test_data_path},
+                                timeout=10)
+                            failed = response.status_code != 200 or \
+                                not isinstance(response.json(), list)
+                        except (requests.RequestException, ValueError):
+                            failed = True
+                        with counts_lock:
+                            counts['requests'] += 1
+                            counts['failures'] += failed
+
+            threads = [threading.Thread(target=client)
+                       for _ in range(clients)]
+            for thread in threads:
+                thread.start()
+            start = time.perf_counter()
+            for i in range(1, deployments + 1):
+                for name in ('trainedmodel.pkl', 'trainedmodel.json'):
+                    shutil.copy(os.path.join(model_dirs[i % 2], name),
+                                model_path)
+                deployment.store_model_into_pickle()
+                if i % rollback_every == 0:
+                    deployment.rollback()
+                time.sleep(0.05)
+            seconds = time.perf_counter() - start
+            stop.set()
+            for thread in threads:
+                thread.join()
+            server.terminate()
+            server.wait()
+        finally:
+            config.config_path = project_config_path
+            config.reload()
+
+    result = {'deployments': deployments, 'clients': clients,
+              'seconds': seconds, **counts,
+              'passed': counts['failures'] == 0 and counts['requests'] > 0}
+    print(result)
+    return [result]
+
+
+def bench_scheduler(drops=5, rows_per_drop=500):
+    """
+    Measure the latency from a file drop to the deployed model with the
+    scheduler daemon running the pipeline. Each dropped file is labelled
+    against the deployed model's predictions, so that it triggers drift,
+    re-training and deployment, and its activity is scaled up so that the
+    statistical drift tests fire too. The app is served on a free port,
+    set as 'api_url', for the API calls of the pipeline.
+
+    Args:
+    - drops: Optional; The number of files dropped one after another.
+    - rows_per_drop: Optional; The number of rows per dropped file.
+
+    Returns:
+    - A list of dictionaries with the latency of each drop and whether it
+    ended with a deployment.
+    """
+    import shutil
+    import requests
+    import deployment
+    import model_registry
+    from compact_model import feature_array
+    from scheduler import Scheduler, warm_up
+    from datastore import FEATURE_COLUMNS
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        port = free_port()
+        api_url = f'http://127.0.0.1:{port}'
+        config_path = temporary_config(
+            tmp_dir, trace_memory=False, promotion_margin=-1.0,
+            api_url=api_url)
+        project_config_path = config.config_path
+        config.config_path = config_path
+        config.reload()
+        server = None
+        scheduler = None
+        try:
+            for folder, names in (
+                    ('sourcedata', os.listdir(os.path.join(PROJECT_DIR,
+                                                           'sourcedata'))),
+                    ('testdata', ['testdata.csv']),
+                    ('models', ['trainedmodel.pkl', 'trainedmodel.json',
+                                'latestscore.txt']),
+                    ('ingesteddata', ['ingestedfiles.txt'])):
+                key = {'sourcedata': 'input_folder_path',
+                       'testdata': 'test_data_path',
+                       'models': 'output_model_path',
+                       'ingesteddata': 'output_folder_path'}[folder]
+                for name in names:
+                    shutil.copy(os.path.join(PROJECT_DIR, folder, name),
+                                config.path(key))
+            deployment.store_model_into_pickle()
+            server = subprocess.Popen(
+                [sys.executable, '-c', SERVE_SCRIPT, config_path, str(port)],
+                cwd=PROJECT_DIR, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            for _ in range(100):
+                try:
+                    requests.get(f'{api_url}/modelcache', timeout=1)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+
+            warm_up()
+            scheduler = Scheduler(debounce_seconds=0.5, poll_seconds=0.2)
+            scheduler.start()
+            while not scheduler.run_count:
+                time.sleep(0.1)
+
+            for i in range(drops):
+                data = generate_frame(rows_per_drop, seed=100 + i)
+                data['lastmonth_activity'] *= 2 + i
+                model = model_registry.get_inference_model()
+                data['exited'] = 1 - model.predict(
+                    feature_array(data[FEATURE_COLUMNS]))
+                runs = scheduler.run_count
+                data.to_csv(os.path.join(config.path('input_folder_path'),
+                                         f'drop{i:03d}.csv'), index=False)
+                while scheduler.run_count == runs:
+                    time.sleep(0.05)
+                run = scheduler.runs[-1]
+                result = {'drop': i, 'rows': rows_per_drop,
+                          'latency_seconds': run['seconds'],
+                          'debounce_queue_seconds': run['queue_seconds'],
+                          'run_seconds': run['run_seconds'],
+                          'deployed': run['deployed'],
+                          'passed': run['error'] is None}
+                results.append(result)
+                print(result)
+        finally:
+            if scheduler is not None:
+                scheduler.stop()
+            if server is not None:
+                server.terminate()
+                server.wait()
+            config.config_path = project_config_path
+            config.reload()
+    return results
+
+
+def load_test(url, concurrency, seconds, payload=None):
+    """
+    Send requests to an endpoint from concurrent clients for a fixed time.
+
+    Args:
+    - url: The endpoint URL.
+    - concurrency: The number of concurrent clients.
+    - seconds: How long to send requests for.
+    - payload: Optional; A JSON body to POST. The endpoint is fetched with
+    GET if it is not given.
+
+    Returns:
+    - A dictionary with the request and error counts, the throughput and
+    the latency percentiles in milliseconds.
+    """
+    import threading
+    import requests
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        with requests.Session() as session:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    if payload is None:
+                        response = session.get(url, timeout=30)
+                    else:
+                        response = session.post(url, json=payload,
+                                                timeout=30)
+                    failed = response.status_code != 200
+                except requests.RequestException:
+                    failed = True
+                latency = time.perf_counter() - start
+                with lock:
+                    latencies.append(latency)
+                    errors[0] += failed
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    percentiles = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'concurrency': concurrency, 'requests': len(latencies),
+            'errors': errors[0],
+            'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': percentiles[0], 'p95_ms': percentiles[1],
+            'p99_ms': percentiles[2], 'max_ms': max(latencies) * 1000}
+
+
+def worker_memory(pid):
+    """
+    Get the memory of the worker processes of a server, split into the
+    pages shared with the other processes and the private ones.
+
+    Args:
+    - pid: The process id of the server.
+
+    Returns:
+    - A list of dictionaries with the RSS, shared and private MB of each
+    worker, or of the server itself if it has no workers.
+    """
+    with open(f'/proc/{pid}/task/{pid}/children', 'r',
+              encoding='utf-8') as children_file:
+        pids = [int(child) for child in children_file.read().split()]
+    memory = []
+    for worker_pid in pids or [pid]:
+        fields = {}
+        with open(f'/proc/{worker_pid}/smaps_rollup', 'r',
+                  encoding='utf-8') as smaps_file:
+            for line in smaps_file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+        memory.append({
+            'rss_mb': fields['Rss'],
+            'shared_mb': fields['Shared_Clean'] + fields['Shared_Dirty'],
+            'private_mb': fields['Private_Clean'] + fields['Private_Dirty']})
+    return memory
+
+
+def bench_serving(concurrency=(1, 4, 16, 64), seconds=3.0):
+    """
+    Load test the /prediction and /summarystats endpoints at increasing
+    concurrency, served by the Flask development server and by serve.py
+    with 'serve_workers' pre-forked workers of 'serve_threads' threads.
+
+    Args:
+    - concurrency: Optional; The numbers of concurrent clients.
+    - seconds: Optional; How long to load each endpoint at each level.
+
+    Returns:
+    - A list of dictionaries with the throughput, tail latency and errors
+    of each server, endpoint and concurrency, and the worker memory.
+    """
+    import shutil
+    import requests
+    from datastore import write_dataset
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(tmp_dir, trace_memory=False)
+        project_config_path = config.config_path
+        config.config_path = config_path
+        config.reload()
+        try:
+            for name in ('trainedmodel.pkl', 'trainedmodel.json'):
+                shutil.copy(os.path.join(PROJECT_DIR, 'models', name),
+                            config.path('prod_deployment_path'))
+            write_dataset(generate_frame(100_000),
+                          config.path('output_folder_path', 'finaldata.csv'))
+            test_data_path = config.path('test_data_path', 'testdata.csv')
+            generate_frame(1000, seed=1).to_csv(test_data_path, index=False)
+        finally:
+            config.config_path = project_config_path
+            config.reload()
+
+        results = []
+        for server_name, script in (('flask', SERVE_SCRIPT),
+                                    ('prefork', PREFORK_SCRIPT)):
+            port = free_port()
+            base_url = f'http://127.0.0.1:{port}'
+            server = subprocess.Popen(
+                [sys.executable, '-c', script, config_path, str(port)],
+                cwd=PROJECT_DIR, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(200):
+                    try:
+                        requests.get(f'{base_url}/summarystats', timeout=1)
+                        break
+                    except requests.ConnectionError:
+                        time.sleep(0.1)
+                for endpoint, payload in (
+                        ('prediction', {'dataset_path': test_data_path}),
+                        ('summarystats', None)):
+                    for level in concurrency:
+                        result = {'server': server_name,
+                                  'endpoint': endpoint,
+                                  **load_test(f'{base_url}/{endpoint}',
+                                              level, seconds, payload)}
+                        result['passed'] = result['errors'] == 0
+                        results.append(result)
+                        print(result)
+                memory = {'server': server_name,
+                          'workers': worker_memory(server.pid)}
+                results.append(memory)
+                print(memory)
+            finally:
+                server.terminate()
+                server.wait()
+    return results
+
+
+def current_rss_mb():
+    """
+    Get the current resident set size of this process in MB.
+    """
+    with open('/proc/self/statm', 'r', encoding='utf-8') as statm_file:
+        pages = int(statm_file.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+
+
+def bench_reporting(reports=1000, legacy_reports=100, max_growth_mb=5.0):
+    """
+    Render consecutive reports in one process, with the lightweight formats
+    and with the matplotlib png, and compare them with the original
+    pyplot and seaborn plot, which never closed its figures. Memory is
+    measured after a warm-up of 10 reports.
+
+    Args:
+    - reports: Optional; The number of reports per format.
+    - legacy_reports: Optional; The number of reports with the original
+    plot.
+    - max_growth_mb: Optional; The RSS growth allowed over the reports.
+
+    Returns:
+    - A list of dictionaries with the milliseconds per report and the RSS
+    before and after the reports of each format.
+    """
+    import shutil
+    import contextlib
+    import reporting
+    import scoring
+    from evaluation import get_evaluation
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(tmp_dir, trace_memory=False)
+        project_config_path = config.config_path
+        config.config_path = config_path
+        config.reload()
+        try:
+            for name in ('trainedmodel.pkl', 'trainedmodel.json'):
+                shutil.copy(os.path.join(PROJECT_DIR, 'models', name),
+                            config.path('prod_deployment_path'))
+            generate_frame(1000, seed=1).to_csv(
+                config.path('test_data_path', 'testdata.csv'), index=False)
+            scoring.write_score_history([
+                {'role': role, 'f1': {'all': 0.5 + 0.4 * np.sin(i + k)}}
+                for i in range(50) for k, role in enumerate(
+                    ('challenger', 'champion'))])
+
+            def legacy_report():
+                # The original report, kept for comparison
+                # pylint: disable=import-outside-toplevel
+                import matplotlib
+                matplotlib.use('Agg')
+                import matplotlib.pyplot as plt
+                import seaborn as sns
+                plt.figure(figsize=(10, 7))
+                sns.heatmap(get_evaluation()['confusion_matrix'], annot=True,
+                            fmt="d")
+                plt.title('Confusion Matrix')
+                plt.savefig(os.path.join(tmp_dir, 'legacy.png'))
+
+            results = []
+            for name, render, count in (
+                    ('svg+html+json', lambda: reporting.score_model(
+                        ['svg', 'html', 'json']), reports),
+                    ('png', lambda: reporting.score_model(['png']), reports),
+                    ('legacy png', legacy_report, legacy_reports)):
+                with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    for _ in range(10):
+                        render()
+                    rss_start = current_rss_mb()
+                    start = time.perf_counter()
+                    for _ in range(count):
+                        render()
+                    seconds = time.perf_counter() - start
+                    rss_end = current_rss_mb()
+                result = {'formats': name, 'reports': count,
+                          'ms_per_report': seconds / count * 1000,
+                          'rss_start_mb': rss_start, 'rss_end_mb': rss_end,
+                          'rss_growth_mb': rss_end - rss_start}
+                if name != 'legacy png':
+                    result['passed'] = rss_end - rss_start <= max_growth_mb
+                results.append(result)
+                print(result)
+        finally:
+            config.config_path = project_config_path
+            config.reload()
+    return results
+
+
+def compare_results(previous, current, tolerance):
+    """
+    Find the stages of an end-to-end run that got slower or used more
+    memory than in a previous run of the same size.
+
+    Args:
+    - previous: The results of the previous run.
+    - current: The results of the current run.
+    - tolerance: The relative increase allowed, e.g. 0.5 for 50%.
+
+    Returns:
+    - A list of dictionaries describing each regression.
+    """
+    baseline = {(result['rows'], result['stage']): result
+                for result in previous.get('results', [])}
+    regressions = []
+    for result in current:
+        before = baseline.get((result['rows'], result.get('stage')))
+        if before is None:
+            continue
+        for metric, minimum in (('seconds', 0.5), ('peak_rss_mb', 50)):
+            old, new = before.get(metric), result.get(metric)
+            # Small absolute changes are noise, whatever their ratio
+            if old and new and new > old * (1 + tolerance) and \
+                    new - old > minimum:
+                regressions.append({'rows': result['rows'],
+                                    'stage': result['stage'],
+                                    'metric': metric, 'previous': old,
+                                    'current': new})
+    return regressions
+
+
+def bench_end_to_end(row_counts=(10_000, 1_000_000, 10_000_000),
+                     rows_per_file=1_000_000, duplicate_rate=0.01,
+                     serve_seconds=3.0, tolerance=0.5):
+    """
+    Run every pipeline stage on synthetic data of increasing size, each in
+    a fresh interpreter to time it and measure its peak RSS, then load test
+    the pre-forked server. The results are written to a timestamped JSON
+    file in models/benchmarkresults and compared with the previous file,
+    failing on stages that got slower or bigger than the tolerance.
+
+    Args:
+    - row_counts: Optional; The numbers of source rows.
+    - rows_per_file: Optional; The number of rows of each source file.
+    - duplicate_rate: Optional; The fraction of duplicate source rows.
+    - serve_seconds: Optional; How long to load each endpoint.
+    - tolerance: Optional; The relative slowdown or memory growth allowed
+    against the previous results.
+
+    Returns:
+    - A list of dictionaries with the seconds and peak RSS of each stage at
+    each size, the serving throughput and latency, and the regressions.
+    """
+    import glob
+    import platform
+    import requests
+    results = []
+    for rows in row_counts:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_path = temporary_config(
+                tmp_dir, trace_memory=False, incremental_ingestion=False,
+                incremental_training=False, model_selection=False)
+            folders = {key: os.path.join(tmp_dir, key) for key in (
+                'input_folder_path', 'output_folder_path', 'test_data_path')}
+            start = time.perf_counter()
+            write_files(folders['input_folder_path'], rows,
+                        max(1, -(-rows // rows_per_file)),
+                        duplicate_rate=duplicate_rate)
+            write_files(folders['test_data_path'], 10_000, seed=1000,
+                        prefix='testdata')
+            os.replace(
+                os.path.join(folders['test_data_path'], 'testdata0000.csv'),
+                os.path.join(folders['test_data_path'], 'testdata.csv'))
+            result = {'rows': rows, 'stage': 'generate',
+                      'seconds': time.perf_counter() - start}
+            results.append(result)
+            print(result)
+
+            final_data = os.path.join(folders['output_folder_path'],
+                                      'finaldata.csv')
+            stages = {
+                'ingest': [['ingestion:merge_multiple_dataframe', [False]]],
+                'train': [['training:train_model', [False]]],
+                'score': [['scoring:evaluate_challenger', []]],
+                'deploy': [['deployment:store_model_into_pickle', []]],
+                'diagnose': [['diagnostics:model_predictions', [final_data]],
+                             ['diagnostics:dataframe_summary', []],
+                             ['diagnostics:missing_data_check', []]],
+                'report': [['reporting:score_model', []]]
+            }
+            for stage, calls in stages.items():
+                process = subprocess.run(
+                    [sys.executable, '-c', STAGE_SCRIPT, config_path,
+                     json.dumps(calls)],
+                    cwd=PROJECT_DIR, capture_output=True, text=True,
+                    check=False)
+                result = {'rows': rows, 'stage': stage,
+                          'passed': process.returncode == 0}
+                if process.returncode == 0:
+                    result.update(json.loads(
+                        process.stdout.strip().splitlines()[-1]))
+                else:
+                    result['error'] = process.stderr.strip().splitlines()[-1]
+                results.append(result)
+                print(result)
+                if not result['passed']:
+                    break
+            else:
+                port = free_port()
+                base_url = f'http://127.0.0.1:{port}'
+                server = subprocess.Popen(
+                    [sys.executable, '-c', PREFORK_SCRIPT, config_path,
+                     str(port)],
+                    cwd=PROJECT_DIR, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+                try:
+                    for _ in range(600):
+                        try:
+                            requests.get(f'{base_url}/summarystats',
+                                         timeout=1)
+                            break
+                        except requests.ConnectionError:
+                            time.sleep(0.1)
+                    test_data_path = os.path.join(folders['test_data_path'],
+                                                  'testdata.csv')
+                    for endpoint, payload in (
+                            ('prediction', {'dataset_path': test_data_path}),
+                            ('summarystats', None)):
+                        result = {'rows': rows, 'stage': f'serve {endpoint}',
+                                  **load_test(f'{base_url}/{endpoint}', 8,
+                                              serve_seconds, payload)}
+                        result['peak_rss_mb'] = sum(
+                            worker['rss_mb']
+                            for worker in worker_memory(server.pid))
+                        result['passed'] = result['errors'] == 0
+                        results.append(result)
+                        print(result)
+                finally:
+                    server.terminate()
+                    server.wait()
+
+    results_folder = config.path('output_model_path', 'benchmarkresults')
+    previous_files = sorted(glob.glob(os.path.join(results_folder,
+                                                   'endtoend-*.json')))
+    regressions = []
+    if previous_files:
+        with open(previous_files[-1], 'r', encoding='utf-8') as results_file:
+            regressions = compare_results(json.load(results_file), results,
+                                          tolerance)
+        for regression in regressions:
+            regression['passed'] = False
+            print(regression)
+
+    os.makedirs(results_folder, exist_ok=True)
+    results_path = os.path.join(
+        results_folder, time.strftime('endtoend-%Y%m%d-%H%M%S.json'))
+    with open(results_path, 'w', encoding='utf-8') as results_file:
+        json.dump({
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': results,
+            'regressions': regressions
+        }, results_file, indent=4)
+    print(f"Results written to {results_path}")
+    return results + regressions
+
+
+def bench_compact_dataset(rows=10_000_000):
+    """
+    Compare the peak RSS of loading a synthetic dataset and splitting it
+    into training and test sets: with the original dataframe of object
+    strings and 64-bit columns read from csv, with the compact dataframe
+    read from parquet, and as a CompactDataset, with and without the
+    dictionary-encoded corporation column.
+
+    Args:
+    - rows: Optional; The number of rows of the dataset.
+
+    Returns:
+    - A list of dictionaries with the seconds and peak RSS of each way, and
+    the peak RSS reduction of the CompactDataset.
+    """
+    from datastore import DatasetWriter
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = temporary_config(tmp_dir, storage_format='parquet')
+        data_folder = os.path.join(tmp_dir, 'output_folder_path')
+        csv_path = write_files(data_folder, rows, prefix='finaldata')[0]
+        os.replace(csv_path, os.path.join(data_folder, 'finaldata.csv'))
+        csv_path = os.path.join(data_folder, 'finaldata.csv')
+        writer = DatasetWriter(csv_path, file_format='parquet')
+        for chunk in pd.read_csv(csv_path, chunksize=1_000_000):
+            writer.write(chunk)
+        writer.close()
+
+        results = []
+        for way in ('object dataframe', 'compact dataframe',
+                    'compact dataset', 'compact dataset with corporation'):
+            process = subprocess.run(
+                [sys.executable, '-c', SPLIT_SCRIPT, config_path, csv_path,
+                 way], cwd=PROJECT_DIR, capture_output=True, text=True,
+                check=True)
+            result = {'rows': rows, 'way': way,
+                      **json.loads(process.stdout.strip().splitlines()[-1])}
+            results.append(result)
+            print(result)
+    peaks = {result['way']: result['peak_rss_mb'] for result in results}
+    result = {'rows': rows,
+              'reduction_vs_object_dataframe':
+              1 - peaks['compact dataset'] / peaks['object dataframe'],
+              'reduction_vs_compact_dataframe':
+              1 - peaks['compact dataset'] / peaks['compact dataframe'],
+              'passed': peaks['compact dataset'] < peaks['compact dataframe']}
+    results.append(result)
+    print(result)
+    return results
+
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'batch_prediction': bench_batch_prediction,
+    'compact_dataset': bench_compact_dataset,
+    'deployment': bench_deployment,
+    'end_to_end': bench_end_to_end,
+    'inference': bench_inference,
+    'manifest': bench_manifest,
+    'parallel_ingestion': bench_parallel_ingestion,
+    'reporting': bench_reporting,
+    'scheduler': bench_scheduler,
+    'serving': bench_serving,
+    'startup': bench_startup,
+    'streaming_ingestion': bench_streaming_ingestion,
+    'training': bench_training
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python benchmarks.py [{'|'.join(BENCHMARKS)}]")
+        sys.exit(1)
+    # Further arguments are passed on to the benchmark as JSON values,
+    # e.g. python benchmarks.py end_to_end "[10000, 1000000]"
+    benchmark_results = BENCHMARKS[sys.argv[1]](
+        *[json.loads(argument) for argument in sys.argv[2:]])
+    if any(result.get('passed') is False for result in benchmark_results):
+        sys.exit(1)
@@ -0,0 +1,141 @@
+"""
+This module contains a compact, pickle-free format for the linear model
+and a vectorized scorer for it.
+"""
+
+import os
+import sys
+import json
+import pickle
+import numpy as np
+from datastore import FEATURE_COLUMNS
+
+
+class CompactModel:
+    """
+    A binary linear classifier scored as X @ coef + intercept on
+    contiguous float32 arrays.
+    """
+
+    def __init__(self, coef, intercept, classes, features):
+        self.coef = np.ascontiguousarray(coef, dtype=np.float32)
+        self.intercept = np.float32(intercept)
+        self.classes = np.asarray(classes)
+        self.features = list(features)
+
+    def decision_function(self, features):
+        """
+        Compute the decision function for a feature array.
+
+        Args:
+        - features: An array of shape (rows, features) in feature order.
+
+        Returns:
+        - A float32 array of decision values.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        return features @ self.coef + self.intercept
+
+    def predict(self, features):
+        """
+        Predict the class of each row of a feature array.
+
+        Args:
+        - features: An array of shape (rows, features) in feature order.
+
+        Returns:
+        - An array of predicted classes.
+        """
+        return self.classes[
+            (self.decision_function(features) > 0).astype(np.intp)]
+
+    def predict_proba(self, features):
+        """
+        Predict the class probabilities of each row of a feature array.
+
+        Args:
+        - features: An array of shape (rows, features) in feature order.
+
+        Returns:
+        - A float32 array of shape (rows, 2) with the probabilities of the
+        negative and positive class.
+        """
+        # The logistic function written with tanh, which does not overflow
+        positive = 0.5 * (1 + np.tanh(0.5 * self.decision_function(features)))
+        return np.column_stack([1 - positive, positive])
+
+
+def feature_array(data):
+    """
+    Extract the model features of a dataframe as a contiguous float32 array.
+
+    Args:
+    - data: A dataframe holding the FEATURE_COLUMNS.
+
+    Returns:
+    - A float32 array of shape (rows, features).
+    """
+    features = np.empty((len(data), len(FEATURE_COLUMNS)), dtype=np.float32)
+    for i, column in enumerate(FEATURE_COLUMNS):
+        features[:, i] = data[column].to_numpy()
+    return features
+
+
+def export_compact_model(model, path):
+    """
+    Write the coefficients, intercept, classes and feature order of a fitted
+    binary linear model to a JSON file.
+
+    Args:
+    - model: A fitted binary linear classifier, e.g. LogisticRegression.
+    - path: Path of the JSON file to write.
+    """
+    features = getattr(model, 'feature_names_in_', FEATURE_COLUMNS)
+    compact = {
+        'features': [str(feature) for feature in features],
+        'coef': model.coef_.ravel().tolist(),
+        'intercept': float(np.ravel(model.intercept_)[0]),
+        'classes': model.classes_.tolist()
+    }
+    with open(path, 'w', encoding='utf-8') as model_file:
+        json.dump(compact, model_file, indent=4)
+
+
+def loads_compact_model(model_bytes):
+    """
+    Load a compact model from the contents of its JSON file.
+
+    Args:
+    - model_bytes: The contents of the JSON file.
+
+    Returns:
+    - A CompactModel.
+    """
+    compact = json.loads(model_bytes)
+    if compact['features'] != FEATURE_COLUMNS:
+        raise ValueError(
+            f"Unexpected feature order in compact model: "
+            f"{compact['features']}")
+    return CompactModel(compact['coef'], compact['intercept'],
+                        compact['classes'], compact['features'])
+
+
+def compact_model_path(model_path):
+    """
+    Get the path of the compact model stored next to a pickled model.
+
+    Args:
+    - model_path: Path of the pickled model, e.g. 'models/trainedmodel.pkl'.
+
+    Returns:
+    - The path of the compact JSON model.
+    """
+    return os.path.splitext(model_path)[0] + '.json'
+
+
+if __name__ == '__main__':
+    # Export the compact model next to each given pickled model
+    for pickle_path in sys.argv[1:]:
+        with open(pickle_path, 'rb') as pickle_file:
+            export_compact_model(pickle.load(pickle_file),
+                                 compact_model_path(pickle_path))
@@ -0,0 +1,84 @@
+"""
+This module provides the project configuration, read lazily from
+config.json on first use, with its paths resolved relative to the
+project directory rather than the working directory.
+"""
+
+import os
+import json
+import threading
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(PROJECT_DIR, 'config.json')
+
+
+class Config:
+    """
+    Read-only view of config.json that loads the file on first access.
+    """
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self._values = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    with open(self.config_path, 'r',
+                              encoding='utf-8') as config_file:
+                        self._values = json.load(config_file)
+        return self._values
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def get(self, key, default=None):
+        """
+        Get a setting, or a default if it is not set.
+
+        Args:
+        - key: The setting name.
+        - default: Optional; The value returned if the setting is missing.
+
+        Returns:
+        - The setting value.
+        """
+        return self._load().get(key, default)
+
+    def path(self, key, *parts):
+        """
+        Get an absolute path from a folder setting.
+
+        Args:
+        - key: The folder setting name, e.g. 'output_folder_path'.
+        - parts: Optional; Path components to join to the folder.
+
+        Returns:
+        - The absolute path.
+        """
+        return os.path.join(PROJECT_DIR, self[key], *parts)
+
+    def reload(self):
+        """
+        Discard the loaded settings so the next access re-reads the file.
+        """
+        with self._lock:
+            self._values = None
+
+
+config = Config(CONFIG_PATH)
+
+
+def project_path(*parts):
+    """
+    Get an absolute path inside the project directory.
+
+    Args:
+    - parts: Path components relative to the project directory.
+
+    Returns:
+    - The absolute path.
+    """
+    return os.path.join(PROJECT_DIR, *parts)
@@ -0,0 +1,127 @@
+"""
+This module generates synthetic source datasets with the same schema as
+the files in sourcedata, at any scale, to see how the pipeline behaves at
+production volumes.
+
+The label follows a logistic model of the features, so trained models have
+a meaningful F1 score. The generated files can hold duplicate rows, missing
+feature values and drifted feature distributions.
+
+Generate files with:
+    python datagen.py <folder> [--rows N] [--files N] [--duplicate-rate R]
+                               [--na-rate R] [--drift D] [--seed S]
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from datastore import DATASET_COLUMNS, FEATURE_COLUMNS, LABEL_COLUMN
+
+
+def generate_frame(rows, seed=0, duplicate_rate=0.0, na_rate=0.0,
+                   drift=0.0):
+    """
+    Generate a dataframe with the schema of the source datasets.
+
+    Args:
+    - rows: The number of rows to generate.
+    - seed: Optional; The random seed.
+    - duplicate_rate: Optional; The fraction of rows that repeat an earlier
+    row of the frame.
+    - na_rate: Optional; The fraction of feature values that are missing.
+    - drift: Optional; The relative shift of the feature distributions,
+    e.g. 0.5 makes the activity and employee counts 50% larger.
+
+    Returns:
+    - A dataframe of synthetic data.
+    """
+    rng = np.random.default_rng(seed)
+    # Random 4-letter corporation codes, built as bytes to stay fast at
+    # millions of rows
+    corporation = rng.integers(ord('a'), ord('z') + 1, size=(rows, 4),
+                               dtype=np.uint8).view('S4').ravel().astype(str)
+    scale = 1 + drift
+    features = {
+        'lastmonth_activity': rng.integers(0, 2000, rows) * scale,
+        'lastyear_activity': rng.integers(0, 20000, rows) * scale,
+        'number_of_employees': rng.integers(1, 1500, rows) * scale
+    }
+    logits = (-0.002 * features['lastmonth_activity']
+              + 0.0001 * features['lastyear_activity']
+              + 0.001 * features['number_of_employees'])
+    label = (rng.random(rows) < 1 / (1 + np.exp(-logits))).astype(np.int8)
+    data = pd.DataFrame({
+        'corporation': corporation,
+        **{column: np.round(values).astype(np.int64)
+           for column, values in features.items()},
+        LABEL_COLUMN: label
+    })[DATASET_COLUMNS]
+
+    # Mask the missing values before duplicating rows, so that duplicates
+    # stay identical to their original row
+    if na_rate:
+        for column in FEATURE_COLUMNS:
+            missing = rng.random(rows) < na_rate
+            data[column] = data[column].astype(np.float64).mask(missing)
+
+    duplicates = int(rows * duplicate_rate)
+    if duplicates and rows > 1:
+        targets = rng.choice(np.arange(1, rows), size=duplicates,
+                             replace=False)
+        order = np.arange(rows)
+        order[targets] = rng.integers(0, targets)
+        # Follow copies of copies back to an original row
+        while not np.array_equal(order[order], order):
+            order = order[order]
+        data = data.take(order).reset_index(drop=True)
+    return data
+
+
+def write_files(folder_path, rows, files=1, seed=0, prefix='synthetic',
+                **options):
+    """
+    Write synthetic csv files, generating one file at a time to bound
+    memory.
+
+    Args:
+    - folder_path: The folder to write the files to.
+    - rows: The total number of rows, split evenly across the files.
+    - files: Optional; The number of files.
+    - seed: Optional; The random seed of the first file.
+    - prefix: Optional; The file name prefix.
+    - options: Optional; duplicate_rate, na_rate and drift, passed on to
+    generate_frame.
+
+    Returns:
+    - The list of written file paths.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    paths = []
+    for index, file_rows in enumerate(np.diff(
+            np.linspace(0, rows, files + 1).astype(np.int64))):
+        path = os.path.join(folder_path, f'{prefix}{index:04d}.csv')
+        generate_frame(int(file_rows), seed=seed + index, **options).to_csv(
+            path, index=False)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic source datasets.')
+    parser.add_argument('folder', help='The folder to write the files to.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0)
+    parser.add_argument('--na-rate', type=float, default=0.0)
+    parser.add_argument('--drift', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prefix', default='synthetic')
+    arguments = parser.parse_args()
+    for written_path in write_files(
+            arguments.folder, arguments.rows, arguments.files,
+            seed=arguments.seed, prefix=arguments.prefix,
+            duplicate_rate=arguments.duplicate_rate,
+            na_rate=arguments.na_rate, drift=arguments.drift):
+        print(written_path)
@@ -0,0 +1,479 @@
+"""
+This module contains the shared loader and writer for the ingested and
+test datasets, supporting csv and columnar (parquet) storage.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from config import config
+
+FEATURE_COLUMNS = ['lastmonth_activity',
+                   'lastyear_activity',
+                   'number_of_employees']
+LABEL_COLUMN = 'exited'
+DATASET_COLUMNS = ['corporation'] + FEATURE_COLUMNS + [LABEL_COLUMN]
+COLUMN_DTYPES = {
+    'lastmonth_activity': 'int32',
+    'lastyear_activity': 'int32',
+    'number_of_employees': 'int32',
+    'exited': 'int8'
+}
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+# Corporation ids are read from csv as strings, so numeric-looking ids keep
+# their leading zeros and hash the same wherever they are read
+CSV_DTYPES = {'corporation': str}
+
+
+def storage_format():
+    """
+    Get the configured storage format.
+
+    Returns:
+    - 'csv' or 'parquet', from the 'storage_format' setting in config.json.
+    """
+    return config.get('storage_format', 'csv')
+
+
+def storage_path(csv_path, file_format=None):
+    """
+    Get the path a dataset is stored at for a given storage format.
+
+    Args:
+    - csv_path: The csv path of the dataset, e.g. 'ingesteddata/finaldata.csv'.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+
+    Returns:
+    - The path of the dataset file in the given format.
+    """
+    file_format = file_format or storage_format()
+    return os.path.splitext(csv_path)[0] + FILE_EXTENSIONS[file_format]
+
+
+def enforce_dtypes(df):
+    """
+    Downcast the known numeric columns to their compact dtypes. Columns
+    holding NA values are stored as float32 instead.
+
+    Args:
+    - df: The dataframe to convert.
+
+    Returns:
+    - A dataframe with the compact dtypes applied.
+    """
+    dtypes = {}
+    for column, dtype in COLUMN_DTYPES.items():
+        if column in df.columns:
+            dtypes[column] = 'float32' if df[column].isna().any() else dtype
+    return df.astype(dtypes)
+
+
+def other_format(file_format):
+    """
+    Get the storage format a dataset is not stored in.
+
+    Args:
+    - file_format: 'csv' or 'parquet'.
+
+    Returns:
+    - 'parquet' for 'csv', and 'csv' for 'parquet'.
+    """
+    return 'parquet' if file_format == 'csv' else 'csv'
+
+
+def remove_superseded(csv_path, file_format=None):
+    """
+    Remove the copy of a dataset stored in the other format, left over from
+    before the storage format was changed, so that it is never read instead
+    of the current one.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - file_format: Optional; The format the dataset is stored in. Defaults
+    to the 'storage_format' setting in config.json.
+    """
+    file_format = file_format or storage_format()
+    superseded_path = storage_path(csv_path, other_format(file_format))
+    if os.path.exists(storage_path(csv_path, file_format)) and \
+            os.path.exists(superseded_path):
+        os.remove(superseded_path)
+
+
+def dataset_file(csv_path, file_format=None):
+    """
+    Get the file a dataset is read from: the columnar file when it exists,
+    otherwise the csv file.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+
+    Returns:
+    - The path of the file holding the dataset.
+    """
+    file_format = file_format or storage_format()
+    if file_format == 'parquet':
+        parquet_path = storage_path(csv_path, 'parquet')
+        if os.path.exists(parquet_path):
+            return parquet_path
+    return csv_path
+
+
+def load_dataset(csv_path, columns=None, file_format=None):
+    """
+    Load a dataset, reading only the requested columns. The columnar file
+    is used when it exists, otherwise the csv file is read.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - columns: Optional; The columns to read. Defaults to all columns.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+
+    Returns:
+    - A dataframe with the compact dtypes applied.
+    """
+    path = dataset_file(csv_path, file_format)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    data = pd.read_csv(csv_path, usecols=columns, dtype=CSV_DTYPES)
+    if columns is not None:
+        data = data[columns]
+    return enforce_dtypes(data)
+
+
+def write_dataset(df, csv_path, file_format=None):
+    """
+    Write a dataset in the configured storage format.
+
+    Args:
+    - df: The dataframe to write.
+    - csv_path: The csv path of the dataset.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+
+    Returns:
+    - The path the dataset was written to.
+    """
+    path = storage_path(csv_path, file_format)
+    df = enforce_dtypes(df)
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def iter_dataset_chunks(csv_path, chunksize, file_format=None,
+                        columns=None):
+    """
+    Read a dataset in chunks of at most chunksize rows.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - chunksize: The maximum number of rows per chunk.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+    - columns: Optional; The columns to read. Defaults to all columns.
+
+    Yields:
+    - Dataframes with the compact dtypes applied.
+    """
+    file_format = file_format or storage_format()
+    parquet_path = storage_path(csv_path, 'parquet')
+    if file_format == 'parquet' and os.path.exists(parquet_path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(parquet_path).iter_batches(
+                chunksize, columns=columns):
+            yield enforce_dtypes(batch.to_pandas())
+        return
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, usecols=columns,
+                             dtype=CSV_DTYPES):
+        yield enforce_dtypes(chunk if columns is None else chunk[columns])
+
+
+def dataset_columns(csv_path, file_format=None):
+    """
+    Get the columns of a dataset without reading its rows.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+
+    Returns:
+    - The list of column names.
+    """
+    path = dataset_file(csv_path, file_format)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+# Compact in-memory representation of a dataset
+
+
+class CompactDataset:
+    """
+    A dataset held as one contiguous float32 block of the features in
+    FEATURE_COLUMNS order, an int8 label array, and optionally the
+    dictionary-encoded corporation column. Slices share the memory of the
+    dataset they are taken from.
+    """
+
+    def __init__(self, features, labels=None, corporation=None):
+        self.features = features
+        self.labels = labels
+        self.corporation = corporation
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, rows):
+        """
+        Get a slice of the rows as a view, or a copy of the rows selected by
+        an index or boolean array.
+
+        Args:
+        - rows: A slice, or an array of row indices or a boolean mask.
+
+        Returns:
+        - A CompactDataset of the rows.
+        """
+        return CompactDataset(
+            self.features[rows],
+            None if self.labels is None else self.labels[rows],
+            None if self.corporation is None else self.corporation[rows])
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes held by the arrays of the dataset.
+        """
+        nbytes = self.features.nbytes
+        if self.labels is not None:
+            nbytes += self.labels.nbytes
+        if self.corporation is not None:
+            nbytes += self.corporation.nbytes
+        return nbytes
+
+    def frame(self):
+        """
+        Get the features as a dataframe sharing their memory.
+
+        Returns:
+        - A float32 dataframe of the FEATURE_COLUMNS.
+        """
+        return pd.DataFrame(self.features, columns=FEATURE_COLUMNS,
+                            copy=False)
+
+    def split(self, test_size=0.2, random_state=0):
+        """
+        Split the rows into a train and a test set. The rows are reordered
+        once, so that both sets are views of one copy of the dataset. The
+        sets hold the same rows in the same order as train_test_split.
+
+        Args:
+        - test_size: Optional; The fraction of rows in the test set.
+        - random_state: Optional; The random seed of the shuffle.
+
+        Returns:
+        - A tuple of the train and test CompactDataset.
+        """
+        from sklearn.model_selection import ShuffleSplit
+        train_index, test_index = next(ShuffleSplit(
+            n_splits=1, test_size=test_size,
+            random_state=random_state).split(self.features))
+        shuffled = self[np.concatenate([train_index, test_index])]
+        return shuffled[:len(train_index)], shuffled[len(train_index):]
+
+
+def load_compact_dataset(csv_path, corporation=False, dropna=False,
+                         file_format=None, chunksize=1000000, labels=True):
+    """
+    Load a dataset as a CompactDataset, reading it in chunks so that only
+    the compact arrays and one chunk are held in memory. The label is
+    loaded if the dataset has one.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - corporation: Optional; If True, load the dictionary-encoded
+    corporation column, which is dropped otherwise.
+    - dropna: Optional; If True, drop the rows with a missing feature or
+    label.
+    - file_format: Optional; 'csv' or 'parquet'. Defaults to the
+    'storage_format' setting in config.json.
+    - chunksize: Optional; The number of rows read at a time.
+    - labels: Optional; If False, only load the features, e.g. to predict
+    on a dataset whose labels may be missing.
+
+    Returns:
+    - The CompactDataset.
+
+    Raises:
+    - ValueError: If labels are loaded, some are missing and dropna is
+    False.
+    """
+    if corporation:
+        import pyarrow as pa
+    has_labels = labels and \
+        LABEL_COLUMN in dataset_columns(csv_path, file_format)
+    values = FEATURE_COLUMNS + ([LABEL_COLUMN] if has_labels else [])
+    columns = (['corporation'] if corporation else []) + values
+    features, label_blocks, corporations = [], [], []
+    for chunk in iter_dataset_chunks(csv_path, chunksize, file_format,
+                                     columns):
+        if dropna:
+            chunk = chunk.dropna(subset=values)
+        elif has_labels and chunk[LABEL_COLUMN].isna().any():
+            raise ValueError(f"{csv_path} has missing labels, load it with "
+                             f"dropna=True")
+        block = np.empty((len(chunk), len(FEATURE_COLUMNS)),
+                         dtype=np.float32)
+        for i, column in enumerate(FEATURE_COLUMNS):
+            block[:, i] = chunk[column].to_numpy(dtype=np.float32,
+                                                 na_value=np.nan)
+        features.append(block)
+        if has_labels:
+            label_blocks.append(chunk[LABEL_COLUMN].to_numpy(dtype=np.int8))
+        if corporation:
+            corporations.append(pa.array(
+                chunk['corporation'], type=pa.string(),
+                from_pandas=True).dictionary_encode())
+
+    if not features:
+        features.append(np.empty((0, len(FEATURE_COLUMNS)),
+                                 dtype=np.float32))
+    return CompactDataset(
+        np.concatenate(features) if len(features) > 1 else features[0],
+        np.concatenate(label_blocks or [np.empty(0, dtype=np.int8)])
+        if has_labels else None,
+        # One dictionary for all the chunks, as a pandas Categorical
+        pa.chunked_array(corporations, pa.dictionary(pa.int32(), pa.string()))
+        .unify_dictionaries().to_pandas().array if corporation else None)
+
+
+class DatasetWriter:
+    """
+    Writes a dataset chunk by chunk in the configured storage format, so
+    only one chunk is held in memory at a time. The output goes to a
+    temporary file that replaces the dataset when the writer is closed.
+    When appending, the rows already stored are kept: a csv file is appended
+    to in place, and a parquet file is copied over batch by batch. Rows
+    stored in the other format before the format was changed are copied
+    over once, and the file holding them is removed on close. A writer
+    closed without any rows still replaces the dataset, with an empty one.
+    """
+
+    def __init__(self, csv_path, append=False, file_format=None,
+                 chunksize=100000):
+        file_format = file_format or storage_format()
+        self.path = storage_path(csv_path, file_format)
+        self.rows = 0
+        self._csv_path = csv_path
+        self._file_format = file_format
+        self._parquet = file_format == 'parquet'
+        self._parquet_writer = None
+        self._header = not (append and os.path.exists(self.path))
+        self._columns = None
+        self._output_path = self.path
+        if not self._parquet and not self._header:
+            self._columns = pd.read_csv(self.path, nrows=0).columns
+        if self._parquet or self._header:
+            self._output_path = self.path + '.tmp'
+            if os.path.exists(self._output_path):
+                os.remove(self._output_path)
+        if append and (self._parquet or self._header):
+            source_format = file_format if os.path.exists(self.path) \
+                else other_format(file_format)
+            if os.path.exists(storage_path(csv_path, source_format)):
+                for chunk in iter_dataset_chunks(csv_path, chunksize,
+                                                 source_format):
+                    self.write(chunk)
+
+    def write(self, df):
+        """
+        Write a chunk of rows.
+
+        Args:
+        - df: The dataframe to write.
+        """
+        df = enforce_dtypes(df)
+        if self._parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, schema=arrow_schema(df.columns),
+                                         preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self._output_path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            if self._columns is not None:
+                df = df[self._columns]
+            df.to_csv(self._output_path, mode='a', header=self._header,
+                      index=False)
+            self._header = False
+        self.rows += len(df)
+
+    def close(self):
+        """
+        Finish writing and move the output into place.
+
+        Returns:
+        - The path the dataset was written to.
+        """
+        if self._output_path != self.path and \
+                self._parquet_writer is None and \
+                not os.path.exists(self._output_path):
+            self.write(pd.DataFrame(columns=DATASET_COLUMNS))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._output_path != self.path and \
+                os.path.exists(self._output_path):
+            os.replace(self._output_path, self.path)
+        remove_superseded(self._csv_path, self._file_format)
+        return self.path
+
+
+def arrow_schema(columns):
+    """
+    Get the fixed arrow schema of a dataset, so that parquet chunks holding
+    NA values still share one schema.
+
+    Args:
+    - columns: The dataset columns.
+
+    Returns:
+    - A pyarrow schema with nullable compact integer columns.
+    """
+    import pyarrow as pa
+    arrow_types = {'int32': pa.int32(), 'int8': pa.int8()}
+    return pa.schema([
+        (column, arrow_types[COLUMN_DTYPES[column]]
+         if column in COLUMN_DTYPES else pa.string())
+        for column in columns])
+
+
+def dataset_exists(csv_path):
+    """
+    Check whether a dataset has been written in the configured storage
+    format or as a csv file.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+
+    Returns:
+    - True if the dataset exists.
+    """
+    return (os.path.exists(storage_path(csv_path))
+            or os.path.exists(csv_path))
+
+
+if __name__ == '__main__':
+    # Convert the test dataset to the configured storage format
+    test_data_path = config.path('test_data_path', 'testdata.csv')
+    print(write_dataset(pd.read_csv(test_data_path), test_data_path))
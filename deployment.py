@@ -1,46 +1,356 @@
 """
 This module contains functions for deploying the trained model
 and associated files.
+
+Every deployment is stored as a content-addressed version directory in
+production_deployment/versions. The 'current' symlink points at the
+deployed version, and each artifact in production_deployment is a hard
+link to its file in that version. Every switch is an atomic rename, so
+readers see either the old or the new file, never a partly written one.
+The artifacts stay regular files, so those tracked in git only change when
+a deployment changes their contents.
+
+Usage:
+    python deployment.py              Deploy the trained model
+    python deployment.py list         List the kept versions
+    python deployment.py rollback [version]
+                                      Switch back to a previous version
 """
 
 import os
+import sys
 import json
+import time
 import shutil
+import hashlib
+import tempfile
+import model_registry
+from compact_model import compact_model_path
+from drift import reference_path
+from manifest import file_hash
+from selection import selection_path
+from training import training_state_path
+from instrumentation import instrumented
+from config import config
+
+# Artifacts that every deployed version holds
+REQUIRED_ARTIFACTS = ('trainedmodel.pkl', 'latestscore.txt',
+                      'ingestedfiles.txt')
+
+
+# Functions for the deployment paths
+
+
+def versions_path():
+    """
+    Get the folder holding the deployed versions.
+    """
+    return config.path('prod_deployment_path', 'versions')
+
+
+def current_link_path():
+    """
+    Get the path of the symlink to the deployed version.
+    """
+    return config.path('prod_deployment_path', 'current')
+
+
+def history_path():
+    """
+    Get the path of the deployment history.
+    """
+    return config.path('prod_deployment_path', 'deployments.json')
+
+
+def artifact_paths():
+    """
+    Get the paths of the artifacts to deploy that exist: the trained model
+    and its compact model, drift reference profile, training state and
+    model selection results, the model score, and the ingested data record.
+
+    Returns:
+    - A list of file paths.
+    """
+    model_path = config.path('output_model_path', 'trainedmodel.pkl')
+    paths = [
+        model_path,
+        compact_model_path(model_path),
+        reference_path(),
+        training_state_path(),
+        selection_path(),
+        config.path('output_model_path', 'latestscore.txt'),
+        config.path('output_folder_path', 'ingestedfiles.txt')
+    ]
+    return [path for path in paths if os.path.basename(path)
+            in REQUIRED_ARTIFACTS or os.path.exists(path)]
 
 
-# Load config.json and correct path variable
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
+# Functions for the deployment history
+
+
+def read_history():
+    """
+    Read the deployment history.
+
+    Returns:
+    - A list of deployment records, oldest first.
+    """
+    if not os.path.exists(history_path()):
+        return []
+    with open(history_path(), 'r', encoding='utf-8') as history_file:
+        return json.load(history_file)
+
+
+def record_deployment(version, action):
+    """
+    Append a record to the deployment history.
+
+    Args:
+    - version: The deployed version.
+    - action: 'deploy', 'adopt' or 'rollback'.
+    """
+    history = read_history()
+    history.append({'version': version, 'action': action,
+                    'deployed_at': time.time()})
+    tmp_path = history_path() + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as history_file:
+        json.dump(history, history_file, indent=4)
+    os.replace(tmp_path, history_path())
+
+
+def current_version():
+    """
+    Get the deployed version.
+
+    Returns:
+    - The version, or None if no version has been deployed.
+    """
+    if not os.path.islink(current_link_path()):
+        return None
+    return os.path.basename(os.readlink(current_link_path()))
+
+
+def list_versions():
+    """
+    List the kept versions, most recently deployed first.
+
+    Returns:
+    - A list of versions.
+    """
+    versions = []
+    for record in reversed(read_history()):
+        if record['version'] not in versions and os.path.isdir(
+                os.path.join(versions_path(), record['version'])):
+            versions.append(record['version'])
+    return versions
+
+
+# Functions for versions
+
+
+def create_version(paths):
+    """
+    Copy artifacts into a version directory named after the hash of their
+    names and contents. The files are copied to a temporary directory that
+    is renamed into place, so a version directory is always complete.
+
+    Args:
+    - paths: The paths of the artifacts.
+
+    Returns:
+    - The version.
+    """
+    os.makedirs(versions_path(), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=versions_path())
+    try:
+        os.chmod(tmp_dir, 0o755)
+        digest = hashlib.sha256()
+        for path in sorted(paths, key=os.path.basename):
+            name = os.path.basename(path)
+            shutil.copy(path, os.path.join(tmp_dir, name))
+            digest.update(f"{name}\0"
+                          f"{file_hash(os.path.join(tmp_dir, name))}\n"
+                          .encode('utf-8'))
+        version = digest.hexdigest()[:16]
+        version_dir = os.path.join(versions_path(), version)
+        if os.path.isdir(version_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, version_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return version
+
+
+def replace_symlink(target, link_path):
+    """
+    Atomically point a symlink at a target, replacing any file at its path.
+
+    Args:
+    - target: The target of the symlink, relative to its folder.
+    - link_path: The path of the symlink.
+    """
+    tmp_path = link_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+def replace_hard_link(target, link_path):
+    """
+    Atomically hard-link a file to a path, replacing any file at the path.
+
+    Args:
+    - target: The path of the file to link to.
+    - link_path: The path of the link.
+    """
+    tmp_path = link_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.link(target, tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+def switch_version(version):
+    """
+    Make a version the deployed one and link the artifact names in the
+    production deployment directory to its files. The artifacts of other
+    versions that this version lacks are removed.
+
+    Args:
+    - version: The version to deploy.
+    """
+    version_dir = os.path.join(versions_path(), version)
+    if not os.path.isdir(version_dir):
+        raise FileNotFoundError(f"Unknown deployment version: {version}")
+    replace_symlink(os.path.join('versions', version), current_link_path())
+    names = set(os.listdir(version_dir))
+    for name in names:
+        link_path = config.path('prod_deployment_path', name)
+        target = os.path.join(version_dir, name)
+        if os.path.islink(link_path) or not os.path.exists(link_path) or \
+                not os.path.samefile(target, link_path):
+            replace_hard_link(target, link_path)
+
+    # E.g. the model selection results, after rolling back to a version
+    # deployed before model selection was enabled
+    versioned = {name for kept in list_versions()
+                 for name in os.listdir(os.path.join(versions_path(), kept))}
+    for name in os.listdir(config.path('prod_deployment_path')):
+        if name in names:
+            continue
+        path = config.path('prod_deployment_path', name)
+        if os.path.islink(path):
+            # Symlinks through 'current' are left by earlier deployments
+            stale = os.readlink(path).startswith('current' + os.sep)
+        else:
+            stale = name in versioned and os.path.isfile(path)
+        if stale:
+            os.remove(path)
+
+    # Make in-process users of the deployed model pick up the new one
+    model_path = model_registry.deployed_model_path()
+    model_registry.get_registry(model_path).invalidate()
+    model_registry.get_registry(compact_model_path(model_path)).invalidate()
+
+
+def adopt_unversioned():
+    """
+    Store the artifacts deployed before versioning as a version, so that
+    the first versioned deployment can be rolled back.
+    """
+    if current_version() is not None or not all(
+            os.path.exists(config.path('prod_deployment_path', name))
+            for name in REQUIRED_ARTIFACTS):
+        return
+    paths = [config.path('prod_deployment_path', os.path.basename(path))
+             for path in artifact_paths()]
+    paths = [path for path in paths
+             if os.path.isfile(path) and not os.path.islink(path)]
+    version = create_version(paths)
+    switch_version(version)
+    record_deployment(version, 'adopt')
+
+
+def prune_versions(keep=None):
+    """
+    Delete the versions beyond the most recently deployed ones.
+
+    Args:
+    - keep: Optional; The number of versions to keep. Defaults to the
+    'deployment_keep_versions' setting in config.json.
+    """
+    keep = keep or config.get('deployment_keep_versions', 5)
+    kept = set(list_versions()[:keep])
+    kept.add(current_version())
+    for name in os.listdir(versions_path()):
+        if not name.startswith('.') and name not in kept:
+            shutil.rmtree(os.path.join(versions_path(), name))
 
-prod_deployment_path = os.path.join(config['prod_deployment_path'])
-model_path = os.path.join(config['output_model_path'], 'trainedmodel.pkl')
-score_file_path = os.path.join(
-    config['output_model_path'], 'latestscore.txt')
-output_folder_path = os.path.join(
-    config['output_folder_path'], 'ingestedfiles.txt')
 
 # function for deployment
 
 
+@instrumented('deployment')
 def store_model_into_pickle():
     """
-    Copies the trained model, model score, and ingested data record
-    to the production deployment directory.
+    Deploys the trained model, its drift reference profile, training state
+    and model selection results, model score, and ingested data record as
+    a new version of the production deployment directory.
+
+    Returns:
+    - The deployed version.
     """
-    try:
-        # Ensure the production deployment directory exists
-        if not os.path.exists(prod_deployment_path):
-            os.makedirs(prod_deployment_path)
+    paths = artifact_paths()
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(
+            f"Error during deployment, missing artifacts: {missing}")
+
+    # Ensure the production deployment directory exists
+    os.makedirs(config.path('prod_deployment_path'), exist_ok=True)
+    adopt_unversioned()
 
-        # Copy the specified files to the production deployment directory
-        shutil.copy(model_path, prod_deployment_path)
-        shutil.copy(score_file_path, prod_deployment_path)
-        shutil.copy(output_folder_path, prod_deployment_path)
+    version = create_version(paths)
+    switch_version(version)
+    record_deployment(version, 'deploy')
+    prune_versions()
+    print(f"Files successfully deployed to production directory as "
+          f"version {version}")
+    return version
 
-        print("Files successfully deployed to production directory")
-    except FileNotFoundError as e:
-        print(f"Error during deployment: {e}")
+
+def rollback(version=None):
+    """
+    Switch the production deployment back to a kept version.
+
+    Args:
+    - version: Optional; The version to switch to. Defaults to the one
+    deployed before the current version.
+
+    Returns:
+    - The deployed version.
+    """
+    if version is None:
+        previous = [kept for kept in list_versions()
+                    if kept != current_version()]
+        if not previous:
+            raise FileNotFoundError("No previous version to roll back to")
+        version = previous[0]
+    switch_version(version)
+    record_deployment(version, 'rollback')
+    print(f"Rolled back production deployment to version {version}")
+    return version
 
 
 if __name__ == "__main__":
-    store_model_into_pickle()
+    if sys.argv[1:2] == ['list']:
+        for kept_version in list_versions():
+            marker = '*' if kept_version == current_version() else ' '
+            print(f"{marker} {kept_version}")
+    elif sys.argv[1:2] == ['rollback']:
+        rollback(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        store_model_into_pickle()
@@ -4,21 +4,22 @@ This module contains functions for diagnostics and monitoring
 of a machine learning model.
 """
 
-import os
-import json
-import pickle
-import subprocess
 import time
-import pandas as pd
-import numpy as np
+import logging
+import threading
+from importlib import metadata
+from datastore import DATASET_COLUMNS, FEATURE_COLUMNS, load_compact_dataset
+import model_registry
+import profiling
+from instrumentation import read_execution_times, read_stage_metrics
+from config import config, project_path
 
-# Load config.json and get environment variables
-with open('config.json', 'r', encoding='utf-8') as config_file:
-    config = json.load(config_file)
+logger = logging.getLogger(__name__)
 
-dataset_csv_path = os.path.join(config['output_folder_path'])
-test_data_path = os.path.join(config['test_data_path'])
-prod_deployment_path = os.path.join(config['prod_deployment_path'])
+# Cached results of the background diagnostics job
+_outdated_packages_cache = (None, None)
+_snapshot = None
+_snapshot_lock = threading.Lock()
 
 
 # Function to get model predictions
@@ -26,7 +27,8 @@ prod_deployment_path = os.path.join(config['prod_deployment_path'])
 
 def model_predictions(infer_data_path):
     """
-    Get model predictions for the given inference data.
+    Get model predictions for the given inference data. Nothing is cached
+    or saved, so any dataset can be predicted on request.
 
     Args:
     - infer_data_path: Path to the inference data CSV file.
@@ -34,132 +36,220 @@ def model_predictions(infer_data_path):
     Returns:
     - A list of model predictions.
     """
-    model_path = os.path.join(prod_deployment_path, 'trainedmodel.pkl')
-    # Load model
-    with open(model_path, 'rb') as model_file:
-        model = pickle.load(model_file)
-    # Load test data
-    infer_data = pd.read_csv(infer_data_path)
-    features = infer_data[['lastmonth_activity',
-                           'lastyear_activity',
-                           'number_of_employees']]
+    # Get the deployed model from the in-memory registry
+    model = model_registry.get_inference_model()
+    # Load the features only, so that rows with a missing label are still
+    # predicted
+    features = load_compact_dataset(infer_data_path, labels=False).features
     # Predict
-    predictions = model.predict(features)
-    predictions = [int(prediction) if isinstance(
-        prediction, np.integer) else prediction for prediction in predictions]
-
-    return predictions
+    return model.predict(features).tolist()
 
 # Function to get summary statistics
 
 
 def dataframe_summary():
     """
-    Calculate summary statistics for numeric columns in the dataset.
+    Get summary statistics for numeric columns in the dataset from the
+    profile cached at ingestion time.
 
     Returns:
     - A list of dictionaries containing the mean, median, and standard
-    deviation for each numeric column.
+    deviation for each numeric column, empty if no data has been ingested.
     """
-    data_file_path = os.path.join(dataset_csv_path, 'finaldata.csv')
-    data = pd.read_csv(data_file_path)
-    numeric_columns = ['lastmonth_activity',
-                       'lastyear_activity',
-                       'number_of_employees']
+    columns = dataset_profile()['columns']
     summary_stats = []
-    for column in numeric_columns:
+    for column in FEATURE_COLUMNS:
+        if column not in columns:
+            continue
         stats = {
-            'mean': data[column].mean(),
-            'median': data[column].median(),
-            'std': data[column].std()
+            'mean': columns[column]['mean'],
+            'median': columns[column]['quantiles']['0.5'],
+            'std': columns[column]['std']
         }
         summary_stats.append(stats)
     return summary_stats
 
+
+def dataset_profile():
+    """
+    Get the profile of the ingested dataset, profiling it once if ingestion
+    has not cached it yet.
+
+    Returns:
+    - A dictionary with the row count and the statistics of each column,
+    with no rows and no columns if no data has been ingested yet.
+    """
+    summary = profiling.load_summary()
+    if summary is None:
+        profiling.current_profile(
+            config.path('output_folder_path', 'finaldata.csv'))
+        summary = profiling.load_summary()
+    if summary is None:
+        return profiling.DatasetProfile().summary()
+    return summary
+
 # Missing data function
 
 
 def missing_data_check():
     """
-    Count missing data (NA values) in each column of the dataset and calculate
-    the percentage of NA values.
+    Get the percentage of missing data (NA values) in each column of the
+    dataset from the profile cached at ingestion time.
 
     Returns:
-    - A list of percentages of NA values for each column in the dataset.
-    """
-    dataset = pd.read_csv(os.path.join(
-        config['output_folder_path'], 'finaldata.csv'))
-    # Calculating the number of missing values in each column
-    missing_counts = dataset.isna().sum()
-    # Calculating the percentage of missing values in each column
-    total_rows = len(dataset)
-    missing_percentage = (missing_counts / total_rows) * 100
-    # Returning the missing percentage values as a list
-    return missing_percentage.tolist()
+    - A list of percentages of NA values for each column in the dataset,
+    empty if no data has been ingested.
+    """
+    columns = dataset_profile()['columns']
+    return [columns[column]['na_percentage']
+            for column in DATASET_COLUMNS if column in columns]
 
 # Function to get timings
 
 
 def execution_time():
     '''
-    Calculate timing of training.py and ingestion.py using subprocess.
+    Get the timings of ingestion and training recorded the last time
+    each of them ran.
+    Returns:
+    - A list of 2 timing values in seconds: [ingestion_time, training_time],
+    with None for a stage that has not run yet
+    '''
+    execution_times = read_execution_times()
+    return [execution_times.get(stage, {}).get('seconds')
+            for stage in ('ingestion', 'training')]
+
+
+def stage_metrics_history(limit=100):
+    '''
+    Get the most recent stage records of the instrumented pipeline.
+    Args:
+    - limit: Optional; The maximum number of records to return.
     Returns:
-    - A list of 2 timing values in seconds: [ingestion_time, training_time]
+    - A list of stage records with run id, stage, duration, peak memory
+    and row count, oldest first
     '''
-    start_time = time.time()
-    # Run ingestion.py and wait for it to finish
-    subprocess.run(['python', 'ingestion.py'],
-                   capture_output=True, text=True, check=True)
-    ingestion_time = time.time() - start_time
-    start_time = time.time()
-    # Run training.py and wait for it to finish
-    subprocess.run(['python', 'training.py'],
-                   capture_output=True, text=True, check=True)
-    training_time = time.time() - start_time
-    return [ingestion_time, training_time]
+    return read_stage_metrics(limit)
 
 # Function to check dependencies
 
 
 def outdated_packages_list():
     """
-    Get a list of outdated packages listed in requirements.txt
-    with their current and latest versions.
+    Get a list of packages listed in requirements.txt whose installed
+    version differs from the required one, using the locally installed
+    package metadata. The result is cached for the number of seconds set by
+    'dependency_check_ttl_seconds' in config.json.
 
     Returns:
     - A list of dictionaries, each containing information
      about an outdated package.
     """
-    # Read the requirements.txt file and extract package names
-    with open('requirements.txt', 'r', encoding='utf-8') as f:
-        required_packages = {line.split(
-            '==')[0].lower() for line in f if '==' in line}
-
-    # Execute the pip list command to get outdated packages
-    result = subprocess.run(['pip', 'list', '--outdated'],
-                            capture_output=True, text=True, check=True)
-    lines = result.stdout.split('\n')
+    global _outdated_packages_cache
+    checked_at, outdated_packages = _outdated_packages_cache
+    if checked_at is not None and \
+            time.time() - checked_at < config.get(
+                'dependency_check_ttl_seconds', 3600):
+        return outdated_packages
+
+    # Read the requirements.txt file and extract package names and versions
+    with open(project_path('requirements.txt'), 'r', encoding='utf-8') as f:
+        required_packages = [line.strip().split('==')
+                             for line in f if '==' in line]
 
     # Initialize a list to hold outdated package info
     outdated_packages = []
 
-    # Parse the output to find outdated packages
-    for line in lines:
-        if line and 'Package' not in line and '---' not in line:
-            package_details = line.split()
-            package_name, current_version, latest_version, _ = package_details
-            if package_name.lower() in required_packages:
-                outdated_packages.append({
-                    'package_name': package_name,
-                    'current_version': current_version,
-                    'latest_version': latest_version
-                })
-
+    # Compare the required versions with the installed ones
+    for package_name, required_version in required_packages:
+        try:
+            current_version = metadata.version(package_name)
+        except metadata.PackageNotFoundError:
+            current_version = None
+        if current_version != required_version:
+            outdated_packages.append({
+                'package_name': package_name,
+                'current_version': current_version,
+                'required_version': required_version
+            })
+
+    _outdated_packages_cache = (time.time(), outdated_packages)
     return outdated_packages
 
+# Functions for the cached diagnostics snapshot
+
+
+def refresh_snapshot():
+    """
+    Recompute the diagnostics and store them as the latest snapshot.
+
+    Returns:
+    - The new snapshot.
+    """
+    global _snapshot
+    snapshot = {
+        'execution_time': execution_time(),
+        'stage_metrics': read_execution_times(),
+        'missing_data': missing_data_check(),
+        'outdated_packages': outdated_packages_list(),
+        'timestamp': time.time()
+    }
+    with _snapshot_lock:
+        _snapshot = snapshot
+    return snapshot
+
+
+def diagnostics_snapshot():
+    """
+    Get the latest diagnostics snapshot without recomputing it, computing
+    it only if no snapshot has been taken yet.
+
+    Returns:
+    - A dictionary with the diagnostics, the time they were taken, their age
+    in seconds and whether they are stale.
+    """
+    with _snapshot_lock:
+        snapshot = _snapshot
+    if snapshot is None:
+        snapshot = refresh_snapshot()
+    age = time.time() - snapshot['timestamp']
+    return {
+        **snapshot,
+        'age_seconds': age,
+        'stale': age > 2 * config.get('diagnostics_refresh_seconds', 60)
+    }
+
+
+def start_background_refresh(interval=None):
+    """
+    Start a daemon thread refreshing the diagnostics snapshot periodically.
+
+    Args:
+    - interval: Optional; Seconds between refreshes. Defaults to the
+    'diagnostics_refresh_seconds' setting in config.json.
+
+    Returns:
+    - The started thread.
+    """
+    interval = interval or config.get('diagnostics_refresh_seconds', 60)
+
+    def refresh_loop():
+        while True:
+            # Keep refreshing whatever fails, or the snapshot goes stale
+            try:
+                refresh_snapshot()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error refreshing diagnostics")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=refresh_loop, daemon=True,
+                              name='diagnostics-refresh')
+    thread.start()
+    return thread
+
 
 if __name__ == '__main__':
-    test_path = os.path.join(test_data_path, 'testdata.csv')
+    test_path = config.path('test_data_path', 'testdata.csv')
     model_predictions(test_path)
     dataframe_summary()
     execution_time()
@@ -0,0 +1,362 @@
+"""
+This module detects data drift on the newly ingested rows by comparing
+their feature and score distributions with a reference profile stored at
+training time, without re-scoring the whole dataset.
+"""
+
+import os
+import json
+import math
+import numpy as np
+from scipy.special import kolmogorov
+from datastore import FEATURE_COLUMNS, dataset_exists, iter_dataset_chunks
+from compact_model import feature_array
+from instrumentation import instrumented, record_rows
+from ingestion import new_rows_path
+import model_registry
+from config import config
+
+# Smallest bin proportion used in the PSI, so empty bins stay finite
+PSI_EPSILON = 1e-4
+
+# Fixed bin edges of the predicted probability
+SCORE_EDGES = np.linspace(0, 1, 21)[1:-1]
+
+
+# Function for the path of the reference profile
+
+
+def reference_path(folder_key='output_model_path'):
+    """
+    Get the path of the drift reference profile.
+
+    Args:
+    - folder_key: Optional; The config.json key of the folder holding it.
+
+    Returns:
+    - The path of driftreference.json.
+    """
+    return config.path(folder_key, 'driftreference.json')
+
+
+def drift_report_path():
+    """
+    Get the path of the drift decision of the latest pipeline run.
+
+    Returns:
+    - The path of driftreport.json in the output model folder.
+    """
+    return config.path('output_model_path', 'driftreport.json')
+
+
+# Functions for binned distributions
+
+
+def bin_counts(values, edges):
+    """
+    Count values in the bins delimited by the inner bin edges.
+
+    Args:
+    - values: A numpy array of values without NAs.
+    - edges: The sorted inner bin edges.
+
+    Returns:
+    - A numpy array of len(edges) + 1 counts.
+    """
+    return np.bincount(np.searchsorted(edges, values, side='right'),
+                       minlength=len(edges) + 1)
+
+
+def population_stability_index(reference_counts, counts):
+    """
+    Calculate the population stability index between two binned
+    distributions.
+
+    Args:
+    - reference_counts: The bin counts of the reference.
+    - counts: The bin counts of the new rows.
+
+    Returns:
+    - The PSI, 0 for identical distributions.
+    """
+    expected = np.maximum(reference_counts / reference_counts.sum(),
+                          PSI_EPSILON)
+    actual = np.maximum(counts / counts.sum(), PSI_EPSILON)
+    return float(((actual - expected) * np.log(actual / expected)).sum())
+
+
+def ks_test(reference_counts, counts):
+    """
+    Two-sample Kolmogorov-Smirnov test on binned distributions. The
+    statistic is evaluated at the bin edges, so it is a lower bound of the
+    statistic on the raw values.
+
+    Args:
+    - reference_counts: The bin counts of the reference.
+    - counts: The bin counts of the new rows.
+
+    Returns:
+    - A tuple of the KS statistic and its asymptotic p-value.
+    """
+    n, m = reference_counts.sum(), counts.sum()
+    statistic = float(np.abs(np.cumsum(reference_counts) / n
+                             - np.cumsum(counts) / m).max())
+    effective = n * m / (n + m)
+    scaled = (math.sqrt(effective) + 0.12 + 0.11 / math.sqrt(effective)) \
+        * statistic
+    return statistic, float(kolmogorov(scaled))
+
+
+# Functions for the reference profile
+
+
+def build_reference(features, scores, bins=20):
+    """
+    Build the drift reference profile of the training data: quantile bins
+    of every feature and fixed bins of the predicted probability.
+
+    Args:
+    - features: A dataframe of the training features.
+    - scores: A numpy array of the predicted probabilities of the
+    training rows.
+    - bins: Optional; The number of quantile bins per feature.
+
+    Returns:
+    - The reference profile as a dictionary.
+    """
+    reference = {'rows': len(features), 'features': {}}
+    for column in FEATURE_COLUMNS:
+        values = features[column].dropna().to_numpy(dtype=np.float64)
+        edges = np.unique(
+            np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1]))
+        reference['features'][column] = {
+            'edges': edges.tolist(),
+            'counts': bin_counts(values, edges).tolist()
+        }
+    reference['score'] = {
+        'edges': SCORE_EDGES.tolist(),
+        'counts': bin_counts(np.asarray(scores), SCORE_EDGES).tolist()
+    }
+    return reference
+
+
+def update_reference(reference, features, scores):
+    """
+    Add new training rows to a drift reference profile, keeping its bins.
+
+    Args:
+    - reference: The reference profile.
+    - features: A dataframe of the new training features.
+    - scores: A numpy array of the predicted probabilities of the new rows.
+
+    Returns:
+    - The updated reference profile.
+    """
+    updated = {'rows': reference['rows'] + len(features), 'features': {}}
+    for column in FEATURE_COLUMNS:
+        edges = reference['features'][column]['edges']
+        values = features[column].dropna().to_numpy(dtype=np.float64)
+        updated['features'][column] = {
+            'edges': edges,
+            'counts': (np.asarray(reference['features'][column]['counts'])
+                       + bin_counts(values, np.asarray(edges))).tolist()
+        }
+    updated['score'] = {
+        'edges': reference['score']['edges'],
+        'counts': (np.asarray(reference['score']['counts'])
+                   + bin_counts(np.asarray(scores), SCORE_EDGES)).tolist()
+    }
+    return updated
+
+
+def save_reference(reference, path=None):
+    """
+    Write a drift reference profile.
+
+    Args:
+    - reference: The reference profile.
+    - path: Optional; The output path. Defaults to the model folder.
+    """
+    path = path or reference_path()
+    with open(path, 'w', encoding='utf-8') as reference_file:
+        json.dump(reference, reference_file)
+
+
+def load_reference(path=None):
+    """
+    Load a drift reference profile.
+
+    Args:
+    - path: Optional; The reference path. Defaults to the one deployed in
+    production.
+
+    Returns:
+    - The reference profile, or None if it does not exist.
+    """
+    path = path or reference_path('prod_deployment_path')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as reference_file:
+        return json.load(reference_file)
+
+
+# Function for drift detection
+
+
+def compare(reference_counts, counts):
+    """
+    Compare binned distributions against the drift thresholds set by
+    'drift_psi_threshold' and 'drift_ks_alpha' in config.json.
+
+    Args:
+    - reference_counts: The bin counts of the reference.
+    - counts: The bin counts of the new rows.
+
+    Returns:
+    - A dictionary with the PSI, the KS statistic and p-value, and whether
+    the distributions drifted, or None if there are no new values.
+    """
+    if not counts.sum():
+        return None
+    psi = population_stability_index(reference_counts, counts)
+    statistic, p_value = ks_test(reference_counts, counts)
+    return {
+        'psi': psi,
+        'ks_statistic': statistic,
+        'ks_p_value': p_value,
+        'drift': bool(psi > config.get('drift_psi_threshold', 0.2)
+                      or p_value < config.get('drift_ks_alpha', 0.01))
+    }
+
+
+@instrumented('drift')
+def detect_drift(data_path=None, reference=None, model=None,
+                 chunksize=100000):
+    """
+    Detect drift of the newly ingested rows against the reference profile
+    of the deployed model, in a single pass over the new rows.
+
+    Args:
+    - data_path: Optional; The csv path of the rows to check. Defaults to
+    the rows added by the latest ingestion.
+    - reference: Optional; The reference profile. Defaults to the one
+    deployed in production.
+    - model: Optional; The model scoring the rows. Defaults to the deployed
+    inference model.
+    - chunksize: Optional; The number of rows read at a time.
+
+    Returns:
+    - A dictionary with the row count, the comparison of every feature and
+    of the scores, whether any of them drifted and whether there were
+    enough rows ('drift_min_rows' in config.json) to decide, or None if
+    there is no reference profile or no rows to check.
+    """
+    reference = reference or load_reference()
+    data_path = data_path or new_rows_path()
+    if reference is None or not dataset_exists(data_path):
+        return None
+    model = model or model_registry.get_inference_model()
+
+    features = reference['features']
+    edges = {column: np.asarray(features[column]['edges'])
+             for column in FEATURE_COLUMNS}
+    counts = {column: 0 for column in FEATURE_COLUMNS + ['score']}
+    rows = 0
+    for chunk in iter_dataset_chunks(data_path, chunksize):
+        rows += len(chunk)
+        for column in FEATURE_COLUMNS:
+            values = chunk[column].dropna().to_numpy(dtype=np.float64)
+            counts[column] = counts[column] + bin_counts(values,
+                                                         edges[column])
+        scores = model.predict_proba(feature_array(
+            chunk[FEATURE_COLUMNS].dropna()))[:, 1]
+        counts['score'] = counts['score'] + bin_counts(scores, SCORE_EDGES)
+    record_rows(rows)
+
+    report = {'rows': rows, 'features': {}, 'score': None, 'drift': False,
+              'sufficient': rows >= config.get('drift_min_rows', 100)}
+    if rows == 0:
+        return report
+    for column in FEATURE_COLUMNS:
+        report['features'][column] = compare(
+            np.asarray(features[column]['counts']), counts[column])
+    report['score'] = compare(
+        np.asarray(reference['score']['counts']), counts['score'])
+    report['drift'] = any(
+        comparison is not None and comparison['drift']
+        for comparison in [report['score'], *report['features'].values()])
+    return report
+
+
+# Functions for the model drift decision
+
+
+def f1_drift():
+    """
+    Check for model drift by re-scoring the ingested data with the deployed
+    model and comparing its F1 score with the deployed score.
+
+    Returns:
+    - True if the new score is below the deployed score.
+    """
+    # pylint: disable=import-outside-toplevel
+    import diagnostics
+    import scoring
+
+    new_data_path = config.path('output_folder_path', 'finaldata.csv')
+
+    # Use the diagnostics module to generate model predictions
+    predictions = diagnostics.model_predictions(new_data_path)
+
+    # Score the new predictions
+    new_score = scoring.score_model(
+        predictions=predictions, new_data_path=new_data_path)
+
+    # Read the last score from 'latestscore.txt'
+    with open(config.path('prod_deployment_path', 'latestscore.txt'), 'r',
+              encoding='utf-8') as f:
+        last_score_str = f.readline().strip()
+        last_score = float(last_score_str.split(": ")[1])
+
+    return new_score < last_score
+
+
+def check_model_drift():
+    """
+    Decide whether the deployed model drifted, from the distributions of the
+    newly ingested rows, falling back to re-scoring when the tests can't
+    decide or when 'drift_confirm_f1' is set in config.json. The decision is
+    written to driftreport.json.
+
+    Returns:
+    - True if model drift was found.
+    """
+    report = detect_drift()
+    if report is None or not report['sufficient']:
+        model_drift = f1_drift()
+    elif report['drift'] and config.get('drift_confirm_f1', False):
+        model_drift = f1_drift()
+    else:
+        model_drift = report['drift']
+
+    with open(drift_report_path(), 'w', encoding='utf-8') as report_file:
+        json.dump({'drift': bool(model_drift), 'report': report},
+                  report_file, indent=4)
+    return model_drift
+
+
+def load_drift_report():
+    """
+    Load the drift decision of the latest pipeline run.
+
+    Returns:
+    - The decision as a dictionary, or None if there is none.
+    """
+    if not os.path.exists(drift_report_path()):
+        return None
+    with open(drift_report_path(), 'r', encoding='utf-8') as report_file:
+        return json.load(report_file)
+
+
+if __name__ == '__main__':
+    print(json.dumps(detect_drift(), indent=4))
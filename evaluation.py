@@ -0,0 +1,242 @@
+"""
+This module evaluates the deployed model on a dataset once and keeps the
+result as an artifact, so that reporting, the API and apicalls.py share
+the predictions and metrics instead of re-running inference.
+
+An evaluation holds the predictions, the probabilities of the positive
+class, the confusion matrix, and the F1 score, precision, recall, AUC and
+ROC curve when the dataset is labelled. It is stored in models/evaluations,
+named after the hash of the model file and the hash of the dataset file,
+and is recomputed only when either of them changes.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from sklearn import metrics
+from datastore import dataset_file, load_compact_dataset
+from compact_model import compact_model_path
+import model_registry
+from manifest import file_hash
+from instrumentation import instrumented, record_rows
+from config import config
+
+# Content hashes of files by path, with the size, mtime and inode they were
+# computed for
+_file_hashes = {}
+
+# The evaluations loaded in this process, by key
+_evaluations = {}
+_evaluations_lock = threading.Lock()
+
+
+# Functions for the evaluation artifacts
+
+
+def evaluations_path(*parts):
+    """
+    Get the folder holding the evaluations, or a path in it.
+
+    Args:
+    - parts: Optional; Path components to join to the folder.
+
+    Returns:
+    - The path in models/evaluations.
+    """
+    return config.path('output_model_path', 'evaluations', *parts)
+
+
+def cached_file_hash(path):
+    """
+    Get the content hash of a file, hashing it again only if its size,
+    mtime or inode changed.
+
+    Args:
+    - path: The path of the file.
+
+    Returns:
+    - The sha256 hex digest of the file.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    known = _file_hashes.get(path)
+    if known is None or known[0] != signature:
+        known = (signature, file_hash(path))
+        _file_hashes[path] = known
+    return known[1]
+
+
+def evaluation_key(data_path, model_path):
+    """
+    Get the key of the evaluation of a model on a dataset.
+
+    Args:
+    - data_path: The csv path of the dataset.
+    - model_path: The path of the pickled model.
+
+    Returns:
+    - A tuple of the model version, the dataset hash and the key.
+    """
+    model_file = compact_model_path(model_path)
+    if not os.path.exists(model_file):
+        model_file = model_path
+    model_version = cached_file_hash(model_file)[:16]
+    data_hash = cached_file_hash(dataset_file(data_path))[:16]
+    return model_version, data_hash, f'{model_version}-{data_hash}'
+
+
+def save_evaluation(evaluation):
+    """
+    Atomically write an evaluation, keeping only the most recent ones, set
+    by 'evaluation_keep' in config.json.
+
+    Args:
+    - evaluation: The evaluation.
+    """
+    os.makedirs(evaluations_path(), exist_ok=True)
+    path = evaluations_path(f"{evaluation['key']}.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as evaluation_file:
+        json.dump(evaluation, evaluation_file)
+    os.replace(path + '.tmp', path)
+
+    saved = sorted((entry for entry in os.scandir(evaluations_path())
+                    if entry.name.endswith('.json')),
+                   key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in saved[config.get('evaluation_keep', 10):]:
+        os.remove(entry.path)
+
+
+def load_evaluation(key):
+    """
+    Load a saved evaluation.
+
+    Args:
+    - key: The evaluation key.
+
+    Returns:
+    - The evaluation, or None if it is not saved.
+    """
+    path = evaluations_path(f'{key}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as evaluation_file:
+        return json.load(evaluation_file)
+
+
+# Functions for evaluating the model
+
+
+@instrumented('evaluation')
+def evaluate(data_path, model_path, key=None):
+    """
+    Score a model on a dataset in a single pass, computing the predictions
+    and probabilities from one decision function.
+
+    Args:
+    - data_path: The csv path of the dataset.
+    - model_path: The path of the pickled model.
+    - key: Optional; The result of evaluation_key, if already computed.
+
+    Returns:
+    - The evaluation as a dictionary. The metrics are None if the dataset
+    has no labels.
+    """
+    model_version, data_hash, key = key or evaluation_key(data_path,
+                                                          model_path)
+    model = model_registry.get_inference_model(model_path)
+    data = load_compact_dataset(data_path)
+    record_rows(len(data))
+
+    classes = model.classes_ if hasattr(model, 'classes_') else model.classes
+    decision = np.ravel(model.decision_function(data.features))
+    predictions = np.asarray(classes)[(decision > 0).astype(np.intp)]
+    # The logistic function written with tanh, which does not overflow
+    probabilities = 0.5 * (1 + np.tanh(0.5 * decision.astype(np.float64)))
+
+    evaluation = {
+        'key': key,
+        'model_version': model_version,
+        'data_hash': data_hash,
+        'data_path': data_path,
+        'rows': len(data),
+        'evaluated_at': time.time(),
+        'predictions': predictions.tolist(),
+        'probabilities': probabilities.tolist(),
+        'labels': None,
+        'confusion_matrix': None,
+        'f1': None,
+        'precision': None,
+        'recall': None,
+        'auc': None,
+        'roc': None
+    }
+    if data.labels is not None:
+        actual = data.labels
+        labels = np.union1d(actual, predictions)
+        positive = actual == classes[1]
+        evaluation.update({
+            'labels': labels.tolist(),
+            'confusion_matrix': metrics.confusion_matrix(
+                actual, predictions, labels=labels).tolist(),
+            'f1': float(metrics.f1_score(actual, predictions,
+                                         zero_division=0)),
+            'precision': float(metrics.precision_score(
+                actual, predictions, zero_division=0)),
+            'recall': float(metrics.recall_score(actual, predictions,
+                                                 zero_division=0)),
+            'auc': float(metrics.roc_auc_score(positive, probabilities))
+            if 0 < positive.sum() < len(positive) else None
+        })
+        if evaluation['auc'] is not None:
+            fpr, tpr, _ = metrics.roc_curve(positive, probabilities)
+            evaluation['roc'] = {'fpr': fpr.tolist(), 'tpr': tpr.tolist()}
+    return evaluation
+
+
+def get_evaluation(data_path=None, model_path=None):
+    """
+    Get the evaluation of a model on a dataset, computing and saving it
+    only if no evaluation of the same model and data exists.
+
+    Args:
+    - data_path: Optional; The csv path of the dataset. Defaults to the
+    test dataset.
+    - model_path: Optional; The path of the pickled model. Defaults to the
+    deployed model.
+
+    Returns:
+    - The evaluation as a dictionary.
+    """
+    data_path = data_path or config.path('test_data_path', 'testdata.csv')
+    model_path = model_path or model_registry.deployed_model_path()
+    key = evaluation_key(data_path, model_path)
+    with _evaluations_lock:
+        evaluation = _evaluations.get(key[2]) or load_evaluation(key[2])
+        if evaluation is None:
+            evaluation = evaluate(data_path, model_path, key)
+            save_evaluation(evaluation)
+        # Keep only the latest evaluations in memory
+        if len(_evaluations) >= 4:
+            _evaluations.clear()
+        _evaluations[key[2]] = evaluation
+    return evaluation
+
+
+def evaluation_summary(evaluation):
+    """
+    Get an evaluation without its per-row predictions and probabilities.
+
+    Args:
+    - evaluation: The evaluation.
+
+    Returns:
+    - A dictionary of the keys and metrics of the evaluation.
+    """
+    return {name: value for name, value in evaluation.items()
+            if name not in ('predictions', 'probabilities')}
+
+
+if __name__ == '__main__':
+    print(json.dumps(evaluation_summary(get_evaluation()), indent=4))
@@ -7,49 +7,89 @@ diagnostics, and reporting.
 
 The process includes the following steps:
 1. Check and read new data:
-    - Read the 'ingestedfiles.txt' file.
+    - Read the ingestion manifest of file sizes, mtimes and content hashes.
     - Determine whether the source data folder has files that aren't
-      listed in 'ingestedfiles.txt'.
+      in the manifest, or that changed since they were ingested.
 
 2. Deciding whether to proceed, part 1:
     - If new data is found, proceed with the process.
       Otherwise, end the process here.
 
 3. Checking for model drift:
-    - Check whether the score from the deployed model is different
-      from the score from the model that uses the newest ingested data.
+    - Compare the feature and score distributions of the newly ingested
+      rows with the reference profile of the deployed model (PSI and KS).
+    - Confirm with the F1 score of the deployed model on the ingested data
+      when 'drift_confirm_f1' is set, or when there is no reference profile
+      or too few new rows for the statistical tests.
 
 4. Deciding whether to proceed, part 2:
     - If model drift is found, proceed with the process.
       Otherwise, end the process here.
 
 5. Re-deployment:
-    - If evidence for model drift is found, re-run the 'deployment.py' script.
+    - If evidence for model drift is found, re-train the model and score it
+      against the deployed model on the test data and the new rows.
+    - Re-deploy only if the re-trained model beats the deployed one by the
+      'promotion_margin' set in config.json.
 
 6. Diagnostics and reporting:
     - Run the 'apicalls.py' and 'reporting.py' scripts for the
      re-deployed model.
 """
-import os
-import json
-import ingestion
-import training
-import scoring
-import deployment
-import diagnostics
-import reporting
-import apicalls
-
-with open('config.json', 'r', encoding='utf-8') as config_file:
-    config = json.load(config_file)
-
-prod_deployment_path = config['prod_deployment_path']
-input_folder_path = config['input_folder_path']
-ingested_files_path = os.path.join(prod_deployment_path, 'ingestedfiles.txt')
-new_data_path = os.path.join(config['output_folder_path'], 'finaldata.csv')
-
-
-def main():
+import sys
+import fcntl
+import contextlib
+import manifest
+import pipeline
+from config import config
+
+
+@contextlib.contextmanager
+def pipeline_lock(blocking=False):
+    """
+    Hold an exclusive lock on the pipeline, so that runs started by cron and
+    by the scheduler daemon never overlap.
+
+    Args:
+    - blocking: Optional; If True, wait for a running pipeline to finish.
+
+    Yields:
+    - True if the lock was acquired.
+    """
+    lock_path = config.path('output_model_path', 'pipeline.lock')
+    with open(lock_path, 'a', encoding='utf-8') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking
+                        else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def main(blocking=False):
+    """
+    Run the full process of scoring monitoring unless another run holds the
+    pipeline lock.
+
+    Args:
+    - blocking: Optional; If True, wait for the other run to finish instead.
+
+    Returns:
+    - True if the process ran.
+    """
+    with pipeline_lock(blocking) as acquired:
+        if not acquired:
+            print("Another pipeline run is in progress")
+            return False
+        run_pipeline()
+        return True
+
+
+def run_pipeline(dry_run=False):
     """
     Main function that executes the full process of scoring monitoring.
 
@@ -61,78 +101,32 @@ def main():
      model drift.
     5. Re-trains the model with new data and re-deploys the model if necessary.
     6. Runs diagnostics and reporting for the re-deployed model.
+
+    Steps 3 to 6 are the stages of pipeline.py, which skips the stages whose
+    inputs and settings are unchanged since they last ran.
+
+    Args:
+    - dry_run: Optional; If True, only print which stages would run and why.
     """
     # 1. Check and read new data
-    # first, read ingestedfiles.txt
-    with open(ingested_files_path, 'r', encoding='utf-8') as f:
-        ingested_files = f.read().splitlines()
-
-    # Check for new data in the input folder
-    source_data_files = os.listdir(input_folder_path)
-    # second, determine whether the source data folder has files that aren't
-    #  listed in ingestedfiles.txt
-    new_files = [
-        file for file in source_data_files if file not in ingested_files]
+    # Compare the input folder with the ingestion manifest; only files whose
+    # size or mtime changed are hashed
+    scan = manifest.scan_folder()
 
     # 2. Deciding whether to proceed, part 1
-    # if you found new data, you should proceed. otherwise,
-    # do end the process here
-    if new_files:
-        # New data found, run ingestion process
-        ingestion.merge_multiple_dataframe()
-        proceed = True  # Variable to control the flow
-    else:
+    # if you found new or changed data, you should proceed. otherwise,
+    # do end the process here, unless the last run was interrupted
+    if not scan.new and not scan.changed and pipeline.is_complete() \
+            and not dry_run:
         # No new data found, end the process
-        proceed = False
-
-    # Checking for model drift
-    if proceed:
-        # Use the diagnostics module to generate model predictions
-        predictions = diagnostics.model_predictions(new_data_path)
-
-        # Score the new predictions
-        new_score = scoring.score_model(
-            predictions=predictions, new_data_path=new_data_path)
-
-        # Read the last score from 'latestscore.txt'
-        with open(os.path.join(prod_deployment_path, 'latestscore.txt'), 'r',
-                  encoding='utf-8') as f:
-            last_score_str = f.readline().strip()
-            last_score = float(last_score_str.split(": ")[1])
-
-        # 3. Check for model drift
-        if new_score < last_score:
-            model_drift = True
-            print("Model drift detected")
-        else:
-            model_drift = False
-            print("No model drift detected")
-
-        # 4. Deciding whether to proceed, part 2
-        if model_drift:
-            proceed = True
-            print("Proceeding with re-deployment and diagnostics")
-        else:
-            proceed = False
-            print("Process ends due to no model drift")
-
-        if proceed:
-            # 5.1. Re-training the model with the new data
-            # if you found evidence for model drift, re-run the deployment.py
-            print("Re-training the model...")
-            training.train_model()
-
-            # 5.2. Re-deploying the model
-            print("Re-deploying the model...")
-            # Calling the function to deploy the retrained model
-            deployment.store_model_into_pickle()
-
-    # Diagnostics and reporting
-    # run diagnostics.py and reporting.py for the re-deployed model
-            print("Running diagnostics and generating reports...")
-            apicalls.run_apicalls()
-            reporting.score_model()
+        return
+
+    # Run the stages that are out of date
+    pipeline.run(dry_run=dry_run)
 
 
 if __name__ == "__main__":
-    main()
+    if '--dry-run' in sys.argv[1:]:
+        run_pipeline(dry_run=True)
+    else:
+        main()
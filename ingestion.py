@@ -4,50 +4,457 @@ This module is responsible for data ingestion.
 
 import os
 import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+from config import config
+from datastore import (COLUMN_DTYPES, CSV_DTYPES, DATASET_COLUMNS,
+                       DatasetWriter, dataset_exists, dataset_file,
+                       enforce_dtypes, iter_dataset_chunks, remove_superseded,
+                       storage_path, write_dataset)
+from instrumentation import instrumented, record_rows
+import manifest
+import profiling
 
-# Load config.json and get input and output paths
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
 
-input_folder_path = config['input_folder_path']
-output_folder_path = config['output_folder_path']
+# Functions for the input and output paths
+
+
+def input_folder_path():
+    """
+    Get the folder holding the source csv files.
+    """
+    return config.path('input_folder_path')
+
+
+def final_data_path():
+    """
+    Get the csv path of the ingested dataset.
+    """
+    return config.path('output_folder_path', 'finaldata.csv')
+
+
+def ingested_files_path():
+    """
+    Get the path of the record of ingested files.
+    """
+    return config.path('output_folder_path', 'ingestedfiles.txt')
+
+
+def new_rows_path():
+    """
+    Get the csv path of the rows added by the latest ingestion, which are
+    checked for drift.
+    """
+    return config.path('output_folder_path', 'newrows.csv')
+
+
+def row_hashes_path():
+    """
+    Get the path of the row-hash index of the ingested dataset.
+    """
+    return config.path('output_folder_path', 'rowhashes.npy')
+
+
+def append_journal_path():
+    """
+    Get the path of the journal of an incremental ingestion in progress.
+    """
+    return config.path('output_folder_path', 'appendjournal.json')
+
+
+# Functions for the persisted row-hash index
+
+
+def hash_rows(df):
+    """
+    Hash every row of a dataframe into a 64-bit fingerprint. The numeric
+    columns are hashed as float64, so a row hashes the same whether or not
+    its chunk held NA values.
+
+    Args:
+    - df: The dataframe to hash.
+
+    Returns:
+    - A numpy array of uint64 row hashes.
+    """
+    canonical = df.astype(
+        {column: 'float64' for column in COLUMN_DTYPES if column in df})
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+
+
+class RowHashIndex:
+    """
+    Set of row hashes, kept as sorted uint64 runs that are merged when a
+    newer run grows to half the size of the one before it. Lookups are
+    binary searches, and memory is 8 bytes per unique row.
+    """
+
+    def __init__(self, hashes=None):
+        self._runs = []
+        if hashes is not None and len(hashes):
+            self._runs.append(np.unique(hashes))
+
+    def add_unseen(self, hashes):
+        """
+        Add the hashes not yet in the index.
+
+        Args:
+        - hashes: A numpy array of uint64 row hashes.
+
+        Returns:
+        - A boolean mask of the rows seen for the first time, keeping the
+        first of any duplicates within the hashes.
+        """
+        unseen = np.zeros(len(hashes), dtype=bool)
+        unseen[np.unique(hashes, return_index=True)[1]] = True
+        for run in self._runs:
+            positions = np.searchsorted(run, hashes)
+            positions[positions == len(run)] = 0
+            unseen &= run[positions] != hashes
+        if unseen.any():
+            self._runs.append(np.sort(hashes[unseen]))
+            while len(self._runs) > 1 and \
+                    len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+                newest = self._runs.pop()
+                self._runs[-1] = np.sort(
+                    np.concatenate([self._runs[-1], newest]))
+        return unseen
+
+    def to_array(self):
+        """
+        Get all hashes in the index.
+
+        Returns:
+        - A sorted numpy array of uint64 row hashes.
+        """
+        if not self._runs:
+            return np.empty(0, dtype=np.uint64)
+        return np.sort(np.concatenate(self._runs))
+
+
+def load_row_hashes():
+    """
+    Load the row-hash index of the rows already in finaldata.csv, building
+    it from finaldata.csv when the index has not been persisted yet.
+
+    Returns:
+    - A numpy array of uint64 row hashes, or None if there is no
+    finaldata.csv to build it from.
+    """
+    if os.path.exists(row_hashes_path()):
+        return np.load(row_hashes_path())
+    if not dataset_exists(final_data_path()):
+        return None
+    # Hash the stored rows chunk by chunk, so that the corporation strings
+    # of only one chunk are held in memory
+    row_hashes = np.concatenate([np.empty(0, dtype=np.uint64)] + [
+        hash_rows(chunk) for chunk in iter_dataset_chunks(
+            final_data_path(), config.get('ingestion_chunksize') or 100000)])
+    np.save(row_hashes_path(), row_hashes)
+    return row_hashes
+
+
+def parse_source_file(file_path, chunksize=None):
+    """
+    Parse a source csv file, enforcing the dataset columns and dtypes, and
+    hash its rows. Runs in the ingestion worker processes.
+
+    Args:
+    - file_path: Path of the csv file.
+    - chunksize: Optional; Split the file into chunks of this many rows.
+
+    Returns:
+    - A list of (dataframe, row hashes) tuples, one per chunk.
+    """
+    if chunksize:
+        chunks = pd.read_csv(file_path, chunksize=chunksize,
+                             dtype=CSV_DTYPES)
+    else:
+        chunks = [pd.read_csv(file_path, dtype=CSV_DTYPES)]
+    parsed = []
+    for chunk in chunks:
+        chunk = enforce_dtypes(chunk[DATASET_COLUMNS])
+        parsed.append((chunk, hash_rows(chunk)))
+    return parsed
+
+
+def iter_source_chunks(files, chunksize=None):
+    """
+    Parse source csv files, in a process pool when the 'ingestion_workers'
+    setting in config.json is above 1 and at least two files reach the
+    'ingestion_parallel_min_bytes' setting. Smaller files are parsed faster
+    in this process than the workers can pickle their chunks back. Chunks
+    are yielded in file order whatever the worker count, and at most two
+    files per worker are parsed ahead of the consumer.
+
+    Args:
+    - files: The names of the csv files in the input folder, in order.
+    - chunksize: Optional; Split the files into chunks of this many rows.
+
+    Yields:
+    - (dataframe, row hashes) tuples.
+    """
+    file_paths = [os.path.join(input_folder_path(), file) for file in files]
+    workers = config.get('ingestion_workers', 1)
+    min_bytes = config.get('ingestion_parallel_min_bytes', 50000000)
+    large_files = sum(os.path.getsize(file_path) >= min_bytes
+                      for file_path in file_paths)
+    if workers <= 1 or large_files < 2:
+        for file_path in file_paths:
+            yield from parse_source_file(file_path, chunksize)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append(
+                executor.submit(parse_source_file, file_path, chunksize))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def write_ingested_files(files, append=False):
+    """
+    Save the record of ingested files.
+
+    Args:
+    - files: The names of the ingested files.
+    - append: Optional; If True, add the files to the existing record.
+    """
+    with open(ingested_files_path(), 'a' if append else 'w',
+              encoding='utf-8') as file_obj:
+        for file in files:
+            file_obj.write(f"{file}\n")
+
+
+# Functions for rolling back an interrupted incremental ingestion
+
+
+def begin_append():
+    """
+    Record the state of the ingested dataset before new rows are appended
+    to it. A csv dataset is appended to in place, so its size is recorded;
+    a dataset rewritten by the append is kept under a hard link. Until
+    commit_append is called, the next ingestion rolls the append back, so
+    rows written before a crash are not duplicated by the retry.
+    """
+    path = dataset_file(final_data_path())
+    backup_path = path + '.bak'
+    if os.path.exists(backup_path):
+        os.remove(backup_path)
+    if not os.path.exists(path):
+        path = None
+    in_place = path == storage_path(final_data_path()) and \
+        path.endswith('.csv')
+    if path is not None and not in_place:
+        os.link(path, backup_path)
+    journal = {'path': path, 'in_place': in_place,
+               'size': os.path.getsize(path) if path else 0,
+               'ingested_files_size': os.path.getsize(ingested_files_path())
+               if os.path.exists(ingested_files_path()) else 0}
+    tmp_path = append_journal_path() + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as journal_file:
+        json.dump(journal, journal_file)
+    os.replace(tmp_path, append_journal_path())
+
+
+def read_append_journal():
+    """
+    Read the journal of an incremental ingestion in progress.
+
+    Returns:
+    - The journal as a dictionary, or None if no append is in progress.
+    """
+    if not os.path.exists(append_journal_path()):
+        return None
+    with open(append_journal_path(), 'r', encoding='utf-8') as journal_file:
+        return json.load(journal_file)
+
+
+def commit_append():
+    """
+    Mark the append started by begin_append as complete.
+    """
+    journal = read_append_journal()
+    os.remove(append_journal_path())
+    if journal['path'] is not None and not journal['in_place']:
+        os.remove(journal['path'] + '.bak')
+
+
+def rollback_append():
+    """
+    Restore the ingested dataset and the record of ingested files to their
+    state before an append that did not complete, and drop the row-hash
+    index and the profile, which are rebuilt from the restored dataset.
+    """
+    journal = read_append_journal()
+    if journal is None:
+        return
+    path = journal['path']
+    if journal['in_place']:
+        with open(path, 'r+b') as dataset_obj:
+            dataset_obj.truncate(journal['size'])
+    else:
+        if path is not None:
+            os.replace(path + '.bak', path)
+        # Remove the dataset written by the append under another name, or
+        # at all if there was none before
+        for other_path in (storage_path(final_data_path(), 'csv'),
+                           storage_path(final_data_path(), 'parquet')):
+            if other_path != path and os.path.exists(other_path):
+                os.remove(other_path)
+    if os.path.exists(ingested_files_path()):
+        with open(ingested_files_path(), 'r+b') as ingested_obj:
+            ingested_obj.truncate(journal['ingested_files_size'])
+    for derived_path in (row_hashes_path(), profiling.profile_path()):
+        if os.path.exists(derived_path):
+            os.remove(derived_path)
+    os.remove(append_journal_path())
 
 
 # Function for data ingestion
-def merge_multiple_dataframe():
+@instrumented('ingestion')
+def merge_multiple_dataframe(incremental=None, scan=None):
     """
     Merge multiple dataframes into a single dataframe
     and write to an output file.
+
+    Args:
+    - incremental: Optional; If True, only read the files not yet in the
+    ingestion manifest and append their unique rows to finaldata.csv.
+    Files changed since they were ingested always trigger a full rebuild.
+    Defaults to the 'incremental_ingestion' setting in config.json.
+    - scan: Optional; A manifest.ScanResult of the input folder, if already
+    computed.
     """
+    if incremental is None:
+        incremental = config.get('incremental_ingestion', False)
+    # Stream the files in chunks of this many rows when set
+    chunksize = config.get('ingestion_chunksize')
+
     # check for datasets, compile them together, and write to an output file
-    all_files = os.listdir(input_folder_path)
-    csv_files = [file for file in all_files if file.endswith('.csv')]
-    dfs = []
+    scan = scan or manifest.scan_folder(input_folder_path())
+    csv_files = scan.files
+    rollback_append()
 
-    for file in csv_files:
-        file_path = os.path.join(input_folder_path, file)
-        # Read the current file into a DataFrame
-        df = pd.read_csv(file_path)
-        dfs.append(df)
+    if incremental and not scan.changed:
+        row_hashes = load_row_hashes()
+        if row_hashes is not None:
+            begin_append()
+            if chunksize:
+                stream_files(scan.new, RowHashIndex(row_hashes), chunksize,
+                             append=True)
+            else:
+                append_new_files(scan.new, row_hashes)
+            write_ingested_files(scan.new, append=True)
+            # A crash after this point leaves the manifest behind, and the
+            # files are ingested again, but their rows are all known
+            commit_append()
+            manifest.save_manifest(scan.manifest)
+            return
 
-    # Append the data from the current file to the combined DataFrame
-    combined_df = pd.concat(dfs, ignore_index=True)
+    if chunksize:
+        stream_files(csv_files, RowHashIndex(), chunksize)
+    else:
+        # Read the files into DataFrames
+        dfs = [df for df, _ in iter_source_chunks(csv_files)]
 
-    # Remove duplicate rows
-    combined_df.drop_duplicates(inplace=True)
+        # Append the data from the current file to the combined DataFrame
+        combined_df = pd.concat(dfs, ignore_index=True)
 
-    # Write the combined and de-duplicated DataFrame to a csv file
-    combined_df.to_csv(
-        os.path.join(output_folder_path, 'finaldata.csv'), index=False
-    )
+        # Remove duplicate rows
+        combined_df.drop_duplicates(inplace=True)
+
+        # Write the combined and de-duplicated DataFrame in the configured
+        # storage format
+        write_dataset(combined_df, final_data_path())
+        write_dataset(combined_df, new_rows_path())
+        remove_superseded(final_data_path())
+        remove_superseded(new_rows_path())
+        record_rows(len(combined_df))
+        np.save(row_hashes_path(), hash_rows(combined_df))
+        profile = profiling.DatasetProfile()
+        profile.update(combined_df)
+        profiling.save_profile(profile)
 
     # Save the record of ingested files
-    with open(
-            os.path.join(output_folder_path, 'ingestedfiles.txt'), 'w',
-            encoding='utf-8') as file_obj:
-        for file in csv_files:
-            file_obj.write(f"{file}\n")
+    write_ingested_files(csv_files)
+    manifest.save_manifest(scan.manifest)
+
+
+def append_new_files(new_files, row_hashes):
+    """
+    Append the unique rows of the files not yet ingested to finaldata.csv.
+
+    Args:
+    - new_files: The names of the csv files not yet ingested.
+    - row_hashes: The row-hash index of the rows already in finaldata.csv.
+    """
+    if not new_files:
+        # Leave no rows of the previous ingestion to be checked for drift
+        DatasetWriter(new_rows_path()).close()
+        return
+
+    parsed = list(iter_source_chunks(new_files))
+    new_df = pd.concat([df for df, _ in parsed], ignore_index=True)
+
+    # Keep only rows that are unique within the new files and not yet
+    # present in finaldata.csv
+    row_index = RowHashIndex(row_hashes)
+    unique = row_index.add_unseen(
+        np.concatenate([hashes for _, hashes in parsed]))
+    new_df = new_df[unique]
+    record_rows(len(new_df))
+
+    profile = profiling.current_profile(final_data_path())
+    writer = DatasetWriter(final_data_path(), append=True)
+    writer.write(new_df)
+    writer.close()
+    write_dataset(new_df, new_rows_path())
+    remove_superseded(new_rows_path())
+    np.save(row_hashes_path(), row_index.to_array())
+    profile.update(new_df)
+    profiling.save_profile(profile)
+
+
+def stream_files(files, row_index, chunksize, append=False):
+    """
+    Stream csv files into finaldata.csv chunk by chunk, enforcing the
+    dataset columns and dtypes and dropping rows already in the row index.
+    The cached dataset profile is updated with each chunk written, and the
+    rows written are also kept in newrows.csv, which is left empty when no
+    rows are new.
+    Peak memory is bounded by the chunk size plus 8 bytes per unique row,
+    or by two files per worker when the files are parsed in parallel.
+
+    Args:
+    - files: The names of the csv files to ingest, in order.
+    - row_index: The RowHashIndex of the rows already written.
+    - chunksize: The number of rows read at a time.
+    - append: Optional; If True, keep the rows already in finaldata.csv.
+    """
+    if append:
+        profile = profiling.current_profile(final_data_path())
+    else:
+        profile = profiling.DatasetProfile()
+    writer = DatasetWriter(final_data_path(), append=append,
+                           chunksize=chunksize)
+    new_rows_writer = DatasetWriter(new_rows_path(), chunksize=chunksize)
+    rows_before = writer.rows
+    for chunk, hashes in iter_source_chunks(files, chunksize):
+        chunk = chunk[row_index.add_unseen(hashes)]
+        writer.write(chunk)
+        new_rows_writer.write(chunk)
+        profile.update(chunk)
+    writer.close()
+    new_rows_writer.close()
+    record_rows(writer.rows - rows_before)
+    np.save(row_hashes_path(), row_index.to_array())
+    profiling.save_profile(profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+"""
+This module instruments the pipeline stages. Each call of an instrumented
+stage records its duration, peak traced memory and row count as one
+structured record in a local metrics file, so diagnostics can report real
+stage timings without re-running them.
+"""
+
+import os
+import json
+import time
+import uuid
+import cProfile
+import functools
+import threading
+import tracemalloc
+from collections import deque
+from config import config
+
+_context = threading.local()
+_write_lock = threading.Lock()
+_run_id = None
+_execution_times = None
+
+
+def stage_metrics_path():
+    """
+    Get the path of the stage metrics file.
+
+    Returns:
+    - The path of stagemetrics.jsonl in the output model folder.
+    """
+    return config.path('output_model_path', 'stagemetrics.jsonl')
+
+
+def start_run():
+    """
+    Start a new pipeline run in the calling thread, so the stages it calls
+    from now on are recorded under one run id.
+
+    Returns:
+    - The new run id.
+    """
+    global _run_id
+    _run_id = uuid.uuid4().hex
+    _context.run_id = _run_id
+    return _run_id
+
+
+def end_run():
+    """
+    End the pipeline run of the calling thread, so the stages it calls from
+    now on are no longer recorded.
+    """
+    _context.run_id = None
+
+
+def current_run():
+    """
+    Get the id of the latest pipeline run.
+
+    Returns:
+    - The run id, or None if no run was started.
+    """
+    return _run_id
+
+
+def record_rows(rows):
+    """
+    Record the number of rows processed by the stage currently running.
+    Ignored outside the instrumented stages of a pipeline run.
+
+    Args:
+    - rows: The number of rows.
+    """
+    if getattr(_context, 'stages', None):
+        _context.stages[-1]['rows'] = int(rows)
+
+
+def stage_metrics_files():
+    """
+    Get the paths of the stage metrics files.
+
+    Returns:
+    - The paths of the rotated and the current metrics file, oldest first.
+    """
+    metrics_path = stage_metrics_path()
+    return [metrics_path + '.1', metrics_path]
+
+
+def write_stage_metrics(record):
+    """
+    Append one stage record to the metrics file.
+
+    Args:
+    - record: A dictionary describing the stage call.
+    """
+    metrics_path = stage_metrics_path()
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    max_bytes = config.get('stage_metrics_max_bytes', 1000000)
+    with _write_lock:
+        if max_bytes and os.path.exists(metrics_path) and \
+                os.path.getsize(metrics_path) >= max_bytes:
+            os.replace(metrics_path, metrics_path + '.1')
+        with open(metrics_path, 'a', encoding='utf-8') as metrics_file:
+            metrics_file.write(json.dumps(record) + '\n')
+
+
+def read_stage_metrics(limit=None):
+    """
+    Read the most recent stage records.
+
+    Args:
+    - limit: Optional; The maximum number of records to return.
+    Defaults to all of them.
+
+    Returns:
+    - A list of stage records, oldest first.
+    """
+    lines = deque(maxlen=limit)
+    for metrics_path in stage_metrics_files():
+        if os.path.exists(metrics_path):
+            with open(metrics_path, 'r', encoding='utf-8') as metrics_file:
+                lines.extend(metrics_file)
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def read_execution_times():
+    """
+    Read the latest record of each stage. The result is cached until the
+    metrics files change.
+
+    Returns:
+    - A dictionary mapping each stage name to its latest record.
+    """
+    global _execution_times
+    key = tuple(
+        (os.stat(path).st_mtime_ns, os.stat(path).st_size)
+        if os.path.exists(path) else None for path in stage_metrics_files())
+    if _execution_times is None or _execution_times[0] != key:
+        _execution_times = (key, {record['stage']: record
+                                  for record in read_stage_metrics()})
+    return _execution_times[1]
+
+
+def instrumented(stage):
+    """
+    Decorator recording the duration, peak traced memory and row count of
+    every call of a stage function within a pipeline run. The peak of a
+    stage includes the peaks of the stages it calls. The stage named by the
+    'profile_stage' setting in config.json is also profiled with cProfile.
+
+    Args:
+    - stage: The stage name to record the metrics under.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_context, 'run_id', None) is None:
+                return func(*args, **kwargs)
+            if not hasattr(_context, 'stages'):
+                _context.stages = []
+            stages = _context.stages
+            trace_memory = config.get('trace_memory', True)
+            profile_stage = config.get('profile_stage')
+            started_tracing = False
+            if trace_memory:
+                if stages:
+                    # Keep the peak of the calling stage so far before
+                    # resetting it for this nested stage
+                    stages[-1]['peak'] = max(
+                        stages[-1]['peak'], tracemalloc.get_traced_memory()[1])
+                    tracemalloc.reset_peak()
+                elif tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+                else:
+                    tracemalloc.start()
+                    started_tracing = True
+            stages.append({'rows': None, 'peak': 0})
+            profiler = cProfile.Profile() if stage == profile_stage else None
+
+            started_at = time.time()
+            start_time = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start_time
+                if profiler:
+                    profiler.disable()
+                    profiler.dump_stats(config.path(
+                        'output_model_path', f'profile_{stage}.prof'))
+                current = stages.pop()
+                peak_memory = None
+                if trace_memory:
+                    peak_memory = max(current['peak'],
+                                      tracemalloc.get_traced_memory()[1])
+                    if stages:
+                        stages[-1]['peak'] = max(stages[-1]['peak'],
+                                                 peak_memory)
+                    if started_tracing:
+                        tracemalloc.stop()
+                write_stage_metrics({
+                    'run_id': _context.run_id,
+                    'stage': stage,
+                    'started_at': started_at,
+                    'seconds': seconds,
+                    'peak_memory_bytes': peak_memory,
+                    'rows': current['rows']
+                })
+        return wrapper
+    return decorator
@@ -0,0 +1,143 @@
+"""
+This module keeps a manifest of the ingested source files, recording the
+size, mtime and content hash of each one, to detect new and changed files
+without re-reading unchanged ones.
+"""
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+from config import config
+
+HASH_CHUNK_SIZE = 1 << 20
+
+ScanResult = namedtuple('ScanResult',
+                        ['files', 'new', 'changed', 'manifest'])
+
+
+def manifest_path():
+    """
+    Get the path of the ingestion manifest.
+
+    Returns:
+    - The path of ingestedmanifest.json in the output folder.
+    """
+    return config.path('output_folder_path', 'ingestedmanifest.json')
+
+
+def file_hash(file_path):
+    """
+    Compute the SHA-256 of a file, reading it in chunks.
+
+    Args:
+    - file_path: Path of the file to hash.
+
+    Returns:
+    - The hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_entry(file_path, stat=None):
+    """
+    Build the manifest entry of a file.
+
+    Args:
+    - file_path: Path of the file.
+    - stat: Optional; The os.stat_result of the file, if already known.
+
+    Returns:
+    - A dictionary with the size, mtime and content hash of the file.
+    """
+    stat = stat or os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_hash(file_path)}
+
+
+def load_manifest():
+    """
+    Load the ingestion manifest. If it does not exist yet, it is bootstrapped
+    and saved from the files listed in ingestedfiles.txt, assuming they are
+    unchanged.
+
+    Returns:
+    - A dictionary mapping each ingested file name to its entry.
+    """
+    if os.path.exists(manifest_path()):
+        with open(manifest_path(), 'r', encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+
+    manifest = {}
+    ingested_files_path = config.path(
+        'output_folder_path', 'ingestedfiles.txt')
+    if os.path.exists(ingested_files_path):
+        with open(ingested_files_path, 'r', encoding='utf-8') as file_obj:
+            ingested_files = file_obj.read().splitlines()
+        for file in ingested_files:
+            file_path = config.path('input_folder_path', file)
+            if os.path.exists(file_path):
+                manifest[file] = file_entry(file_path)
+        save_manifest(manifest)
+    return manifest
+
+
+def save_manifest(manifest):
+    """
+    Atomically write the ingestion manifest.
+
+    Args:
+    - manifest: A dictionary mapping each ingested file name to its entry.
+    """
+    tmp_path = manifest_path() + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, manifest_path())
+
+
+def scan_folder(folder_path=None, manifest=None):
+    """
+    Compare the csv files of a folder with the manifest. Only files whose
+    size or mtime differ from their entry are hashed.
+
+    Args:
+    - folder_path: Optional; The folder to scan. Defaults to the input
+    folder.
+    - manifest: Optional; The manifest to compare with. Defaults to the
+    saved manifest.
+
+    Returns:
+    - A ScanResult with the sorted lists of all, new and changed csv file
+    names, and the manifest of the files currently in the folder.
+    """
+    folder_path = folder_path or config.path('input_folder_path')
+    manifest = load_manifest() if manifest is None else manifest
+    updated = {}
+    files = []
+    new_files = []
+    changed_files = []
+
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.csv') or not entry.is_file():
+                continue
+            files.append(entry.name)
+            stat = entry.stat()
+            known = manifest.get(entry.name)
+            if known is not None and known['size'] == stat.st_size \
+                    and known['mtime_ns'] == stat.st_mtime_ns:
+                updated[entry.name] = known
+                continue
+            current = file_entry(entry.path, stat)
+            updated[entry.name] = current
+            if known is None:
+                new_files.append(entry.name)
+            elif known['sha256'] != current['sha256']:
+                changed_files.append(entry.name)
+
+    return ScanResult(sorted(files), sorted(new_files), sorted(changed_files),
+                      updated)
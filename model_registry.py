@@ -0,0 +1,171 @@
+"""
+This module contains an in-process registry that keeps the deployed model
+in memory and hot-reloads it when the model file changes on disk.
+"""
+
+import os
+import pickle
+import hashlib
+import warnings
+import threading
+from compact_model import compact_model_path, loads_compact_model
+from config import config
+
+# Pickled models are fitted on a DataFrame but scored on float32 arrays whose
+# columns are already in FEATURE_COLUMNS order
+warnings.filterwarnings(
+    'ignore', message='X does not have valid feature names')
+
+
+class ModelRegistry:
+    """
+    Keeps a loaded model in memory, keyed by the model file's
+    mtime and size. A changed file is re-read and its content hash compared
+    so that a touched but unchanged file does not trigger a reload.
+    """
+
+    def __init__(self, model_path, loader=pickle.loads):
+        self.model_path = model_path
+        self.loader = loader
+        self.hits = 0
+        self.reloads = 0
+        self._lock = threading.Lock()
+        # (file signature, content hash, model), swapped in as one object
+        self._state = (None, None, None)
+
+    def _file_signature(self):
+        stat = os.stat(self.model_path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get_model(self):
+        """
+        Get the model, reloading it only if the model file has changed.
+
+        Returns:
+        - The loaded model.
+        """
+        signature = self._file_signature()
+        cached_signature, _, model = self._state
+        if model is not None and cached_signature == signature:
+            self.hits += 1
+            return model
+
+        with self._lock:
+            cached_signature, content_hash, model = self._state
+            if model is not None and cached_signature == signature:
+                self.hits += 1
+                return model
+            with open(self.model_path, 'rb') as model_file:
+                model_bytes = model_file.read()
+            new_hash = hashlib.sha256(model_bytes).hexdigest()
+            if model is not None and new_hash == content_hash:
+                self.hits += 1
+            else:
+                model = self.loader(model_bytes)
+                self.reloads += 1
+            self._state = (signature, new_hash, model)
+            return model
+
+    def invalidate(self):
+        """
+        Force the next get_model() call to check the model file contents.
+        """
+        with self._lock:
+            _, content_hash, model = self._state
+            self._state = (None, content_hash, model)
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns:
+        - A dictionary with the model path, content hash, cache hits
+        and reloads.
+        """
+        _, content_hash, _ = self._state
+        return {
+            'model_path': self.model_path,
+            'content_hash': content_hash,
+            'hits': self.hits,
+            'reloads': self.reloads
+        }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def deployed_model_path():
+    """
+    Get the path of the deployed pickled model.
+
+    Returns:
+    - The path of trainedmodel.pkl in the production deployment directory.
+    """
+    return config.path('prod_deployment_path', 'trainedmodel.pkl')
+
+
+def get_registry(model_path=None):
+    """
+    Get the shared registry for a model file.
+
+    Args:
+    - model_path: Optional; Path to the model file. Defaults to the
+    deployed model.
+
+    Returns:
+    - The ModelRegistry for the model file.
+    """
+    model_path = model_path or deployed_model_path()
+    with _registries_lock:
+        if model_path not in _registries:
+            loader = pickle.loads
+            if model_path.endswith('.json'):
+                loader = loads_compact_model
+            _registries[model_path] = ModelRegistry(model_path, loader)
+        return _registries[model_path]
+
+
+def get_model(model_path=None):
+    """
+    Get a model from its shared registry.
+
+    Args:
+    - model_path: Optional; Path to the model file. Defaults to the
+    deployed model.
+
+    Returns:
+    - The loaded model.
+    """
+    return get_registry(model_path).get_model()
+
+
+def stats():
+    """
+    Get the cache counters of every registry in use.
+
+    Returns:
+    - A list of dictionaries, one per model file.
+    """
+    with _registries_lock:
+        registries = list(_registries.values())
+    return [registry.stats() for registry in registries]
+
+
+def get_inference_model(model_path=None):
+    """
+    Get the model to score with: the compact model stored next to the
+    pickled model if it exists, otherwise the pickled model.
+
+    Args:
+    - model_path: Optional; Path to the pickled model file. Defaults to the
+    deployed model.
+
+    Returns:
+    - A CompactModel or the unpickled model.
+    """
+    model_path = model_path or deployed_model_path()
+    compact_path = compact_model_path(model_path)
+    if os.path.exists(compact_path):
+        return get_model(compact_path)
+    return get_model(model_path)
@@ -0,0 +1,591 @@
+"""
+This module runs the monitoring pipeline as a graph of stages, like a local
+build system.
+
+Each stage declares the files it reads and writes and the config.json
+settings it depends on. The key of a stage is the hash of its name, its
+settings and the contents of its inputs. A stage is skipped when its key
+and its outputs match its last run. For deterministic stages, the outputs
+of every key are also kept in a content-addressed cache under
+models/pipelinecache, so a key seen before is restored instead of being
+recomputed. Re-running the pipeline after a failure, or after changing a
+setting, only runs the stages that are out of date.
+
+Usage:
+    python pipeline.py              Run the stages that are out of date
+    python pipeline.py --dry-run    Show which stages would run, and why
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import hashlib
+import importlib
+import urllib.parse
+import instrumentation
+from manifest import file_hash
+from config import config, PROJECT_DIR
+
+
+# Functions for the pipeline paths
+
+
+def cache_path(*parts):
+    """
+    Get a path in the pipeline cache.
+
+    Args:
+    - parts: Optional; Path components to join to the cache folder.
+
+    Returns:
+    - The path in models/pipelinecache.
+    """
+    return config.path('output_model_path', 'pipelinecache', *parts)
+
+
+def relative(path):
+    """
+    Get a path relative to the project directory, as used in the cache.
+    """
+    return os.path.relpath(path, PROJECT_DIR)
+
+
+def dataset_files(csv_path):
+    """
+    Get the paths of a dataset in every storage format.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+
+    Returns:
+    - A list of the csv and parquet paths.
+    """
+    stem = os.path.splitext(csv_path)[0]
+    return [stem + '.csv', stem + '.parquet']
+
+
+def model_file(name):
+    """
+    Get the path of a file in the output model folder.
+    """
+    return config.path('output_model_path', name)
+
+
+def prod_file(name):
+    """
+    Get the path of a file in the production deployment folder.
+    """
+    return config.path('prod_deployment_path', name)
+
+
+def ingested_file(name):
+    """
+    Get the path of a file in the ingested data folder.
+    """
+    return config.path('output_folder_path', name)
+
+
+def source_files():
+    """
+    Get the paths of the source csv files.
+    """
+    folder_path = config.path('input_folder_path')
+    return [os.path.join(folder_path, name)
+            for name in sorted(os.listdir(folder_path))
+            if name.endswith('.csv')]
+
+
+# Functions for the stage conditions
+
+
+def read_json(path):
+    """
+    Read a json file.
+
+    Args:
+    - path: The path of the file.
+
+    Returns:
+    - The decoded contents, or None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def drift_detected():
+    """
+    Check the drift decision written by the drift stage.
+    """
+    report = read_json(model_file('driftreport.json'))
+    return bool(report and report['drift'])
+
+
+def challenger_promoted():
+    """
+    Check that model drift was found and the re-trained model beat the
+    deployed one in the evaluation written by the score stage.
+    """
+    evaluation = read_json(model_file('challenger.json'))
+    return drift_detected() and bool(evaluation and evaluation['promoted'])
+
+
+def api_reachable():
+    """
+    Check that the API server at the 'api_url' setting in config.json
+    accepts connections, so that the apicalls stage can call it.
+    """
+    url = urllib.parse.urlsplit(config.get('api_url', 'http://127.0.0.1:8000'))
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    try:
+        with socket.create_connection((url.hostname, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+# Stages
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Args:
+    - name: The stage name.
+    - action: The function running the stage, as 'module:function'. The
+    module is imported when the stage runs.
+    - inputs: A function returning the paths the stage reads.
+    - outputs: A function returning the paths the stage writes.
+    - params: Optional; The config.json settings the stage depends on.
+    - when: Optional; A tuple of a function returning whether the stage
+    should run at all, and the description of the condition.
+    - restorable: Optional; If True, the outputs are deterministic and are
+    restored from the cache for a key seen before.
+    - check_outputs: Optional; If False, the stage is up to date as long as
+    its key is unchanged, even if its outputs were changed since, e.g. by a
+    rollback of the deployment.
+    """
+
+    def __init__(self, name, action, inputs, outputs, params=(), when=None,
+                 restorable=False, check_outputs=True):
+        self.name = name
+        self.action = action
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.when = when
+        self.restorable = restorable
+        self.check_outputs = check_outputs
+
+    def run(self):
+        """
+        Import the module of the stage and call its function.
+        """
+        module_name, function_name = self.action.split(':')
+        getattr(importlib.import_module(module_name), function_name)()
+
+
+def trained_model_files(folder):
+    """
+    Get the paths of the artifacts written by training.
+
+    Args:
+    - folder: model_file or prod_file.
+
+    Returns:
+    - A list of paths.
+    """
+    return [folder(name) for name in (
+        'trainedmodel.pkl', 'trainedmodel.json', 'trainingstate.json',
+        'driftreference.json', 'modelselection.json')]
+
+
+def test_data_file():
+    """
+    Get the path of the test dataset.
+    """
+    return config.path('test_data_path', 'testdata.csv')
+
+
+STAGES = [
+    # Profiling is done by ingestion, in the same pass over the new rows
+    Stage('ingest', 'ingestion:merge_multiple_dataframe',
+          inputs=source_files,
+          outputs=lambda: (
+              dataset_files(ingested_file('finaldata.csv'))
+              + dataset_files(ingested_file('newrows.csv'))
+              + [ingested_file(name) for name in (
+                  'ingestedfiles.txt', 'profile.json', 'rowhashes.npy')]),
+          params=('incremental_ingestion', 'storage_format',
+                  'ingestion_chunksize', 'profile_exact_limit')),
+    # Drift, training and scoring start from the model deployed when the new
+    # rows arrived, so a deployment by this run doesn't make them out of
+    # date; otherwise the same rows would be trained on twice. As their keys
+    # leave out the deployed model, training and scoring are not restored
+    # from the cache: after a rollback, a cached model could be built on
+    # another base model, and a cached verdict compared with another champion
+    Stage('drift', 'drift:check_model_drift',
+          inputs=lambda: (
+              dataset_files(ingested_file('finaldata.csv'))
+              + dataset_files(ingested_file('newrows.csv'))),
+          outputs=lambda: [model_file('driftreport.json')],
+          params=('drift_psi_threshold', 'drift_ks_alpha',
+                  'drift_min_rows', 'drift_confirm_f1')),
+    Stage('train', 'training:train_model',
+          inputs=lambda: (
+              dataset_files(ingested_file('finaldata.csv'))
+              + dataset_files(ingested_file('newrows.csv'))
+              + [ingested_file('profile.json')]),
+          outputs=lambda: trained_model_files(model_file),
+          params=('incremental_training', 'full_refit_every',
+                  'model_selection', 'hyperparameter_grid', 'cv_folds'),
+          when=(drift_detected, 'model drift is found')),
+    Stage('score', 'scoring:evaluate_challenger',
+          inputs=lambda: (
+              trained_model_files(model_file)[:2]
+              + dataset_files(test_data_file())
+              + dataset_files(ingested_file('newrows.csv'))),
+          outputs=lambda: [model_file('latestscore.txt'),
+                           model_file('challenger.json')],
+          params=('promotion_margin',),
+          when=(drift_detected, 'model drift is found')),
+    # A rollback changes the deployed files, and must not be undone by
+    # deploying the same model again
+    Stage('deploy', 'deployment:store_model_into_pickle',
+          inputs=lambda: (trained_model_files(model_file)
+                          + [model_file('latestscore.txt')]),
+          outputs=lambda: (trained_model_files(prod_file)
+                           + [prod_file('latestscore.txt')]),
+          when=(challenger_promoted, 'the re-trained model is promoted'),
+          check_outputs=False),
+    Stage('apicalls', 'apicalls:run_apicalls',
+          inputs=lambda: (
+              trained_model_files(prod_file)[:2]
+              + dataset_files(test_data_file())
+              + dataset_files(ingested_file('finaldata.csv'))),
+          outputs=lambda: [model_file('apireturns.txt')],
+          # Without a running server the stage is skipped, so the run still
+          # completes, and it runs in the next run once the server is up
+          when=(lambda: challenger_promoted() and api_reachable(),
+                'the re-trained model is promoted and the API is reachable')),
+    Stage('report', 'reporting:score_model',
+          inputs=lambda: (trained_model_files(prod_file)[:2]
+                          + dataset_files(test_data_file())),
+          outputs=lambda: [model_file('confusionmatrix2.png')],
+          when=(challenger_promoted, 'the re-trained model is promoted'),
+          restorable=True)
+]
+
+
+# Cache of file hashes, stage records and stage outputs
+
+
+class PipelineCache:
+    """
+    The pipeline state and the content-addressed cache of stage outputs.
+    File hashes are kept by path, size, mtime and inode, so unchanged
+    files are not read again.
+    """
+
+    def __init__(self):
+        self.hashes = read_json(cache_path('filehashes.json')) or {}
+        self.state = read_json(cache_path('state.json')) or {
+            'complete': True, 'stages': {}}
+
+    def file_hash(self, path):
+        """
+        Get the content hash of a file.
+
+        Args:
+        - path: The path of the file.
+
+        Returns:
+        - The sha256 hex digest, or None if the file does not exist.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        known = self.hashes.get(relative(path))
+        if known is not None and known[:3] == signature:
+            return known[3]
+        digest = file_hash(path)
+        self.hashes[relative(path)] = signature + [digest]
+        return digest
+
+    def file_hashes(self, paths):
+        """
+        Get the content hashes of files, keyed by their relative path.
+        """
+        return {relative(path): self.file_hash(path) for path in paths}
+
+    def record(self, stage_name):
+        """
+        Get the record of the last run of a stage, or None.
+        """
+        return self.state['stages'].get(stage_name)
+
+    def save_record(self, stage_name, record):
+        """
+        Record the run of a stage.
+        """
+        self.state['stages'][stage_name] = record
+        self.save()
+
+    def set_complete(self, complete):
+        """
+        Record whether the last pipeline run completed.
+        """
+        self.state['complete'] = complete
+        self.save()
+
+    def save(self):
+        """
+        Atomically write the pipeline state and the file hashes.
+        """
+        os.makedirs(cache_path(), exist_ok=True)
+        for name, values in (('state.json', self.state),
+                             ('filehashes.json', self.hashes)):
+            tmp_path = cache_path(name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as json_file:
+                json.dump(values, json_file, indent=4)
+            os.replace(tmp_path, cache_path(name))
+
+    def action_path(self, stage_name, key):
+        """
+        Get the path of the cached outputs of a stage key.
+        """
+        return cache_path('actions', f'{stage_name}-{key}.json')
+
+    def cached_outputs(self, stage_name, key):
+        """
+        Get the cached output hashes of a stage key.
+
+        Returns:
+        - A dictionary mapping each output to its hash, or None if the key
+        is not cached.
+        """
+        outputs = read_json(self.action_path(stage_name, key))
+        if outputs is None or not all(
+                os.path.exists(cache_path('objects', digest))
+                for digest in outputs.values() if digest is not None):
+            return None
+        return outputs
+
+    def store_outputs(self, stage_name, key, outputs):
+        """
+        Copy the outputs of a stage into the cache.
+
+        Args:
+        - stage_name: The stage name.
+        - key: The stage key.
+        - outputs: A dictionary mapping each output to its hash.
+        """
+        os.makedirs(cache_path('objects'), exist_ok=True)
+        os.makedirs(cache_path('actions'), exist_ok=True)
+        for path, digest in outputs.items():
+            object_path = cache_path('objects', digest or '')
+            if digest is not None and not os.path.exists(object_path):
+                copy_atomic(os.path.join(PROJECT_DIR, path), object_path)
+        tmp_path = self.action_path(stage_name, key) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as action_file:
+            json.dump(outputs, action_file, indent=4)
+        os.replace(tmp_path, self.action_path(stage_name, key))
+        self.prune(stage_name)
+
+    def restore_outputs(self, outputs):
+        """
+        Restore the outputs of a stage from the cache, removing the outputs
+        the stage did not write.
+
+        Args:
+        - outputs: A dictionary mapping each output to its hash.
+        """
+        for path, digest in outputs.items():
+            path = os.path.join(PROJECT_DIR, path)
+            if digest is None:
+                if os.path.lexists(path):
+                    os.remove(path)
+            elif self.file_hash(path) != digest:
+                copy_atomic(cache_path('objects', digest), path)
+
+    def prune(self, stage_name):
+        """
+        Keep the cached outputs of the most recent keys of a stage, set by
+        'pipeline_cache_entries' in config.json, and delete the objects no
+        longer referenced.
+        """
+        keep = config.get('pipeline_cache_entries', 5)
+        actions = sorted(
+            (entry for entry in os.scandir(cache_path('actions'))
+             if entry.name.startswith(f'{stage_name}-')
+             and entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for entry in actions[keep:]:
+            os.remove(entry.path)
+
+        referenced = set()
+        for entry in os.scandir(cache_path('actions')):
+            if entry.name.endswith('.json'):
+                referenced.update(read_json(entry.path).values())
+        for entry in os.scandir(cache_path('objects')):
+            if entry.name not in referenced:
+                os.remove(entry.path)
+
+
+def copy_atomic(source, destination):
+    """
+    Copy a file through a temporary file renamed into place.
+    """
+    tmp_path = destination + '.tmp'
+    try:
+        shutil.copyfile(source, tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Functions for planning and running the stages
+
+
+def stage_key(stage, inputs, params):
+    """
+    Compute the key of a stage from its settings and input hashes.
+    """
+    return hashlib.sha256(json.dumps(
+        {'stage': stage.name, 'params': params, 'inputs': inputs},
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def changes(record, inputs, params):
+    """
+    Describe why a stage is out of date compared with its last run.
+
+    Returns:
+    - A list of reasons.
+    """
+    if record is None:
+        return ['never run']
+    reasons = [f"input changed: {path}" for path in sorted(inputs)
+               if record['inputs'].get(path) != inputs[path]]
+    reasons += [f"setting changed: {name}" for name in sorted(params)
+                if record['params'].get(name) != params[name]]
+    return reasons or ['stage definition changed']
+
+
+def plan_stage(stage, cache, upstream):
+    """
+    Decide what to do with a stage.
+
+    Args:
+    - stage: The Stage.
+    - cache: The PipelineCache.
+    - upstream: A dictionary mapping the outputs of the earlier stages that
+    would run in a dry run to their stage names.
+
+    Returns:
+    - A dictionary with the action ('skip', 'restore' or 'run'), the
+    reasons, and the key, input and setting values of the stage.
+    """
+    waiting = sorted({upstream[path] for path in stage.inputs()
+                      if path in upstream})
+    if waiting:
+        reasons = [f"inputs written by {', '.join(waiting)}"]
+        if stage.when is not None:
+            reasons.append(f"if {stage.when[1]}")
+        return {'action': 'run', 'reasons': reasons}
+    if stage.when is not None and not stage.when[0]():
+        return {'action': 'skip', 'reasons': [f"unless {stage.when[1]}"]}
+
+    inputs = cache.file_hashes(stage.inputs())
+    params = {name: config.get(name) for name in stage.params}
+    key = stage_key(stage, inputs, params)
+    record = cache.record(stage.name)
+    plan = {'key': key, 'inputs': inputs, 'params': params}
+    if record is not None and record['key'] == key:
+        if not stage.check_outputs or \
+                cache.file_hashes(stage.outputs()) == record['outputs']:
+            return {**plan, 'action': 'skip', 'reasons': ['up to date']}
+        reasons = ['outputs changed since the last run']
+    else:
+        reasons = changes(record, inputs, params)
+    if stage.restorable and cache.cached_outputs(stage.name, key):
+        return {**plan, 'action': 'restore', 'reasons': reasons}
+    return {**plan, 'action': 'run', 'reasons': reasons}
+
+
+def run(dry_run=False, stages=None):
+    """
+    Run the stages that are out of date, in order.
+
+    Args:
+    - dry_run: Optional; If True, only print which stages would run and
+    why, without running them.
+    - stages: Optional; The stages to run. Defaults to STAGES.
+
+    Returns:
+    - A list of (stage name, action, reasons) tuples.
+    """
+    stages = stages or STAGES
+    cache = PipelineCache()
+    upstream = {}
+    results = []
+    if not dry_run:
+        # Group the stage metrics of this run under one run id
+        instrumentation.start_run()
+        cache.set_complete(False)
+
+    try:
+        for stage in stages:
+            plan = plan_stage(stage, cache, upstream)
+            results.append((stage.name, plan['action'], plan['reasons']))
+            print(f"{stage.name}: {plan['action']} "
+                  f"({'; '.join(plan['reasons'])})")
+            if plan['action'] == 'skip':
+                continue
+            if dry_run:
+                upstream.update({path: stage.name for path in stage.outputs()})
+                continue
+
+            started = time.perf_counter()
+            if plan['action'] == 'restore':
+                outputs = cache.cached_outputs(stage.name, plan['key'])
+                cache.restore_outputs(outputs)
+            else:
+                stage.run()
+                outputs = cache.file_hashes(stage.outputs())
+                if stage.restorable:
+                    cache.store_outputs(stage.name, plan['key'], outputs)
+            cache.save_record(stage.name, {
+                'key': plan['key'], 'inputs': plan['inputs'],
+                'params': plan['params'], 'outputs': outputs,
+                'action': plan['action'], 'finished_at': time.time(),
+                'seconds': time.perf_counter() - started})
+    finally:
+        if not dry_run:
+            instrumentation.end_run()
+
+    if not dry_run:
+        cache.set_complete(True)
+    return results
+
+
+def is_complete():
+    """
+    Check whether the last pipeline run completed, so that an interrupted
+    run is resumed even without new data.
+    """
+    state = read_json(cache_path('state.json'))
+    return state is None or state['complete']
+
+
+if __name__ == '__main__':
+    run(dry_run='--dry-run' in sys.argv[1:])
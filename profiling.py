@@ -0,0 +1,412 @@
+"""
+This module computes a profile of the ingested dataset in a single pass:
+row and NA counts, mean, standard deviation, min, max and quantiles of each
+numeric column. Profiles are mergeable, so the profile can be updated
+incrementally as new rows are ingested and cached next to finaldata.csv.
+"""
+
+import os
+import json
+import math
+import numpy as np
+from config import config
+from datastore import COLUMN_DTYPES, dataset_exists, iter_dataset_chunks
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative accuracy alpha, counting values
+    in logarithmically sized buckets (as in DDSketch).
+    """
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+    def _add_buckets(self, buckets, values):
+        keys, counts = np.unique(
+            np.ceil(np.log(values) / math.log(self.gamma)).astype(np.int64),
+            return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            buckets[key] = buckets.get(key, 0) + count
+
+    def add(self, values):
+        """
+        Add values to the sketch.
+
+        Args:
+        - values: A numpy array of values without NAs.
+        """
+        self._add_buckets(self.positive, values[values > 0])
+        self._add_buckets(self.negative, -values[values < 0])
+        self.zero += int(np.count_nonzero(values == 0))
+
+    def merge(self, other):
+        """
+        Merge another sketch with the same alpha into this one.
+
+        Args:
+        - other: The QuantileSketch to merge.
+        """
+        for buckets, other_buckets in ((self.positive, other.positive),
+                                       (self.negative, other.negative)):
+            for key, count in other_buckets.items():
+                buckets[key] = buckets.get(key, 0) + count
+        self.zero += other.zero
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile.
+
+        Args:
+        - q: The quantile, between 0 and 1.
+
+        Returns:
+        - The estimated value, or None if the sketch is empty.
+        """
+        count = sum(self.positive.values()) + sum(self.negative.values()) \
+            + self.zero
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def to_dict(self):
+        """
+        Serialize the sketch.
+        """
+        return {'alpha': self.alpha, 'zero': self.zero,
+                'positive': {str(k): v for k, v in self.positive.items()},
+                'negative': {str(k): v for k, v in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Deserialize a sketch.
+        """
+        sketch = cls(state['alpha'])
+        sketch.zero = state['zero']
+        sketch.positive = {int(k): v for k, v in state['positive'].items()}
+        sketch.negative = {int(k): v for k, v in state['negative'].items()}
+        return sketch
+
+
+class ColumnProfile:
+    """
+    Single-pass statistics of one column. Moments are merged with Chan's
+    parallel algorithm. Quantiles are exact while the column holds at most
+    exact_limit values, and estimated by a QuantileSketch beyond that.
+    """
+
+    def __init__(self, numeric, exact_limit=10000):
+        self.numeric = numeric
+        self.exact_limit = exact_limit
+        self.count = 0
+        self.na_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.values = []
+        self.sketch = None
+
+    def update(self, column):
+        """
+        Add the values of a column chunk.
+
+        Args:
+        - column: A pandas Series.
+        """
+        na_mask = column.isna().to_numpy()
+        self.na_count += int(na_mask.sum())
+        if not self.numeric:
+            self.count += int(len(column) - na_mask.sum())
+            return
+        values = column.to_numpy(dtype=np.float64)[~na_mask]
+        if len(values) == 0:
+            return
+        other = ColumnProfile(True, self.exact_limit)
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        if self.sketch is None and \
+                self.count + len(values) <= self.exact_limit:
+            other.values = values.tolist()
+        else:
+            other.sketch = QuantileSketch()
+            other.sketch.add(values)
+        self.merge(other)
+
+    def merge(self, other):
+        """
+        Merge the profile of another chunk of the same column.
+
+        Args:
+        - other: The ColumnProfile to merge.
+        """
+        self.na_count += other.na_count
+        if not self.numeric or other.count == 0:
+            self.count += other.count
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.min = other.min if self.min is None else min(self.min,
+                                                          other.min)
+        self.max = other.max if self.max is None else max(self.max,
+                                                          other.max)
+        self.count = count
+
+        if self.sketch is None and other.sketch is None and \
+                count <= self.exact_limit:
+            self.values.extend(other.values)
+            return
+        if self.sketch is None:
+            self.sketch = QuantileSketch()
+            self.sketch.add(np.asarray(self.values, dtype=np.float64))
+            self.values = []
+        if other.sketch is None:
+            self.sketch.add(np.asarray(other.values, dtype=np.float64))
+        else:
+            self.sketch.merge(other.sketch)
+
+    def quantile(self, q):
+        """
+        Get a quantile, exact while the column is small.
+
+        Args:
+        - q: The quantile, between 0 and 1.
+
+        Returns:
+        - The quantile value, or None if the column has no values.
+        """
+        if self.sketch is not None:
+            return self.sketch.quantile(q)
+        if not self.values:
+            return None
+        return float(np.quantile(self.values, q))
+
+    def summary(self, rows):
+        """
+        Summarize the column.
+
+        Args:
+        - rows: The number of rows in the dataset.
+
+        Returns:
+        - A dictionary of the column statistics.
+        """
+        summary = {
+            'count': self.count,
+            'na_count': self.na_count,
+            'na_percentage': self.na_count / rows * 100 if rows else 0.0
+        }
+        if self.numeric:
+            summary.update({
+                'mean': self.mean if self.count else None,
+                'std': math.sqrt(self.m2 / (self.count - 1))
+                if self.count > 1 else None,
+                'min': self.min,
+                'max': self.max,
+                'quantiles': {str(q): self.quantile(q) for q in QUANTILES},
+                'exact_quantiles': self.sketch is None
+            })
+        return summary
+
+    def to_dict(self):
+        """
+        Serialize the column profile.
+        """
+        return {'numeric': self.numeric, 'exact_limit': self.exact_limit,
+                'count': self.count, 'na_count': self.na_count,
+                'mean': self.mean, 'm2': self.m2, 'min': self.min,
+                'max': self.max, 'values': self.values,
+                'sketch': self.sketch.to_dict() if self.sketch else None}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Deserialize a column profile.
+        """
+        profile = cls(state['numeric'], state['exact_limit'])
+        for key in ('count', 'na_count', 'mean', 'm2', 'min', 'max',
+                    'values'):
+            setattr(profile, key, state[key])
+        if state['sketch'] is not None:
+            profile.sketch = QuantileSketch.from_dict(state['sketch'])
+        return profile
+
+
+class DatasetProfile:
+    """
+    Mergeable single-pass profile of every column of a dataset.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.columns = {}
+
+    def update(self, df):
+        """
+        Add the rows of a dataframe chunk.
+
+        Args:
+        - df: The dataframe chunk.
+        """
+        self.rows += len(df)
+        for column in df.columns:
+            if column not in self.columns:
+                self.columns[column] = ColumnProfile(
+                    column in COLUMN_DTYPES,
+                    config.get('profile_exact_limit', 10000))
+            self.columns[column].update(df[column])
+
+    def summary(self):
+        """
+        Summarize the dataset.
+
+        Returns:
+        - A dictionary with the row count and the statistics of each column.
+        """
+        return {'rows': self.rows,
+                'columns': {name: column.summary(self.rows)
+                            for name, column in self.columns.items()}}
+
+    def to_dict(self):
+        """
+        Serialize the profile together with its summary.
+        """
+        return {'summary': self.summary(), 'rows': self.rows,
+                'columns': {name: column.to_dict()
+                            for name, column in self.columns.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Deserialize a profile.
+        """
+        profile = cls()
+        profile.rows = state['rows']
+        profile.columns = {name: ColumnProfile.from_dict(column)
+                           for name, column in state['columns'].items()}
+        return profile
+
+
+def profile_path():
+    """
+    Get the path of the cached profile of the ingested dataset.
+
+    Returns:
+    - The path of profile.json in the output folder.
+    """
+    return config.path('output_folder_path', 'profile.json')
+
+
+def save_profile(profile):
+    """
+    Atomically write the profile of the ingested dataset.
+
+    Args:
+    - profile: The DatasetProfile to write.
+    """
+    tmp_path = profile_path() + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as profile_file:
+        json.dump(profile.to_dict(), profile_file)
+    os.replace(tmp_path, profile_path())
+
+
+def load_profile():
+    """
+    Load the cached profile of the ingested dataset.
+
+    Returns:
+    - The DatasetProfile, or None if no profile has been saved.
+    """
+    if not os.path.exists(profile_path()):
+        return None
+    with open(profile_path(), 'r', encoding='utf-8') as profile_file:
+        return DatasetProfile.from_dict(json.load(profile_file))
+
+
+def profile_dataset(csv_path, chunksize=100000):
+    """
+    Profile a stored dataset in a single pass over bounded chunks.
+
+    Args:
+    - csv_path: The csv path of the dataset.
+    - chunksize: Optional; The number of rows read at a time.
+
+    Returns:
+    - The DatasetProfile of the dataset.
+    """
+    profile = DatasetProfile()
+    for chunk in iter_dataset_chunks(csv_path, chunksize):
+        profile.update(chunk)
+    return profile
+
+
+def current_profile(csv_path):
+    """
+    Get the profile of the ingested dataset, profiling and caching it when
+    it has not been saved yet.
+
+    Args:
+    - csv_path: The csv path of the ingested dataset.
+
+    Returns:
+    - The DatasetProfile, empty if the dataset does not exist.
+    """
+    profile = load_profile()
+    if profile is None:
+        profile = DatasetProfile()
+        if dataset_exists(csv_path):
+            profile = profile_dataset(csv_path)
+            save_profile(profile)
+    return profile
+
+
+_summary_cache = (None, None)
+
+
+def load_summary():
+    """
+    Get the summary of the cached profile, re-reading the profile file only
+    when it has changed.
+
+    Returns:
+    - The summary dictionary, or None if no profile has been saved.
+    """
+    global _summary_cache
+    try:
+        mtime = os.stat(profile_path()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached_mtime, summary = _summary_cache
+    if cached_mtime != mtime:
+        with open(profile_path(), 'r', encoding='utf-8') as profile_file:
+            summary = json.load(profile_file)['summary']
+        _summary_cache = (mtime, summary)
+    return summary
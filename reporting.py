@@ -1,60 +1,347 @@
-
 """
 This module contains a function to score a model
 and generate a confusion matrix plot.
+
+Reports are stored per model version in models/reports/<version>, in the
+formats set by 'report_formats' in config.json:
+- png: The confusion matrix plot, rendered with matplotlib's Agg backend on
+  a figure reused across reports, so a long-running process does not
+  accumulate figures. It is also copied to confusionmatrix2.png.
+- svg: The confusion matrix, ROC curve and score history as SVG files,
+  written without matplotlib.
+- html: A page with the metrics and the SVG charts.
+- json: The metrics, confusion matrix, ROC curve and score history.
 """
 
 import os
 import json
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn import metrics
-from diagnostics import model_predictions
+import shutil
+from html import escape
+from evaluation import evaluation_summary, get_evaluation
+from instrumentation import instrumented, record_rows
+from scoring import read_score_history
+from config import config
+
+# Size in pixels of the SVG charts
+SVG_WIDTH = 480
+SVG_HEIGHT = 360
+SVG_MARGIN = 50
+
+# The matplotlib figure reused by every png report of this process
+_figure = None
+
+
+# Functions for the report paths
+
+
+def report_path(model_version, *parts):
+    """
+    Get the folder holding the reports of a model version, or a path in it.
+
+    Args:
+    - model_version: The model version of the evaluation.
+    - parts: Optional; Path components to join to the folder.
+
+    Returns:
+    - The path in models/reports/<version>.
+    """
+    return config.path('output_model_path', 'reports', model_version, *parts)
+
+
+def write_text(path, text):
+    """
+    Atomically write a text file.
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as text_file:
+        text_file.write(text)
+    os.replace(path + '.tmp', path)
+
+
+# Functions for the png plot
+
+
+def render_png(cm, labels, path):
+    """
+    Plot a confusion matrix as a heatmap and save it as a png, on a figure
+    created once and cleared between reports. The figure is not registered
+    with pyplot, so it is never kept alive by it.
+
+    Args:
+    - cm: The confusion matrix as a list of rows.
+    - labels: The class labels.
+    - path: The png path.
+    """
+    # Plotting libraries are slow to import, so only load them when a
+    # plot is actually generated
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    global _figure
+    if _figure is None:
+        _figure = Figure(figsize=(10, 7))
+        FigureCanvasAgg(_figure)
+    _figure.clear()
+
+    axes = _figure.add_subplot()
+    image = axes.imshow(cm, cmap='magma', aspect='auto')
+    _figure.colorbar(image, ax=axes)
+    peak = max(max(row) for row in cm) or 1
+    for i, row in enumerate(cm):
+        for j, value in enumerate(row):
+            axes.text(j, i, str(value), ha='center', va='center',
+                      color='black' if value > peak / 2 else 'white')
+    axes.set_xticks(range(len(labels)), [str(label) for label in labels])
+    axes.set_yticks(range(len(labels)), [str(label) for label in labels])
+    axes.set_title('Confusion Matrix')
+    axes.set_ylabel('Actual label')
+    axes.set_xlabel('Predicted label')
+    _figure.savefig(path)
+
+
+# Functions for the SVG charts, written without matplotlib
+
+
+def svg_document(title, body):
+    """
+    Wrap SVG elements in a titled SVG document.
+
+    Args:
+    - title: The chart title.
+    - body: The SVG elements.
+
+    Returns:
+    - The SVG document as a string.
+    """
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" '
+            f'height="{SVG_HEIGHT}" viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}" '
+            f'font-family="sans-serif" font-size="12">'
+            f'<text x="{SVG_WIDTH / 2}" y="20" text-anchor="middle" '
+            f'font-size="16">{escape(title)}</text>{body}</svg>')
+
+
+def confusion_matrix_svg(cm, labels):
+    """
+    Draw a confusion matrix as an SVG heatmap.
 
-# Load config.json and get path variables
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
+    Args:
+    - cm: The confusion matrix as a list of rows.
+    - labels: The class labels.
+
+    Returns:
+    - The SVG document as a string.
+    """
+    size = min(SVG_WIDTH, SVG_HEIGHT) - 2 * SVG_MARGIN
+    cell = size / len(cm)
+    left = (SVG_WIDTH - size) / 2
+    peak = max(max(row) for row in cm) or 1
+    parts = []
+    for i, row in enumerate(cm):
+        for j, value in enumerate(row):
+            shade = round(255 * (1 - value / peak))
+            x, y = left + j * cell, SVG_MARGIN + i * cell
+            parts.append(
+                f'<rect x="{x:.1f}" y="{y:.1f}" width="{cell:.1f}" '
+                f'height="{cell:.1f}" fill="rgb({shade},{shade},255)" '
+                f'stroke="white"/><text x="{x + cell / 2:.1f}" '
+                f'y="{y + cell / 2:.1f}" text-anchor="middle" '
+                f'fill="{"white" if shade < 128 else "black"}">{value}</text>')
+    for k, label in enumerate(labels):
+        parts.append(
+            f'<text x="{left + (k + 0.5) * cell:.1f}" '
+            f'y="{SVG_MARGIN + size + 15:.1f}" text-anchor="middle">'
+            f'{escape(str(label))}</text><text x="{left - 8:.1f}" '
+            f'y="{SVG_MARGIN + (k + 0.5) * cell:.1f}" text-anchor="end">'
+            f'{escape(str(label))}</text>')
+    parts.append(f'<text x="{SVG_WIDTH / 2}" y="{SVG_HEIGHT - 8}" '
+                 f'text-anchor="middle">Predicted label</text>'
+                 f'<text x="12" y="{SVG_HEIGHT / 2}" text-anchor="middle" '
+                 f'transform="rotate(-90 12 {SVG_HEIGHT / 2})">'
+                 f'Actual label</text>')
+    return svg_document('Confusion Matrix', ''.join(parts))
+
+
+def line_chart_svg(title, series, x_label, y_label, x_range=None,
+                   y_range=(0, 1)):
+    """
+    Draw line series as an SVG chart.
+
+    Args:
+    - title: The chart title.
+    - series: A dictionary mapping each series name to its list of (x, y)
+    points.
+    - x_label: The x axis label.
+    - y_label: The y axis label.
+    - x_range: Optional; The (min, max) of the x axis. Defaults to the range
+    of the points.
+    - y_range: Optional; The (min, max) of the y axis.
+
+    Returns:
+    - The SVG document as a string.
+    """
+    colors = ['#1f77b4', '#d62728', '#2ca02c', '#ff7f0e']
+    xs = [x for points in series.values() for x, _ in points]
+    if x_range is None:
+        x_range = (min(xs, default=0), max(xs, default=1))
+    x_span = (x_range[1] - x_range[0]) or 1
+    y_span = (y_range[1] - y_range[0]) or 1
+    width = SVG_WIDTH - 2 * SVG_MARGIN
+    height = SVG_HEIGHT - 2 * SVG_MARGIN
+
+    def position(x, y):
+        return (SVG_MARGIN + (x - x_range[0]) / x_span * width,
+                SVG_HEIGHT - SVG_MARGIN - (y - y_range[0]) / y_span * height)
+
+    parts = [f'<rect x="{SVG_MARGIN}" y="{SVG_MARGIN}" width="{width}" '
+             f'height="{height}" fill="none" stroke="#999"/>']
+    for k, (name, points) in enumerate(series.items()):
+        color = colors[k % len(colors)]
+        coordinates = ' '.join(f'{px:.1f},{py:.1f}' for px, py in
+                               (position(x, y) for x, y in points))
+        parts.append(f'<polyline points="{coordinates}" fill="none" '
+                     f'stroke="{color}" stroke-width="2"/>'
+                     f'<text x="{SVG_WIDTH - SVG_MARGIN - 5}" '
+                     f'y="{SVG_MARGIN + 15 * (k + 1)}" text-anchor="end" '
+                     f'fill="{color}">{escape(name)}</text>')
+    parts.append(
+        f'<text x="{SVG_MARGIN}" y="{SVG_HEIGHT - SVG_MARGIN + 15}" '
+        f'text-anchor="middle">{x_range[0]:.3g}</text>'
+        f'<text x="{SVG_WIDTH - SVG_MARGIN}" '
+        f'y="{SVG_HEIGHT - SVG_MARGIN + 15}" text-anchor="middle">'
+        f'{x_range[1]:.3g}</text>'
+        f'<text x="{SVG_MARGIN - 5}" y="{SVG_HEIGHT - SVG_MARGIN}" '
+        f'text-anchor="end">{y_range[0]:.3g}</text>'
+        f'<text x="{SVG_MARGIN - 5}" y="{SVG_MARGIN + 5}" '
+        f'text-anchor="end">{y_range[1]:.3g}</text>'
+        f'<text x="{SVG_WIDTH / 2}" y="{SVG_HEIGHT - 8}" '
+        f'text-anchor="middle">{escape(x_label)}</text>'
+        f'<text x="12" y="{SVG_HEIGHT / 2}" text-anchor="middle" '
+        f'transform="rotate(-90 12 {SVG_HEIGHT / 2})">'
+        f'{escape(y_label)}</text>')
+    return svg_document(title, ''.join(parts))
+
+
+def roc_curve_svg(roc):
+    """
+    Draw a ROC curve as an SVG chart.
+
+    Args:
+    - roc: A dictionary with the false and true positive rates.
+
+    Returns:
+    - The SVG document as a string.
+    """
+    return line_chart_svg(
+        'ROC Curve',
+        {'model': list(zip(roc['fpr'], roc['tpr'])),
+         'chance': [(0, 0), (1, 1)]},
+        'False positive rate', 'True positive rate', x_range=(0, 1))
+
+
+def score_history_svg(history):
+    """
+    Draw the F1 scores of the score history as an SVG chart, one series per
+    role.
+
+    Args:
+    - history: The score records, oldest first.
+
+    Returns:
+    - The SVG document as a string.
+    """
+    series = {}
+    for index, record in enumerate(history):
+        series.setdefault(record['role'], []).append(
+            (index, record['f1']['all']))
+    return line_chart_svg('Score History', series, 'Evaluation', 'F1 score')
+
+
+# Function for the html page
+
+
+def render_html(summary, charts):
+    """
+    Render a report as a standalone html page.
+
+    Args:
+    - summary: The evaluation summary.
+    - charts: The SVG documents to embed.
+
+    Returns:
+    - The html page as a string.
+    """
+    rows = ''.join(
+        f'<tr><th>{escape(name)}</th><td>{escape(str(summary[name]))}</td>'
+        f'</tr>' for name in ('model_version', 'data_hash', 'rows', 'f1',
+                              'precision', 'recall', 'auc'))
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8">'
+            f'<title>Model report {escape(summary["model_version"])}'
+            f'</title></head><body><h1>Model report</h1><table>{rows}'
+            f'</table>{"".join(charts)}</body></html>')
 
-dataset_csv_path = os.path.join(config['output_folder_path'])
-output_model_path = os.path.join(config['output_model_path'])
-test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
 
 # Function for reporting
 
 
-def score_model():
+@instrumented('reporting')
+def score_model(formats=None):
     """
     Function to score the model and generate a confusion matrix plot.
 
-    This function loads the model predictions, the actual labels from the test
-    data, calculates a confusion matrix using the test data and the
-    predictions, and plots the confusion matrix using a heatmap.
+    This function gets the confusion matrix of the deployed model on the test
+    data from its evaluation, computed once per model and dataset, and plots
+    it using a heatmap.
     The confusion matrix plot is then saved to a file.
+
+    Args:
+    - formats: Optional; The report formats among 'png', 'svg', 'html' and
+    'json'. Defaults to the 'report_formats' setting in config.json.
+
+    Returns:
+    - The folder holding the reports of the deployed model version.
     """
-    # Get model predictions
-    predictions = model_predictions(test_data_path)
-
-    # Load the actual labels
-    test_data = pd.read_csv(test_data_path)
-    actual = test_data['exited']
-
-    # Calculate a confusion matrix using the test data
-    # and the deployed model predictions
-    cm = metrics.confusion_matrix(actual, predictions)
-
-    # Plotting the confusion matrix
-    plt.figure(figsize=(10, 7))
-    sns.heatmap(cm, annot=True, fmt="d")
-    plt.title('Confusion Matrix')
-    plt.ylabel('Actual label')
-    plt.xlabel('Predicted label')
-
-    # Save the confusion matrix plot
-    confusion_matrix_plot_path = os.path.join(
-        output_model_path, 'confusionmatrix2.png')
-    plt.savefig(confusion_matrix_plot_path)
-    print(f"Confusion matrix plot saved to {confusion_matrix_plot_path}")
+    formats = formats or config.get('report_formats', ['png'])
+    test_data_path = config.path('test_data_path', 'testdata.csv')
+
+    # Get the confusion matrix of the deployed model on the test data from
+    # its evaluation, shared with the API
+    evaluation = get_evaluation(test_data_path)
+    record_rows(evaluation['rows'])
+    cm = evaluation['confusion_matrix']
+    labels = evaluation['labels']
+    folder = report_path(evaluation['model_version'])
+    os.makedirs(folder, exist_ok=True)
+
+    if 'png' in formats:
+        # Save the confusion matrix plot
+        render_png(cm, labels, os.path.join(folder, 'confusionmatrix.png'))
+        confusion_matrix_plot_path = config.path(
+            'output_model_path', 'confusionmatrix2.png')
+        shutil.copyfile(os.path.join(folder, 'confusionmatrix.png'),
+                        confusion_matrix_plot_path)
+        print(f"Confusion matrix plot saved to {confusion_matrix_plot_path}")
+
+    history = read_score_history(config.get('report_history_limit', 100))
+    charts = {}
+    if 'svg' in formats or 'html' in formats:
+        charts['confusionmatrix'] = confusion_matrix_svg(cm, labels)
+        if evaluation.get('roc'):
+            charts['roccurve'] = roc_curve_svg(evaluation['roc'])
+        if history:
+            charts['scorehistory'] = score_history_svg(history)
+
+    if 'svg' in formats:
+        for name, chart in charts.items():
+            write_text(os.path.join(folder, f'{name}.svg'), chart)
+    summary = evaluation_summary(evaluation)
+    if 'html' in formats:
+        write_text(os.path.join(folder, 'report.html'),
+                   render_html(summary, charts.values()))
+    if 'json' in formats:
+        write_text(os.path.join(folder, 'report.json'), json.dumps(
+            {**summary, 'score_history': history}, indent=4))
+    print(f"Reports saved to {folder}")
+    return folder
 
 
 if __name__ == '__main__':
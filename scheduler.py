@@ -0,0 +1,229 @@
+"""
+This module runs the monitoring pipeline as a long-running daemon, instead
+of starting fullprocess.py from cron on a fixed schedule.
+
+The daemon watches the input folder for new or changed files, with
+watchdog (inotify on Linux) when it is installed and by polling the folder
+otherwise. Bursts of file drops are debounced into one run, and runs are
+queued in a bounded queue for a single worker thread, which calls
+fullprocess.main() in this warm process under the pipeline lock. The
+latency from the first file drop to the end of each run is recorded in the
+stage metrics.
+
+Run the daemon with:
+    python scheduler.py
+"""
+
+import os
+import time
+import importlib
+import queue
+import collections
+import threading
+import fullprocess
+import deployment
+from instrumentation import current_run, write_stage_metrics
+from config import config
+
+
+def folder_snapshot(folder_path):
+    """
+    Take a cheap snapshot of the files in a folder.
+
+    Args:
+    - folder_path: The folder to snapshot.
+
+    Returns:
+    - A dictionary mapping each file name to its size and mtime.
+    """
+    with os.scandir(folder_path) as entries:
+        return {entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns)
+                for entry in entries if entry.is_file()}
+
+
+def start_watchdog(folder_path, notify):
+    """
+    Watch a folder for file events with watchdog, if it is installed.
+
+    Args:
+    - folder_path: The folder to watch.
+    - notify: The function called on every file event.
+
+    Returns:
+    - The started watchdog observer, or None if watchdog is not installed.
+    """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        """
+        Forwards file events to the scheduler.
+        """
+
+        def on_any_event(self, event):
+            if not event.is_directory:
+                notify()
+
+    observer = Observer()
+    observer.schedule(Handler(), folder_path)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+class Scheduler:
+    """
+    Runs the pipeline when files in the input folder change. The settings
+    default to 'scheduler_debounce_seconds', 'scheduler_poll_seconds',
+    'scheduler_queue_size' and 'scheduler_history_size' in config.json.
+    Only the records of the last 'scheduler_history_size' runs are kept in
+    runs, and run_count counts all runs.
+    """
+
+    def __init__(self, run=None, folder_path=None, debounce_seconds=None,
+                 poll_seconds=None, queue_size=None, history_size=None):
+        self.run = run or (lambda: fullprocess.main(blocking=True))
+        self.folder_path = folder_path or config.path('input_folder_path')
+        self.debounce_seconds = debounce_seconds or config.get(
+            'scheduler_debounce_seconds', 2.0)
+        self.poll_seconds = poll_seconds or config.get(
+            'scheduler_poll_seconds', 5.0)
+        self.queue = queue.Queue(
+            maxsize=queue_size or config.get('scheduler_queue_size', 4))
+        self.runs = collections.deque(
+            maxlen=history_size or config.get('scheduler_history_size', 100))
+        self.run_count = 0
+        self.watcher = None
+        self._burst = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def notify(self):
+        """
+        Record a change in the input folder. The first change of a burst
+        marks the start of the drop-to-deployment latency.
+        """
+        now = time.time()
+        with self._lock:
+            first_event = self._burst[0] if self._burst else now
+            self._burst = (first_event, now)
+
+    def _poll_loop(self):
+        snapshot = folder_snapshot(self.folder_path)
+        while not self._stop.wait(self.poll_seconds):
+            current = folder_snapshot(self.folder_path)
+            if current != snapshot:
+                snapshot = current
+                self.notify()
+
+    def _debounce_loop(self):
+        while not self._stop.wait(min(self.debounce_seconds / 4, 0.5)):
+            with self._lock:
+                if self._burst is None or \
+                        time.time() - self._burst[1] < self.debounce_seconds:
+                    continue
+                first_event, _ = self._burst
+                self._burst = None
+            try:
+                self.queue.put_nowait(first_event)
+            except queue.Full:
+                # The queued runs will pick up these files as well
+                print("Pipeline queue full, coalescing the file drop")
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                first_event = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.run_once(first_event)
+
+    def run_once(self, first_event):
+        """
+        Run the pipeline and record its latency from the first file drop.
+
+        Args:
+        - first_event: The time of the first change handled by this run.
+
+        Returns:
+        - A dictionary with the queue wait, run time and total latency, and
+        whether a new version was deployed.
+        """
+        run_id = current_run()
+        version = deployment.current_version()
+        started_at = time.time()
+        try:
+            self.run()
+            error = None
+        except Exception as e:  # pylint: disable=broad-except
+            # Keep the daemon alive; the next file drop retries the run
+            error = repr(e)
+            print(f"Pipeline run failed: {error}")
+        finished_at = time.time()
+        record = {
+            'run_id': current_run() if current_run() != run_id else None,
+            'stage': 'scheduler',
+            'started_at': started_at,
+            'queue_seconds': started_at - first_event,
+            'run_seconds': finished_at - started_at,
+            'seconds': finished_at - first_event,
+            'deployed': deployment.current_version() != version,
+            'error': error
+        }
+        self.runs.append(record)
+        self.run_count += 1
+        write_stage_metrics(record)
+        print(f"Pipeline run finished {record['seconds']:.2f}s after the "
+              f"file drop")
+        return record
+
+    def start(self):
+        """
+        Start watching the input folder and the worker, and queue a first
+        run for the files dropped while the daemon was down.
+        """
+        self.watcher = start_watchdog(self.folder_path, self.notify)
+        loops = [self._debounce_loop, self._worker_loop]
+        if self.watcher is None:
+            loops.append(self._poll_loop)
+        for loop in loops:
+            thread = threading.Thread(target=loop, daemon=True,
+                                      name=f'scheduler{loop.__name__}')
+            thread.start()
+            self._threads.append(thread)
+        self.queue.put_nowait(time.time())
+
+    def stop(self):
+        """
+        Stop watching and wait for the running pipeline to finish.
+        """
+        self._stop.set()
+        if self.watcher is not None:
+            self.watcher.stop()
+        for thread in self._threads:
+            thread.join()
+
+
+def warm_up():
+    """
+    Import the pipeline modules once, so runs don't pay for the imports.
+    """
+    for module in ('ingestion', 'training', 'scoring', 'drift',
+                   'reporting', 'apicalls'):
+        importlib.import_module(module)
+
+
+if __name__ == '__main__':
+    warm_up()
+    scheduler = Scheduler()
+    scheduler.start()
+    print(f"Watching {scheduler.folder_path} for new data")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -1,30 +1,109 @@
 """
 This module contains code for scoring a trained model.
+
+It also evaluates a freshly trained challenger model against the deployed
+champion before it is deployed, recording both scores in a structured
+score history.
 """
 
 import os
-import pickle
 import json
-import pandas as pd
+import time
+from collections import deque
+import numpy as np
 from sklearn import metrics
+from datastore import (LABEL_COLUMN, dataset_exists, load_compact_dataset,
+                       load_dataset)
+from compact_model import compact_model_path
+import model_registry
+from ingestion import new_rows_path
+from evaluation import get_evaluation
+from instrumentation import current_run, instrumented, record_rows
+from manifest import file_hash
+from config import config
+
+
+# Functions for the score files
+
+
+def score_file_path():
+    """
+    Get the path of the score of the trained model, deployed with it.
+    """
+    return config.path('output_model_path', 'latestscore.txt')
+
+
+def score_history_path():
+    """
+    Get the path of the score history.
+
+    Returns:
+    - The path of scorehistory.jsonl in the output model folder.
+    """
+    return config.path('output_model_path', 'scorehistory.jsonl')
+
+
+def challenger_path():
+    """
+    Get the path of the latest champion/challenger evaluation.
+
+    Returns:
+    - The path of challenger.json in the output model folder.
+    """
+    return config.path('output_model_path', 'challenger.json')
+
 
+def load_challenger_evaluation():
+    """
+    Load the latest champion/challenger evaluation.
+
+    Returns:
+    - The evaluation as a dictionary, or None if there is none.
+    """
+    if not os.path.exists(challenger_path()):
+        return None
+    with open(challenger_path(), 'r', encoding='utf-8') as challenger_file:
+        return json.load(challenger_file)
+
+
+def write_score_history(records):
+    """
+    Append score records to the score history.
+
+    Args:
+    - records: A list of dictionaries describing a scored model.
+    """
+    with open(score_history_path(), 'a', encoding='utf-8') as history_file:
+        for record in records:
+            history_file.write(json.dumps(record) + '\n')
 
-# Load config.json and get path variables
-with open('config.json', 'r', encoding='utf-8') as f:
-    config = json.load(f)
 
-test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
-model_path = os.path.join(config['prod_deployment_path'], 'trainedmodel.pkl')
-score_file_path = os.path.join(
-    config['output_model_path'], 'latestscore.txt')
+def read_score_history(limit=None):
+    """
+    Read the most recent score records.
+
+    Args:
+    - limit: Optional; The maximum number of records to return.
+    Defaults to all of them.
+
+    Returns:
+    - A list of score records, oldest first.
+    """
+    if not os.path.exists(score_history_path()):
+        return []
+    with open(score_history_path(), 'r', encoding='utf-8') as history_file:
+        lines = deque(history_file, maxlen=limit)
+    return [json.loads(line) for line in lines if line.strip()]
 
 # Function for model scoring
 
 
+@instrumented('scoring')
 def score_model(predictions=None, new_data_path=None):
     """
     Calculate the F1 score for a set of predictions against a given dataset,
-    or against a default test dataset if no arguments are provided.
+    or the F1 score of the deployed model on the test dataset if no
+    arguments are provided.
 
     Args:
     - predictions: Optional; A list/array of model predictions.
@@ -34,33 +113,164 @@ def score_model(predictions=None, new_data_path=None):
     - The F1 score as a float.
     """
     if predictions is None or new_data_path is None:
-        # Default behavior: use the predefined test dataset and model
-        test_data = pd.read_csv(test_data_path).iloc[:, 1:]
-        x_test = test_data.drop('exited', axis=1)
-        y_test = test_data['exited']
+        # Default behavior: the F1 score of the deployed model on the
+        # predefined test dataset, evaluated once per model and dataset
+        evaluation = get_evaluation()
+        record_rows(evaluation['rows'])
+        return evaluation['f1']
 
-        # Load the trained ML model if predictions are not provided
-        with open(model_path, 'rb') as model_file:
-            model = pickle.load(model_file)
-        predictions = model.predict(x_test)
+    # Use provided predictions and new data for scoring
+    new_data = load_dataset(new_data_path, columns=[LABEL_COLUMN])
+    y_test = new_data[LABEL_COLUMN]
 
-        # Calculate F1 score
-        f1 = metrics.f1_score(y_test, predictions)
+    # Calculate F1 score
+    f1 = metrics.f1_score(y_test, predictions)
 
-    else:
-        # Use provided predictions and new data for scoring
-        new_data = pd.read_csv(new_data_path).iloc[:, 1:]
-        # Adjust this to match the label column in your new dataset
-        y_test = new_data['exited']
+    record_rows(len(y_test))
+    return f1
 
-        # Calculate F1 score
-        f1 = metrics.f1_score(y_test, predictions)
+# Functions for champion/challenger evaluation
 
-    with open(score_file_path, 'w', encoding='utf-8') as score_file:
-        score_file.write(f"F1 Score: {f1}")
 
-    return f1
+def linear_parameters(model):
+    """
+    Get the coefficients, intercept and classes of a binary linear model,
+    compact or fitted by sklearn.
+
+    Args:
+    - model: A CompactModel or a fitted LogisticRegression.
+
+    Returns:
+    - A tuple of the coefficients, the intercept and the classes.
+    """
+    if hasattr(model, 'coef_'):
+        return (np.ravel(model.coef_), float(np.ravel(model.intercept_)[0]),
+                np.asarray(model.classes_))
+    return model.coef, float(model.intercept), model.classes
+
+
+def predict_together(models, features):
+    """
+    Predict with several binary linear models in one matrix product.
+
+    Args:
+    - models: A list of models.
+    - features: A float32 array of shape (rows, features).
+
+    Returns:
+    - An array of shape (rows, models) with the predictions of each model.
+    """
+    parameters = [linear_parameters(model) for model in models]
+    coefs = np.column_stack([coef for coef, _, _ in parameters]).astype(
+        np.float32)
+    intercepts = np.array([intercept for _, intercept, _ in parameters],
+                          dtype=np.float32)
+    positive = features @ coefs + intercepts > 0
+    return np.column_stack([classes[positive[:, i].astype(np.intp)]
+                            for i, (_, _, classes) in enumerate(parameters)])
+
+
+def model_hash(model_path):
+    """
+    Get the content hash identifying a model, taken from its compact model
+    if it has one.
+
+    Args:
+    - model_path: Path to the pickled model file.
+
+    Returns:
+    - The sha256 hex digest of the model file.
+    """
+    if os.path.exists(compact_model_path(model_path)):
+        return file_hash(compact_model_path(model_path))
+    return file_hash(model_path)
+
+
+def evaluation_sets():
+    """
+    Load the labelled rows the champion and challenger are compared on: the
+    test dataset and the rows added by the latest ingestion. Rows with a
+    missing feature or label are dropped, since the models can't score
+    them.
+
+    Returns:
+    - A dictionary mapping each set name to its CompactDataset.
+    """
+    sets = {'testdata': load_compact_dataset(
+        config.path('test_data_path', 'testdata.csv'), dropna=True)}
+    if dataset_exists(new_rows_path()):
+        sets['newrows'] = load_compact_dataset(new_rows_path(), dropna=True)
+    return sets
+
+
+@instrumented('challenger')
+def evaluate_challenger(margin=None):
+    """
+    Score the freshly trained challenger model and the deployed champion
+    together on the test dataset and the newly ingested rows. The
+    challenger is promoted if its F1 score on all these rows beats the
+    champion's by more than the margin, or if no model is deployed, so a
+    tie keeps the champion. The challenger's test score is written to
+    latestscore.txt, both scores are appended to the score history and the
+    evaluation is written to challenger.json.
+
+    Args:
+    - margin: Optional; The F1 improvement the challenger must exceed.
+    Defaults to the 'promotion_margin' setting in config.json.
+
+    Returns:
+    - A dictionary with the scores of both models and whether the
+    challenger is promoted.
+    """
+    if margin is None:
+        margin = config.get('promotion_margin', 0.0)
+    roles = {'challenger': config.path('output_model_path',
+                                       'trainedmodel.pkl'),
+             'champion': model_registry.deployed_model_path()}
+    if not os.path.exists(roles['champion']):
+        del roles['champion']
+    models = {role: model_registry.get_inference_model(path)
+              for role, path in roles.items()}
+
+    # Score both models in a single pass over all the evaluation rows
+    sets = evaluation_sets()
+    rows = np.cumsum([0] + [len(data) for data in sets.values()])
+    features = np.concatenate([data.features for data in sets.values()])
+    labels = np.concatenate([data.labels for data in sets.values()])
+    predictions = predict_together(list(models.values()), features)
+    record_rows(len(labels))
+
+    scores = {}
+    for i, role in enumerate(models):
+        scores[role] = {'all': float(metrics.f1_score(
+            labels, predictions[:, i], zero_division=0))}
+        for name, start, end in zip(sets, rows[:-1], rows[1:]):
+            scores[role][name] = float(metrics.f1_score(
+                labels[start:end], predictions[start:end, i],
+                zero_division=0)) if end > start else None
+
+    promoted = 'champion' not in scores or \
+        scores['challenger']['all'] - scores['champion']['all'] > margin
+
+    with open(score_file_path(), 'w', encoding='utf-8') as score_file:
+        score_file.write(f"F1 Score: {scores['challenger']['testdata']}")
+
+    timestamp = time.time()
+    write_score_history([{
+        'run_id': current_run(),
+        'timestamp': timestamp,
+        'role': role,
+        'model_hash': model_hash(roles[role]),
+        'f1': scores[role],
+        'rows': {name: len(data) for name, data in sets.items()},
+        'margin': margin,
+        'promoted': promoted
+    } for role in scores])
+    evaluation = {'scores': scores, 'margin': margin, 'promoted': promoted}
+    with open(challenger_path(), 'w', encoding='utf-8') as challenger_file:
+        json.dump(evaluation, challenger_file, indent=4)
+    return evaluation
 
 
 if __name__ == '__main__':
-    score_model()
+    print(score_model())
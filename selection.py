@@ -0,0 +1,234 @@
+"""
+This module selects the hyperparameters of the logistic regression model
+by k-fold cross-validation over a grid of candidates, set by
+'hyperparameter_grid' in config.json.
+
+The candidate folds are fitted in a process pool. The training data is sent
+to each worker once, and each fold is fitted on a copy of its training rows
+only, so that data-dependent settings such as class_weight='balanced' never
+see the held-out rows. The search stops once the wall-clock budget set by
+'selection_budget_seconds' is spent, terminating the fits still running,
+and picks the best candidate whose folds all completed.
+"""
+
+import os
+import json
+import time
+import itertools
+import warnings
+from multiprocessing import Pool, TimeoutError as PoolTimeoutError
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import f1_score
+from sklearn.model_selection import StratifiedKFold
+from config import config
+
+# Penalties supported by each solver
+SOLVER_PENALTIES = {
+    'liblinear': ('l1', 'l2'),
+    'lbfgs': ('l2',),
+    'newton-cg': ('l2',),
+    'newton-cholesky': ('l2',),
+    'sag': ('l2',),
+    'saga': ('l1', 'l2')
+}
+
+# Training data of the worker processes, set once per worker
+_worker_data = None
+
+
+def selection_path(folder_key='output_model_path'):
+    """
+    Get the path of the model selection results stored next to the model.
+
+    Args:
+    - folder_key: Optional; The config.json key of the folder holding it.
+
+    Returns:
+    - The path of modelselection.json.
+    """
+    return config.path(folder_key, 'modelselection.json')
+
+
+def candidate_grid(grid=None):
+    """
+    Expand a hyperparameter grid into candidates, skipping the penalties a
+    solver does not support.
+
+    Args:
+    - grid: Optional; A dictionary of hyperparameter names to lists of
+    values. Defaults to 'hyperparameter_grid' in config.json.
+
+    Returns:
+    - A list of hyperparameter dictionaries, empty if the grid is empty.
+    """
+    if grid is None:
+        grid = config.get('hyperparameter_grid', {})
+    if not grid:
+        return []
+    names = sorted(grid)
+    candidates = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        params = dict(zip(names, values))
+        if params.get('penalty', 'l2') in SOLVER_PENALTIES.get(
+                params.get('solver', 'liblinear'), ()):
+            candidates.append(params)
+    return candidates
+
+
+def cv_folds(y, n_splits):
+    """
+    Split rows into stratified folds, as index arrays.
+
+    Args:
+    - y: The labels.
+    - n_splits: The number of folds, lowered to the size of the smallest
+    class if needed.
+
+    Returns:
+    - A list of (train indices, test indices) tuples, or an empty list if
+    the smallest class has fewer than 2 rows.
+    """
+    n_splits = min(n_splits, int(np.unique(y, return_counts=True)[1].min()))
+    if n_splits < 2:
+        return []
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True,
+                               random_state=0)
+    return list(splitter.split(np.zeros(len(y)), y))
+
+
+def _init_worker(x, y, folds):
+    global _worker_data
+    _worker_data = (x, y, folds)
+
+
+def fit_fold(base_params, params, fold_index):
+    """
+    Fit a candidate on the training rows of a fold and score it on the
+    held-out rows. Runs in the worker processes.
+
+    Args:
+    - base_params: The hyperparameters shared by every candidate.
+    - params: The hyperparameters of the candidate.
+    - fold_index: The index of the fold.
+
+    Returns:
+    - The F1 score on the held-out rows.
+    """
+    x, y, folds = _worker_data
+    train_index, test_index = folds[fold_index]
+    model = LogisticRegression(**{**base_params, **params})
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        model.fit(x[train_index], y[train_index])
+    return float(f1_score(y[test_index], model.predict(x[test_index]),
+                          zero_division=0))
+
+
+def _fit_task(task):
+    base_params, params, i, j = task
+    return i, j, fit_fold(base_params, params, j)
+
+
+def select_model(x, y, base_params, candidates=None, n_splits=None,
+                 workers=None, budget_seconds=None):
+    """
+    Cross-validate the candidate hyperparameters and pick the one with the
+    best mean F1 score, the first in grid order on ties.
+
+    The budget is soft. A serial search checks it between fits, so it can
+    overrun by one fit. A parallel search terminates its worker processes
+    when the budget runs out, which stops the fits still running.
+
+    Args:
+    - x: The training features.
+    - y: The training labels.
+    - base_params: The hyperparameters shared by every candidate.
+    - candidates: Optional; The hyperparameter dictionaries to evaluate.
+    Defaults to the grid in config.json.
+    - n_splits: Optional; The number of folds. Defaults to 'cv_folds' in
+    config.json.
+    - workers: Optional; The number of worker processes. Defaults to
+    'selection_workers' in config.json.
+    - budget_seconds: Optional; The wall-clock budget. Defaults to
+    'selection_budget_seconds' in config.json.
+
+    Returns:
+    - A dictionary with the winning hyperparameters and the CV scores of
+    every candidate, or None if there are too few rows to cross-validate.
+    """
+    started = time.perf_counter()
+    if candidates is None:
+        candidates = candidate_grid()
+    n_splits = n_splits or config.get('cv_folds', 5)
+    workers = workers or config.get('selection_workers', os.cpu_count())
+    budget_seconds = budget_seconds or config.get(
+        'selection_budget_seconds', 300)
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.asarray(y)
+    folds = cv_folds(y, n_splits)
+    if not folds or not candidates:
+        return None
+
+    scores = [[None] * len(folds) for _ in candidates]
+    tasks = [(i, j) for i in range(len(candidates))
+             for j in range(len(folds))]
+    exhausted = False
+    if workers <= 1:
+        _init_worker(x, y, folds)
+        for i, j in tasks:
+            if time.perf_counter() - started > budget_seconds:
+                exhausted = True
+                break
+            scores[i][j] = fit_fold(base_params, candidates[i], j)
+    else:
+        # Unlike a ProcessPoolExecutor, a multiprocessing pool can be
+        # terminated, so no fit outlives the budget
+        pool = Pool(processes=workers, initializer=_init_worker,
+                    initargs=(x, y, folds))
+        try:
+            fits = pool.imap_unordered(_fit_task, [
+                (base_params, candidates[i], i, j) for i, j in tasks])
+            for _ in tasks:
+                remaining = budget_seconds - (time.perf_counter() - started)
+                try:
+                    i, j, score = fits.next(timeout=max(remaining, 0))
+                except PoolTimeoutError:
+                    exhausted = True
+                    break
+                scores[i][j] = score
+        finally:
+            pool.terminate()
+            pool.join()
+
+    results = []
+    for params, fold_scores in zip(candidates, scores):
+        complete = all(score is not None for score in fold_scores)
+        results.append({
+            'params': params,
+            'fold_f1': fold_scores,
+            'mean_f1': float(np.mean(fold_scores)) if complete else None,
+            'std_f1': float(np.std(fold_scores)) if complete else None
+        })
+    completed = [result for result in results if result['mean_f1'] is not None]
+    if not completed:
+        return None
+    winner = max(completed, key=lambda result: result['mean_f1'])
+    return {'winner': winner, 'candidates': results, 'folds': len(folds),
+            'rows': len(y), 'seconds': time.perf_counter() - started,
+            'budget_exhausted': exhausted}
+
+
+def save_selection(selection, path=None):
+    """
+    Write the model selection results.
+
+    Args:
+    - selection: The results of select_model.
+    - path: Optional; The output path. Defaults to the model folder.
+    """
+    path = path or selection_path()
+    with open(path, 'w', encoding='utf-8') as selection_file:
+        json.dump(selection, selection_file, indent=4)
@@ -0,0 +1,167 @@
+"""
+This module serves the Flask app in production with pre-forked worker
+processes, instead of the Flask development server.
+
+The master process reads config.json, loads the deployed model and the
+dataset profile, and opens the listening socket once, then forks the
+workers. The workers share the preloaded memory copy-on-write and accept
+connections from the shared socket, each handling requests with a fixed
+pool of threads. Dead workers are replaced, and SIGTERM or SIGINT stops
+the master and its workers. The number of workers and threads is set by
+'serve_workers' and 'serve_threads' in config.json.
+
+Run the server with:
+    python serve.py
+"""
+
+import os
+import gc
+import sys
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from app import app, preload
+import diagnostics
+from config import config
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Handles one request per connection, so that idle keep-alive connections
+    never hold on to a pooled thread. Access logging is left to the proxy
+    in front of the server.
+    """
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A WSGI server handling requests with a fixed pool of threads.
+    """
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, wsgi_app, threads, fd=None):
+        super().__init__(host, port, wsgi_app, handler=RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='serve')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle a request in a pooled thread.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def run_worker(listener, threads):
+    """
+    Serve requests from the shared socket until the worker is terminated.
+    Runs in a forked worker process.
+
+    Args:
+    - listener: The listening socket opened by the master.
+    - threads: The number of request threads.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Threads don't survive the fork, so each worker refreshes its own
+    # diagnostics snapshot
+    diagnostics.start_background_refresh()
+    host, port = listener.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads,
+                              fd=listener.fileno())
+    server.serve_forever()
+
+
+def spawn_worker(listener, threads):
+    """
+    Fork a worker process.
+
+    Args:
+    - listener: The listening socket opened by the master.
+    - threads: The number of request threads.
+
+    Returns:
+    - The process id of the worker.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(listener, threads)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve(host=None, port=None, workers=None, threads=None):
+    """
+    Preload the app, open the listening socket and run the workers until
+    the master is stopped.
+
+    Args:
+    - host: Optional; The address to listen on. Defaults to 'serve_host' in
+    config.json.
+    - port: Optional; The port to listen on. Defaults to 'serve_port'.
+    - workers: Optional; The number of worker processes. Defaults to
+    'serve_workers'.
+    - threads: Optional; The number of request threads per worker.
+    Defaults to 'serve_threads'.
+    """
+    host = host or config.get('serve_host', '0.0.0.0')
+    port = config.get('serve_port', 8000) if port is None else port
+    workers = workers or config.get('serve_workers', os.cpu_count())
+    threads = threads or config.get('serve_threads', 8)
+
+    preload()
+    listener = socket.create_server((host, port), backlog=1024)
+    print(f"Serving on http://{host}:{listener.getsockname()[1]} with "
+          f"{workers} workers of {threads} threads", flush=True)
+
+    # Keep the preloaded objects out of the garbage collector, so that
+    # collections in the workers don't write to the shared pages
+    gc.freeze()
+
+    stopping = False
+    pids = set()
+
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    pids.update(spawn_worker(listener, threads) for _ in range(workers))
+    while pids:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        pids.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited, starting a new one", flush=True)
+            pids.add(spawn_worker(listener, threads))
+    listener.close()
+
+
+if __name__ == '__main__':
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -1,53 +1,366 @@
 """
 This module trains a logistic regression model using the provided dataset.
+
+The model is either refit from scratch on the whole dataset, or updated
+incrementally from the deployed model using only the newly ingested rows.
+The incremental update keeps a quadratic approximation of the training loss
+of the rows seen so far (the gradient vanishes at the deployed optimum, so
+only its Hessian is stored), and minimizes it plus the loss of the new rows
+with a few Newton steps.
 """
 
 import os
 import json
 import pickle
-import pandas as pd
-from sklearn.model_selection import train_test_split
+import numpy as np
+from scipy.special import expit
 from sklearn.linear_model import LogisticRegression
+from datastore import FEATURE_COLUMNS, load_compact_dataset
+from compact_model import compact_model_path, export_compact_model
+from instrumentation import instrumented, record_rows
+from ingestion import new_rows_path
+import drift
+import profiling
+import selection
+from config import config
 
-# Load config.json and get path variables
-with open('config.json', 'r', encoding='utf-8') as file:
-    config = json.load(file)
 
-dataset_csv_path = os.path.join(config['output_folder_path'], 'finaldata.csv')
-model_path = os.path.join(config['output_model_path'], 'trainedmodel.pkl')
+# Functions for the training state of the model
 
 
-def train_model():
+def training_state_path(folder_key='output_model_path'):
     """
-    Trains a logistic regression model using the provided dataset.
+    Get the path of the training state stored next to the model.
+
+    Args:
+    - folder_key: Optional; The config.json key of the folder holding it.
+
+    Returns:
+    - The path of trainingstate.json.
+    """
+    return config.path(folder_key, 'trainingstate.json')
+
+
+def load_training_state(path=None):
+    """
+    Load the training state of a model.
+
+    Args:
+    - path: Optional; The state path. Defaults to the state of the model
+    deployed in production.
+
+    Returns:
+    - The training state, or None if it does not exist.
+    """
+    path = path or training_state_path('prod_deployment_path')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+
+def augmented_features(x):
+    """
+    Get the features as a float64 array with a trailing column of ones, so
+    that the intercept is the last weight.
+
+    Args:
+    - x: A dataframe or array of the model features.
+
+    Returns:
+    - A float64 array of shape (rows, features + 1).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    return np.column_stack([x, np.ones(len(x))])
+
+
+def loss_hessian(weights, x_aug, c=1.0):
+    """
+    Compute the Hessian of the log loss of some rows, scaled by c.
+
+    Args:
+    - weights: The coefficients followed by the intercept.
+    - x_aug: The augmented features of the rows.
+    - c: Optional; The inverse regularization strength.
+
+    Returns:
+    - The Hessian as a square float64 array.
+    """
+    p = expit(x_aug @ weights)
+    return c * (x_aug.T * (p * (1 - p))) @ x_aug
+
+
+def chunked_loss_hessian(weights, features, c=1.0, chunksize=1000000):
     """
-    # Read the dataset
-    data = pd.read_csv(dataset_csv_path).iloc[:, 1:]
+    Compute the Hessian of the log loss of some rows chunk by chunk, so
+    that the float64 augmented features of only one chunk are held in
+    memory.
+
+    Args:
+    - weights: The coefficients followed by the intercept.
+    - features: An array of the model features of the rows.
+    - c: Optional; The inverse regularization strength.
+    - chunksize: Optional; The number of rows per chunk.
+
+    Returns:
+    - The Hessian as a square float64 array.
+    """
+    hessian = np.zeros((len(weights), len(weights)))
+    for start in range(0, len(features), chunksize):
+        hessian += loss_hessian(weights, augmented_features(
+            features[start:start + chunksize]), c)
+    return hessian
+
+
+def penalty_hessian(model):
+    """
+    Get the Hessian of the L2 penalty of a model, which covers the
+    intercept only for the liblinear solver.
+
+    Args:
+    - model: The LogisticRegression.
 
-    # Split the dataset into features and target variable
-    x = data.drop('exited', axis=1)
-    y = data['exited']
+    Returns:
+    - A diagonal float64 array over the coefficients and the intercept.
+    """
+    diagonal = np.ones(len(FEATURE_COLUMNS) + 1)
+    if model.solver != 'liblinear':
+        diagonal[-1] = 0
+    return np.diag(diagonal)
+
+
+def supports_incremental(params):
+    """
+    Check whether a model with the given hyperparameters can be updated
+    incrementally, which needs an unweighted L2-regularized loss.
+
+    Args:
+    - params: The hyperparameters of the model.
+
+    Returns:
+    - True if the model can be updated incrementally.
+    """
+    return params.get('penalty', 'l2') == 'l2' and \
+        params.get('class_weight') is None
+
+
+def training_state(weights, hessian, classes, params, dataset_rows,
+                   incremental_updates):
+    """
+    Build the training state of a model.
 
-    # Split the data into training and test sets
-    x_train, _, y_train, _ = train_test_split(
-        x, y, test_size=0.2, random_state=0)
+    Args:
+    - weights: The coefficients followed by the intercept.
+    - hessian: The Hessian of the regularized training loss at the weights.
+    - classes: The class labels.
+    - params: The hyperparameters that differ from new_model's.
+    - dataset_rows: The number of rows in finaldata.csv when trained.
+    - incremental_updates: The number of incremental updates since the last
+    full refit.
 
-    # Initialize the logistic regression model with the given hyperparameters
-    model = LogisticRegression(
+    Returns:
+    - The training state as a dictionary.
+    """
+    return {'weights': np.asarray(weights).tolist(),
+            'hessian': np.asarray(hessian).tolist(),
+            'classes': np.asarray(classes).tolist(),
+            'params': params,
+            'dataset_rows': int(dataset_rows),
+            'incremental_updates': incremental_updates}
+
+
+# Functions for fitting the model
+
+
+def new_model(params=None):
+    """
+    Initialize the logistic regression model with the given hyperparameters.
+
+    Args:
+    - params: Optional; Hyperparameters overriding the defaults, e.g. the
+    ones picked by model selection.
+
+    Returns:
+    - An unfitted LogisticRegression.
+    """
+    return LogisticRegression(
         C=1.0, class_weight=None, dual=False, fit_intercept=True,
         intercept_scaling=1, l1_ratio=None, max_iter=100,
         multi_class='auto', n_jobs=None, penalty='l2',
         random_state=0, solver='liblinear', tol=0.0001, verbose=0,
         warm_start=False
-    )
+    ).set_params(**(params or {}))
+
+
+def model_from_weights(weights, classes, iterations, params=None):
+    """
+    Build a fitted logistic regression model from its weights.
+
+    Args:
+    - weights: The coefficients followed by the intercept.
+    - classes: The class labels.
+    - iterations: The number of iterations of the fit.
+    - params: Optional; The hyperparameters of the model.
+
+    Returns:
+    - A LogisticRegression usable like one fitted by sklearn.
+    """
+    model = new_model(params)
+    model.classes_ = np.asarray(classes)
+    model.coef_ = np.asarray(weights[:-1], dtype=np.float64).reshape(1, -1)
+    model.intercept_ = np.asarray(weights[-1:], dtype=np.float64)
+    model.n_features_in_ = len(FEATURE_COLUMNS)
+    model.feature_names_in_ = np.asarray(FEATURE_COLUMNS, dtype=object)
+    model.n_iter_ = np.asarray([iterations], dtype=np.int32)
+    return model
+
+
+def incremental_update(state, x_new, y_new, max_iter=20, tol=1e-10):
+    """
+    Update the weights of a model with new rows, minimizing the quadratic
+    approximation of the loss of the rows it was trained on plus the log
+    loss of the new rows with Newton steps.
+
+    Args:
+    - state: The training state of the model.
+    - x_new: The features of the new rows.
+    - y_new: The labels of the new rows.
+    - max_iter: Optional; The maximum number of Newton steps.
+    - tol: Optional; Stop when a step is this small relative to the weights.
+
+    Returns:
+    - A tuple of the new weights, the new Hessian and the number of steps.
+    """
+    c = new_model(state['params']).C
+    start = np.asarray(state['weights'])
+    previous_hessian = np.asarray(state['hessian'])
+    x_aug = augmented_features(x_new)
+    y = (np.asarray(y_new) == state['classes'][1]).astype(np.float64)
 
-    # Fit the logistic regression to the data
-    model.fit(x_train, y_train)
+    weights = start.copy()
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        gradient = previous_hessian @ (weights - start) \
+            + c * x_aug.T @ (expit(x_aug @ weights) - y)
+        hessian = previous_hessian + loss_hessian(weights, x_aug, c)
+        step = np.linalg.solve(hessian, gradient)
+        weights -= step
+        if np.abs(step).max() <= tol * (1 + np.abs(weights).max()):
+            break
+    return (weights, previous_hessian + loss_hessian(weights, x_aug, c),
+            iterations)
+
+
+def incremental_inputs():
+    """
+    Get what an incremental update of the deployed model needs, if it can
+    be done: the deployed training state and drift reference, and the rows
+    ingested since the deployed model was trained. A full refit is needed
+    once 'full_refit_every' incremental updates were made in a row, and for
+    models whose loss isn't an unweighted L2-regularized log loss.
+
+    Returns:
+    - A tuple of the training state, the drift reference and the new rows
+    as a CompactDataset, or None if the model must be refit from scratch.
+    """
+    state = load_training_state()
+    reference = drift.load_reference()
+    summary = profiling.load_summary()
+    if state is None or reference is None or summary is None or \
+            not supports_incremental(state['params']) or \
+            state['incremental_updates'] + 1 >= config.get(
+                'full_refit_every', 10):
+        return None
+    new_data = load_compact_dataset(new_rows_path())
+    if state['dataset_rows'] + len(new_data) != summary['rows']:
+        return None
+    return state, reference, new_data
+
+
+@instrumented('training')
+def train_model(incremental=None):
+    """
+    Trains a logistic regression model using the provided dataset.
+
+    Args:
+    - incremental: Optional; If True, update the deployed model with the
+    newly ingested rows, falling back to a full refit when the new rows
+    don't follow on from the rows it was trained on. Defaults to the
+    'incremental_training' setting in config.json.
+
+    With 'model_selection' set in config.json, a full refit first picks the
+    hyperparameters by cross-validation on the training set.
+    """
+    dataset_csv_path = config.path('output_folder_path', 'finaldata.csv')
+    model_path = config.path('output_model_path', 'trainedmodel.pkl')
+    if incremental is None:
+        incremental = config.get('incremental_training', False)
+
+    inputs = incremental_inputs() if incremental else None
+    if inputs is not None:
+        state, reference, new_data = inputs
+        x_new = new_data.frame()
+        record_rows(len(new_data))
+
+        # Update the deployed model with the new rows only
+        weights, hessian, iterations = incremental_update(
+            state, x_new, new_data.labels)
+        model = model_from_weights(weights, state['classes'], iterations,
+                                   state['params'])
+        state = training_state(
+            weights, hessian, state['classes'], state['params'],
+            state['dataset_rows'] + len(new_data),
+            state['incremental_updates'] + 1)
+        reference = drift.update_reference(
+            reference, x_new, model.predict_proba(x_new)[:, 1])
+    else:
+        # Read the dataset as compact feature and label arrays, and split it
+        # into training and test sets that are views of a single copy
+        train, test = load_compact_dataset(dataset_csv_path).split(
+            test_size=0.2, random_state=0)
+        dataset_rows = len(train) + len(test)
+        x_train, y_train = train.frame(), train.labels
+        record_rows(dataset_rows)
+
+        # Pick the hyperparameters by cross-validation
+        params = {}
+        results = None
+        if config.get('model_selection', False):
+            results = selection.select_model(
+                x_train, y_train, new_model().get_params())
+        if results is not None:
+            params = results['winner']['params']
+            selection.save_selection(results)
+        elif os.path.exists(selection.selection_path()):
+            os.remove(selection.selection_path())
+
+        # Fit the logistic regression to the data
+        model = new_model(params)
+        model.fit(x_train, y_train)
+
+        # Keep the Hessian of the regularized loss for incremental updates
+        weights = np.append(model.coef_.ravel(), model.intercept_)
+        hessian = penalty_hessian(model) + chunked_loss_hessian(
+            weights, train.features, model.C)
+        state = training_state(weights, hessian, model.classes_, params,
+                               dataset_rows, 0)
+        reference = drift.build_reference(
+            x_train, model.predict_proba(x_train)[:, 1])
 
     # Write the trained model to a file called trainedmodel.pkl
     with open(model_path, 'wb') as model_file:
         pickle.dump(model, model_file)
 
+    # Write the pickle-free compact model used for inference
+    export_compact_model(model, compact_model_path(model_path))
+
+    # Write the state used by the next incremental update
+    with open(training_state_path(), 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file)
+
+    # Write the reference profile that new data is checked for drift against
+    drift.save_reference(reference)
+
 
 if __name__ == '__main__':
     train_model()
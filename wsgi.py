@@ -1,4 +1,6 @@
-from app import app
+from app import app, init_app
+
+init_app()
 
 
 if __name__ == "__main__":